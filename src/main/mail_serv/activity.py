@@ -0,0 +1,85 @@
+"""
+User mailbox activity log:
+* syncer appends one entry per user per event batch
+* keeper collects entries to prioritize active users
+
+entry format: <epoch_seconds> <tab> <user_name> <tab> <event_count>
+"""
+
+import os
+import time
+import logging
+from typing import Mapping, List, Tuple
+from mail_serv.support import fs_mkdir
+
+logger = logging.getLogger(__name__)
+
+
+def activity_log_dir() -> str:
+    "activity log storage folder"
+    return os.environ.get('ACTIVITY_LOG_DIR', '/var/lib/mail_serv/activity')
+
+
+def activity_log_file() -> str:
+    "live activity log, appended by syncer"
+    return f"{activity_log_dir()}/activity.log"
+
+
+def activity_past_file() -> str:
+    "rotated activity log, consumed by keeper"
+    return f"{activity_log_dir()}/activity.log.past"
+
+
+def activity_record(user_count_map:Mapping[str, int], event_time:float=None) -> None:
+    "append activity entries with single write"
+    if not user_count_map:
+        return
+    if event_time is None:
+        event_time = time.time()
+    entry_time = int(event_time)
+    entry_text = "".join([
+        f"{entry_time}\t{user_name}\t{event_count}\n"
+        for user_name, event_count in user_count_map.items()
+    ])
+    fs_mkdir(activity_log_dir())
+    with open(activity_log_file(), "a") as activity_text:
+        activity_text.write(entry_text)
+
+
+def activity_parse_line(line:str) -> Tuple[str, float, int]:
+    "extract (user_name, event_time, event_count) from log entry"
+    entry_time, user_name, event_count = line.rstrip('\r\n').split('\t')
+    return (user_name, float(entry_time), int(event_count))
+
+
+def activity_parse_file(
+        activity_file:str,
+        activity_map:Mapping[str, List[Tuple[float, int]]],
+    ) -> None:
+    "accumulate activity log entries into the map"
+    with open(activity_file, "r") as line_list:
+        for line in line_list:
+            try:
+                user_name, event_time, event_count = activity_parse_line(line)
+            except Exception as error:
+                logger.warn(f"wrong entry: {line!r} :: {error}")
+                continue
+            activity_map.setdefault(user_name, list()).append((event_time, event_count))
+
+
+def activity_collect() -> Mapping[str, List[Tuple[float, int]]]:
+    """
+    consume activity log: rotate live log and parse rotated entries
+    result map: user_name -> list of (event_time, event_count)
+    """
+    log_file = activity_log_file()
+    past_file = activity_past_file()
+    activity_map = dict()
+    if os.path.isfile(past_file):  # left over from interrupted collect
+        activity_parse_file(past_file, activity_map)
+    if os.path.isfile(log_file):
+        os.replace(log_file, past_file)  # syncer re-creates live log
+        activity_parse_file(past_file, activity_map)
+    if os.path.isfile(past_file):
+        os.remove(past_file)
+    return activity_map
@@ -0,0 +1,154 @@
+"""
+Resumable run checkpoint:
+* run header is written atomically at run start
+* one json line per completed user is appended, no rewrite
+* only users with all steps done are skipped on resume, failed users are retried
+* unfinished run is resumed when its last update is recent enough
+
+journal format:
+{"run_id": ..., "time_start": ...}
+{"user": ..., "time": ..., "step": {"maintain": "done", ...}}
+{"finish": ...}
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from typing import Mapping, Set
+from mail_serv.support import fs_mkdir
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_dir() -> str:
+    "checkpoint journal folder"
+    return os.environ.get('CHECKPOINT_DIR', '/var/lib/mail_serv/keeper')
+
+
+def checkpoint_file(session:str) -> str:
+    "checkpoint journal of a run session"
+    return f"{checkpoint_dir()}/{session}.checkpoint"
+
+
+def checkpoint_stale_time() -> float:
+    "unfinished run older than this is abandoned, seconds"
+    return float(os.environ.get('CHECKPOINT_STALE_TIME', 12 * 3600))
+
+
+class RunCheckpoint():
+    "persisted progress of single keeper run"
+
+    session:str
+    run_id:str
+    time_start:float  # epoch
+    time_update:float  # epoch
+    user_step_map:Mapping[str, Mapping[str, str]]  # user -> step -> status
+    finished:bool
+    journal_lock:threading.Lock
+
+    def __init__(self, session:str, run_id:str=None, time_start:float=None):
+        self.session = session
+        self.run_id = run_id or uuid.uuid4().hex
+        self.time_start = time_start or time.time()
+        self.time_update = self.time_start
+        self.user_step_map = dict()
+        self.finished = False
+        self.journal_lock = threading.Lock()
+
+    @property
+    def journal_file(self) -> str:
+        return checkpoint_file(self.session)
+
+    @property
+    def user_done_set(self) -> Set[str]:
+        "users with all steps done, failed users are retried on resume"
+        return set([
+            user_name for user_name, step_map in self.user_step_map.items()
+            if step_map and all(status == 'done' for status in step_map.values())
+        ])
+
+    def is_stale(self, time_now:float=None) -> bool:
+        time_now = time_now or time.time()
+        return time_now - self.time_update > checkpoint_stale_time()
+
+    def apply_entry(self, entry:Mapping) -> None:
+        "replay journal entry"
+        if 'user' in entry:
+            self.user_step_map[entry['user']] = entry.get('step', dict())
+            self.time_update = max(self.time_update, entry.get('time', 0))
+        if 'finish' in entry:
+            self.finished = True
+            self.time_update = max(self.time_update, entry['finish'])
+
+    def append_entry(self, entry:Mapping) -> None:
+        "append single journal line"
+        line = json.dumps(entry, sort_keys=True) + "\n"
+        with self.journal_lock:
+            self.apply_entry(entry)
+            with open(self.journal_file, "a") as journal_text:
+                journal_text.write(line)
+
+    def persist_header(self) -> None:
+        "start new journal atomically"
+        header = dict(run_id=self.run_id, time_start=self.time_start)
+        fs_mkdir(checkpoint_dir())
+        work_file = f"{self.journal_file}.work"
+        with open(work_file, "w") as journal_text:
+            journal_text.write(json.dumps(header, sort_keys=True) + "\n")
+        os.replace(work_file, self.journal_file)
+
+    def record_user(self, user_name:str, step_map:Mapping[str, str]) -> None:
+        "remember completed user with per-step status"
+        self.append_entry(dict(user=user_name, time=time.time(), step=step_map))
+
+    def record_finish(self) -> None:
+        "mark run as complete"
+        self.append_entry(dict(finish=time.time()))
+
+
+def checkpoint_repair(journal_file:str) -> None:
+    "cut torn trailing line left by interrupted append"
+    with open(journal_file, "rb+") as journal_data:
+        journal_text = journal_data.read()
+        if journal_text and not journal_text.endswith(b"\n"):
+            journal_data.truncate(journal_text.rfind(b"\n") + 1)
+            logger.warn(f"torn entry: {journal_file}")
+
+
+def checkpoint_restore(session:str) -> RunCheckpoint:
+    "replay run journal, drop torn trailing line"
+    journal_file = checkpoint_file(session)
+    if not os.path.isfile(journal_file):
+        return None
+    checkpoint_repair(journal_file)
+    checkpoint = None
+    with open(journal_file, "r") as line_list:
+        for line in line_list:
+            try:
+                entry = json.loads(line)
+            except Exception as error:
+                logger.warn(f"wrong entry: {line!r} :: {error}")
+                continue
+            if checkpoint is None:
+                if 'run_id' not in entry:
+                    logger.warn(f"wrong header: {journal_file}")
+                    return None
+                checkpoint = RunCheckpoint(session, entry['run_id'], entry['time_start'])
+            else:
+                checkpoint.apply_entry(entry)
+    return checkpoint
+
+
+def checkpoint_begin(session:str) -> RunCheckpoint:
+    "resume recent unfinished run or start a new one"
+    checkpoint = checkpoint_restore(session)
+    if checkpoint and not checkpoint.finished and not checkpoint.is_stale():
+        logger.info(f"resume run: {checkpoint.run_id} user_done={len(checkpoint.user_step_map)}")
+        return checkpoint
+    checkpoint = RunCheckpoint(session)
+    checkpoint.persist_header()
+    logger.info(f"start run: {checkpoint.run_id}")
+    return checkpoint
@@ -3,31 +3,97 @@ Dovecot command wrapper
 """
 
 import os
+import time
+import signal
 import logging
+import threading
 import subprocess
-from typing import List, Tuple
-from mail_serv.process import execute_process_sert
+from typing import List, Tuple, Callable
+from mail_serv.process import execute_process_sert, execute_process_unit, \
+    execute_process_line, process_time_left, ExecuteResult
 
 logger = logging.getLogger(__name__)
 
 
+# doveconf results: (config_file, *option_list) -> (time_cached, result)
+doveconf_cache_map = dict()
+doveconf_cache_lock = threading.Lock()
+
+
+def dove_config_file() -> str:
+    return os.getenv('DOVECOT_CONFIG', '/etc/dovecot/dovecot.conf')
+
+
+def doveconf_cache_time() -> float:
+    "doveconf result reuse period in seconds, zero disables cache"
+    return float(os.environ.get('DOVECONF_CACHE_TIME', 60))
+
+
 def execute_dove(dove_cmd:str, *option_list:Tuple[str]):
-    config_file = os.getenv('DOVECOT_CONFIG', '/etc/dovecot/dovecot.conf')
+    config_file = dove_config_file()
     command = [dove_cmd, '-c', config_file] + list(option_list)
     return execute_process_sert(command).strip()
 
 
+def execute_dove_result(dove_cmd:str, *option_list:Tuple[str]) -> ExecuteResult:
+    "invoke without asserting, let caller inspect exit code and output"
+    config_file = dove_config_file()
+    command = [dove_cmd, '-c', config_file] + list(option_list)
+    return execute_process_unit(command)
+
+
+def execute_dove_line(dove_cmd:str, react_stderr:Callable, *option_list:Tuple[str]) -> ExecuteResult:
+    "invoke without asserting, stream error output lines to reaction"
+    config_file = dove_config_file()
+    command = [dove_cmd, '-c', config_file] + list(option_list)
+    return execute_process_line(command, react_stderr)
+
+
 def doveconf(*option_list:Tuple[str]):
-    return execute_dove('doveconf', *option_list)
+    cache_time = doveconf_cache_time()
+    if not cache_time:
+        return execute_dove('doveconf', *option_list)
+    cache_key = (dove_config_file(),) + tuple(option_list)
+    time_now = time.monotonic()
+    with doveconf_cache_lock:
+        cache_entry = doveconf_cache_map.get(cache_key, None)
+    if cache_entry and time_now - cache_entry[0] < cache_time:
+        return cache_entry[1]
+    result = execute_dove('doveconf', *option_list)
+    with doveconf_cache_lock:
+        doveconf_cache_map[cache_key] = (time_now, result)
+    return result
 
 
 def doveadm(*option_list:Tuple[str]):
     return execute_dove('doveadm', *option_list)
 
 
+def doveadm_result(*option_list:Tuple[str]) -> ExecuteResult:
+    return execute_dove_result('doveadm', *option_list)
+
+
+def doveadm_line(react_stderr:Callable, *option_list:Tuple[str]) -> ExecuteResult:
+    return execute_dove_line('doveadm', react_stderr, *option_list)
+
+
 def sieve_filter(*option_list:Tuple[str]):
     return execute_dove('sieve-filter', *option_list)
 
 
+def sievec(*option_list:Tuple[str]):
+    return execute_dove('sievec', *option_list)
+
+
 def shell(script) -> subprocess.CompletedProcess:
-    return subprocess.check_output(script, shell=True)
+    "run script in own session, on thread deadline kill whole pipeline, not only the shell"
+    process = subprocess.Popen(script, shell=True, stdout=subprocess.PIPE, start_new_session=True)
+    try:
+        stdout, _ = process.communicate(timeout=process_time_left())
+    except BaseException:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.communicate()
+        raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, script, output=stdout)
+    return stdout
@@ -0,0 +1,319 @@
+"""
+Replication work dispatch:
+* one work queue per peer node with concurrency limit
+* coalesce duplicate (user, guid) tasks, user task subsumes guid tasks
+* retry failed tasks with jittered exponential backoff
+* persist exhausted tasks as peer backlog, drain it when node reappears,
+  after next successful task to the peer, and periodically
+* requeue temporary lock failures with backoff, outside of retry limit
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+import functools
+from dataclasses import dataclass
+from typing import Mapping, List, Set, Tuple, Callable
+
+from mail_serv.tinker import tinker_registry, NodeEntry
+from mail_serv.prober import prober_enable, prober_instance
+from mail_serv.replicate import replicate_with_user, replicate_with_guid, ReplicateTempFail
+from mail_serv.metrics import metrics_count
+from mail_serv.echo import echo_tracker
+from mail_serv.support import fs_persist_json, fs_restore_json, fs_rmany
+from mail_serv.procname import procname_set
+
+logger = logging.getLogger(__name__)
+
+
+def dispatch_peer_limit() -> int:
+    "concurrent replication tasks per peer"
+    return max(1, int(os.environ.get('DISPATCH_PEER_LIMIT', 2)))
+
+
+def dispatch_retry_limit() -> int:
+    "task attempts before moving to backlog"
+    return int(os.environ.get('DISPATCH_RETRY_LIMIT', 5))
+
+
+def dispatch_contention_limit() -> int:
+    "lock contention requeues before failures count as attempts"
+    return int(os.environ.get('DISPATCH_CONTENTION_LIMIT', 20))
+
+
+def dispatch_backoff_base() -> float:
+    "initial retry delay, seconds"
+    return float(os.environ.get('DISPATCH_BACKOFF_BASE', 2.0))
+
+
+def dispatch_backoff_limit() -> float:
+    "maximum retry delay, seconds"
+    return float(os.environ.get('DISPATCH_BACKOFF_LIMIT', 120.0))
+
+
+def dispatch_backlog_period() -> float:
+    "retry interval of peer backlog while node stays listed, seconds"
+    return float(os.environ.get('DISPATCH_BACKLOG_PERIOD', 300.0))
+
+
+def dispatch_backlog_dir() -> str:
+    "persisted peer backlog folder"
+    return os.environ.get('DISPATCH_BACKLOG_DIR', '/var/lib/mail_serv/dispatch')
+
+
+def dispatch_backlog_file(node_name:str) -> str:
+    "persisted backlog of single peer"
+    return f"{dispatch_backlog_dir()}/{node_name}.json"
+
+
+def dispatch_backoff_delay(attempt:int) -> float:
+    "jittered exponential retry delay"
+    delay = dispatch_backoff_base() * 2 ** max(0, attempt - 1)
+    delay = min(delay, dispatch_backoff_limit())
+    return delay * random.uniform(0.5, 1.5)
+
+
+@dataclass(frozen=True)
+class ReplicateTask:
+    "replication unit for a peer"
+
+    user:str
+    guid:str = None  # None means all user mailboxes
+
+
+@dataclass
+class TaskState:
+    "retry state of pending task"
+
+    attempt:int = 0  # failed attempts so far
+    contention:int = 0  # temporary lock failures so far
+    time_ready:float = 0  # earliest execution, monotonic
+
+
+def dispatch_execute(node:NodeEntry, task:ReplicateTask) -> None:
+    "perform replication task against peer node"
+    if prober_enable():
+        target = (node.addr, int(node.port))
+        if not prober_instance().live_list([target]):
+            raise RuntimeError(f"node unavailable: {node.name}")
+    if task.guid:
+        replicate_with_guid(task.user, task.guid, node.addr, node.port)
+    else:
+        replicate_with_user(task.user, node.addr, node.port)
+
+
+class PeerQueue():
+    "replication work queue of single peer"
+
+    node_name:str
+    execute_func:Callable
+    pending:Mapping[ReplicateTask, TaskState]  # insertion ordered
+    active:Set[ReplicateTask]  # tasks in progress
+    rerun:Set[ReplicateTask]  # tasks resubmitted while in progress
+    backlog:Set[ReplicateTask]  # tasks exhausted retries or lost node
+    time_drain:float  # next periodic backlog drain, monotonic
+    condition:threading.Condition
+
+    def __init__(self, node_name:str, execute_func:Callable, worker_count:int):
+        self.node_name = node_name
+        self.execute_func = execute_func
+        self.pending = dict()
+        self.active = set()
+        self.rerun = set()
+        self.backlog = self.restore_backlog()
+        self.time_drain = time.monotonic() + dispatch_backlog_period()
+        self.condition = threading.Condition()
+        for index in range(worker_count):
+            threading.Thread(
+                name=f'dispatch-{node_name}-{index}',
+                daemon=True,
+                target=self.worker_task,
+            ).start()
+
+    def restore_backlog(self) -> Set[ReplicateTask]:
+        entry_list = fs_restore_json(dispatch_backlog_file(self.node_name), list())
+        return set([ReplicateTask(*entry) for entry in entry_list])
+
+    def persist_backlog(self) -> None:
+        "invoked under condition lock"
+        backlog_file = dispatch_backlog_file(self.node_name)
+        try:
+            if self.backlog:
+                entry_list = sorted([[task.user, task.guid] for task in self.backlog], key=str)
+                fs_persist_json(backlog_file, entry_list)
+            else:
+                fs_rmany(backlog_file)
+        except Exception as error:
+            logger.warn(f"backlog failure: {self.node_name} :: {error}")
+
+    def submit(self, task:ReplicateTask) -> None:
+        "enqueue task, coalesce with pending and active work"
+        with self.condition:
+            self.submit_locked(task, TaskState(time_ready=time.monotonic()))
+            self.condition.notify()
+
+    def submit_locked(self, task:ReplicateTask, state:TaskState) -> None:
+        if task in self.active:
+            self.rerun.add(task)  # changes may have missed running sync
+            return
+        if task in self.pending:
+            return  # keep retry state
+        if task.guid and ReplicateTask(task.user) in self.pending:
+            return  # subsumed by pending user task
+        if task.guid is None:
+            for past in list(self.pending.keys()):
+                if past.user == task.user:
+                    del self.pending[past]
+        self.pending[task] = state
+
+    def drain_backlog(self) -> None:
+        "move backlog into pending work"
+        with self.condition:
+            self.drain_locked()
+            self.condition.notify_all()
+
+    def drain_locked(self) -> None:
+        time_now = time.monotonic()
+        self.time_drain = time_now + dispatch_backlog_period()
+        if not self.backlog:
+            return
+        logger.info(f"backlog drain: {self.node_name} count={len(self.backlog)}")
+        for task in sorted(self.backlog, key=lambda task: (task.user, task.guid or '')):
+            self.submit_locked(task, TaskState(time_ready=time_now))
+        self.backlog.clear()
+        self.persist_backlog()
+
+    def take(self) -> Tuple[ReplicateTask, TaskState]:
+        "obtain next ready task, block until available"
+        with self.condition:
+            while True:
+                time_now = time.monotonic()
+                if self.backlog and self.time_drain <= time_now:
+                    self.drain_locked()
+                time_next = self.time_drain if self.backlog else None
+                for task, state in self.pending.items():
+                    if state.time_ready <= time_now:
+                        del self.pending[task]
+                        self.active.add(task)
+                        return (task, state)
+                    if time_next is None or state.time_ready < time_next:
+                        time_next = state.time_ready
+                time_wait = None if time_next is None else time_next - time_now
+                self.condition.wait(time_wait)
+
+    def finish(
+            self, task:ReplicateTask, state:TaskState, success:bool,
+            node_gone:bool=False, temp_fail:bool=False,
+        ) -> None:
+        "apply task outcome: done, requeue, retry or backlog"
+        with self.condition:
+            self.active.discard(task)
+            has_rerun = task in self.rerun
+            self.rerun.discard(task)
+            time_now = time.monotonic()
+            if success:
+                if has_rerun:
+                    self.submit_locked(task, TaskState(time_ready=time_now))
+                if self.backlog:  # peer is reachable again
+                    self.drain_locked()
+            elif temp_fail and state.contention < dispatch_contention_limit():
+                state.contention += 1
+                metrics_count('dispatch_requeue', node=self.node_name)
+                state.time_ready = time_now + dispatch_backoff_delay(state.contention)
+                self.submit_locked(task, state)
+            else:
+                state.attempt += 1
+                if node_gone or state.attempt >= dispatch_retry_limit():
+                    logger.warn(f"backlog task: {self.node_name} {task} attempt={state.attempt}")
+                    if not self.backlog:
+                        self.time_drain = time_now + dispatch_backlog_period()
+                    self.backlog.add(task)
+                    self.persist_backlog()
+                else:
+                    state.time_ready = time_now + dispatch_backoff_delay(state.attempt)
+                    self.submit_locked(task, state)
+            self.condition.notify_all()
+
+    def worker_task(self) -> None:
+        "execute peer tasks forever"
+        procname_set(threading.current_thread().name)
+        while True:
+            task, state = self.take()
+            try:
+                node = tinker_registry().node_entry(self.node_name)
+                if node is None:
+                    self.finish(task, state, success=False, node_gone=True)
+                    continue
+                func_info = f"{task.user}/{task.guid} {node.addr}:{node.port}"
+                try:
+                    logger.debug(func_info)
+                    self.execute_func(node, task)
+                    self.finish(task, state, success=True)
+                except ReplicateTempFail as error:
+                    logger.info(f"requeue: {func_info} contention={state.contention + 1} :: {error}")
+                    self.finish(task, state, success=False, temp_fail=True)
+                except Exception as error:
+                    logger.warn(f"failure: {func_info} attempt={state.attempt + 1} :: {error}")
+                    self.finish(task, state, success=False)
+            except Exception as error:
+                logger.warn(f"failure: {error}")
+                time.sleep(1)  # prevent error spin
+
+    def report_size(self) -> Mapping[str, int]:
+        with self.condition:
+            return dict(
+                pending=len(self.pending),
+                active=len(self.active),
+                backlog=len(self.backlog),
+            )
+
+
+class ReplicateDispatcher():
+    "per-peer replication queues for live mesh nodes"
+
+    execute_func:Callable
+    peer_map:Mapping[str, PeerQueue]
+    dispatch_lock:threading.Lock
+
+    def __init__(self, execute_func:Callable=dispatch_execute):
+        self.execute_func = execute_func
+        self.peer_map = dict()
+        self.dispatch_lock = threading.Lock()
+
+    def peer_queue(self, node_name:str) -> PeerQueue:
+        with self.dispatch_lock:
+            if node_name not in self.peer_map:
+                self.peer_map[node_name] = PeerQueue(
+                    node_name, self.execute_func, dispatch_peer_limit(),
+                )
+            return self.peer_map[node_name]
+
+    def node_change(self, node_tuple:Tuple[NodeEntry, ...]) -> None:
+        "drain backlog of present nodes, registry listener"
+        for node in node_tuple:
+            self.peer_queue(node.name).drain_backlog()
+
+    def submit(self, user:str, guid:str=None) -> None:
+        "enqueue replication of user or user mailbox to every live replica peer"
+        task = ReplicateTask(user, guid)
+        for node in tinker_registry().user_snapshot(user):
+            self.peer_queue(node.name).submit(task)
+
+    def report_size(self) -> Mapping[str, Mapping[str, int]]:
+        "queue sizes per peer"
+        with self.dispatch_lock:
+            peer_list = list(self.peer_map.items())
+        return dict([(node_name, peer.report_size()) for node_name, peer in peer_list])
+
+
+@functools.lru_cache(maxsize=1)
+def dispatch_instance() -> ReplicateDispatcher:
+    "process wide dispatcher, drains backlog on node set change, takes tasks released by echo tracker"
+    dispatcher = ReplicateDispatcher()
+    registry = tinker_registry()
+    registry.listen(dispatcher.node_change)
+    echo_tracker().listen(dispatcher.submit)
+    dispatcher.node_change(registry.snapshot())
+    return dispatcher
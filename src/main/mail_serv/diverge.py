@@ -0,0 +1,211 @@
+"""
+Pre-sync divergence check:
+* compare cheap mailbox summary of local and peer replica before dsync
+* summary: mailbox guid -> (highestmodseq, uidnext, messages)
+* local summary from 'doveadm mailbox status', peer summary via doveadm http api
+* only mailboxes which differ need dsync, mailbox set change needs user sync
+* peer summaries are prefetched for a batch of users in single request per peer
+
+https://wiki.dovecot.org/Design/DoveadmProtocol/HTTP
+"""
+
+import os
+import time
+import logging
+import threading
+import functools
+from typing import Mapping, List, Tuple, Any, Optional
+from mail_serv.command import doveadm
+from mail_serv.remote import DoveAdmHTTPClient
+from mail_serv.metrics import metrics_count
+from mail_serv.support import convert_text2bool
+
+logger = logging.getLogger(__name__)
+
+# mailbox summary: guid -> (highestmodseq, uidnext, messages)
+MboxSummary = Mapping[str, Tuple[str, str, str]]
+
+# 'doveadm mailbox status' fields, guid first
+diverge_field_list = ['guid', 'highestmodseq', 'uidnext', 'messages']
+
+
+def diverge_enable() -> bool:
+    "compare summaries before keeper dsync, needs peer doveadm http api, no by default"
+    return convert_text2bool(os.environ.get('DIVERGE_ENABLE', 'false'))
+
+
+def diverge_http_port() -> str:
+    "peer doveadm http api port"
+    return os.environ.get('DIVERGE_HTTP_PORT', '8080')
+
+
+def diverge_http_path() -> str:
+    "peer doveadm http api path"
+    return os.environ.get('DIVERGE_HTTP_PATH', '/doveadm/v1')
+
+
+def diverge_api_key() -> str:
+    "doveadm_api_key of peers, optional"
+    return os.environ.get('DIVERGE_API_KEY', None)
+
+
+def diverge_password() -> str:
+    "doveadm_password of peers, optional"
+    return os.environ.get('DIVERGE_PASSWORD', None)
+
+
+def diverge_timeout() -> float:
+    "peer summary request timeout, seconds"
+    return float(os.environ.get('DIVERGE_TIMEOUT', 10.0))
+
+
+def diverge_guid_limit() -> int:
+    "differing mailboxes above which single user sync is cheaper"
+    return int(os.environ.get('DIVERGE_GUID_LIMIT', 20))
+
+
+def diverge_batch_size() -> int:
+    "users per prefetch request of peer summaries"
+    return int(os.environ.get('DIVERGE_BATCH_SIZE', 50))
+
+
+def diverge_prefetch_age() -> float:
+    "prefetched peer summary older than this is fetched again, seconds"
+    return float(os.environ.get('DIVERGE_PREFETCH_AGE', 60.0))
+
+
+def diverge_summary_entry(entry:Mapping[str, Any]) -> Tuple[str, Tuple[str, str, str]]:
+    return (entry['guid'], tuple(str(entry[field]) for field in diverge_field_list[1:]))
+
+
+def diverge_parse_table(text:str) -> MboxSummary:
+    "parse 'doveadm -f tab mailbox status' output with header line"
+    line_list = [line for line in (text or "").splitlines() if line.strip()]
+    if not line_list:
+        return dict()
+    header = line_list[0].split('\t')
+    entry_list = [dict(zip(header, line.split('\t'))) for line in line_list[1:]]
+    return dict([diverge_summary_entry(entry) for entry in entry_list])
+
+
+def diverge_parse_response(response:List[Any]) -> Optional[MboxSummary]:
+    "parse doveadm http api 'mailboxStatus' response, None on error"
+    kind, payload, _ = response
+    if kind != 'doveadmResponse':
+        logger.warn(f"response failure: {payload}")
+        return None
+    return dict([diverge_summary_entry(entry) for entry in payload])
+
+
+def diverge_local_summary(user:str) -> MboxSummary:
+    "summary of local replica"
+    field_text = " ".join(diverge_field_list)
+    return diverge_parse_table(doveadm('-f', 'tab', 'mailbox', 'status', '-u', user, field_text, '*'))
+
+
+@functools.lru_cache(maxsize=None)
+def diverge_client(addr:str) -> DoveAdmHTTPClient:
+    "reusable http api session per peer"
+    apiurl = f"http://{addr}:{diverge_http_port()}{diverge_http_path()}"
+    return DoveAdmHTTPClient(
+        apiurl,
+        apikey=diverge_api_key(),
+        username='doveadm', password=diverge_password(),
+    )
+
+
+def diverge_remote_summary_list(addr:str, user_list:List[str]) -> List[Optional[MboxSummary]]:
+    "summaries of peer replica for several users in single request, None on error"
+    command_list = [
+        ('mailboxStatus', dict(user=user, field=diverge_field_list, mailboxMask=['*']))
+        for user in user_list
+    ]
+    response_list = diverge_client(addr).run_batch(command_list, timeout=diverge_timeout())
+    return [diverge_parse_response(response) for response in response_list]
+
+
+class DivergeRemoteCache():
+    "prefetched peer summaries, each entry is used once"
+
+    entry_map:Mapping[Tuple[str, str], Tuple[float, MboxSummary]]  # (addr, user) -> (time, summary)
+    cache_lock:threading.Lock
+
+    def __init__(self):
+        self.entry_map = dict()
+        self.cache_lock = threading.Lock()
+
+    def store(self, addr:str, user:str, summary:MboxSummary) -> None:
+        with self.cache_lock:
+            self.entry_map[(addr, user)] = (time.monotonic(), summary)
+
+    def take(self, addr:str, user:str) -> Optional[MboxSummary]:
+        "prefetched summary, None when missing or too old"
+        with self.cache_lock:
+            entry = self.entry_map.pop((addr, user), None)
+        if entry is None:
+            return None
+        time_fetch, summary = entry
+        if time.monotonic() - time_fetch > diverge_prefetch_age():
+            return None
+        return summary
+
+    def clear(self) -> None:
+        with self.cache_lock:
+            self.entry_map.clear()
+
+
+@functools.lru_cache(maxsize=1)
+def diverge_remote_cache() -> DivergeRemoteCache:
+    "process wide prefetched peer summaries"
+    return DivergeRemoteCache()
+
+
+def diverge_prefetch(addr:str, user_list:List[str]) -> None:
+    "fetch peer summaries for batch of users in single request, keep them for divergence check"
+    if not user_list:
+        return
+    try:
+        summary_list = diverge_remote_summary_list(addr, user_list)
+    except Exception as error:
+        logger.warn(f"prefetch failure: {addr} :: {error}")
+        return
+    cache = diverge_remote_cache()
+    for user, summary in zip(user_list, summary_list):
+        if summary is not None:
+            cache.store(addr, user, summary)
+    metrics_count('diverge_prefetch', len(user_list))
+
+
+def diverge_compare(local:MboxSummary, remote:MboxSummary) -> Optional[List[str]]:
+    "differing mailbox guids, None when mailbox set differs"
+    if local.keys() != remote.keys():
+        return None
+    return sorted([guid for guid, summary in local.items() if remote[guid] != summary])
+
+
+def diverge_guid_list(user:str, addr:str) -> Optional[List[str]]:
+    "mailbox guids which need dsync, None means whole user sync"
+    try:
+        remote = diverge_remote_cache().take(addr, user)
+        if remote is None:
+            remote = diverge_remote_summary_list(addr, [user])[0]
+        if remote is None:
+            metrics_count('diverge_user_sync', reason='error')
+            return None
+        local = diverge_local_summary(user)
+    except Exception as error:
+        logger.warn(f"failure: {user} {addr} :: {error}")
+        metrics_count('diverge_user_sync', reason='error')
+        return None
+    guid_list = diverge_compare(local, remote)
+    if guid_list is None:
+        metrics_count('diverge_user_sync', reason='mailbox_set')
+        return None
+    if len(guid_list) > diverge_guid_limit():
+        metrics_count('diverge_user_sync', reason='guid_limit')
+        return None
+    if guid_list:
+        metrics_count('diverge_guid_sync', len(guid_list))
+    else:
+        metrics_count('diverge_in_sync')
+    return guid_list
@@ -0,0 +1,262 @@
+"""
+Dsync throughput statistics:
+* run 'doveadm -D sync' and parse importer debug lines from stderr
+* count mailboxes and message changes imported on either side
+* measure wall clock duration, classify lock timeout and connect failure
+* stream stderr line by line, retain only bounded error text
+* aggregate per node into rolling metrics counters
+* keep per user figures in a capped least recently used table, report top users
+
+importer debug line example:
+dsync-local(user): Debug: brain M: Import INBOX: Import change type=save GUID=... UID=5 ...
+
+note: dsync does not report transferred byte volume;
+debug output is large, so change counting is opt-in,
+duration and failure kind are collected without it
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+import functools
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Mapping, List
+from mail_serv.metrics import metrics_count, metrics_report_dir
+from mail_serv.support import convert_text2bool, fs_persist_json
+
+logger = logging.getLogger(__name__)
+
+# default counted stderr patterns: stat name -> regex
+dsyncstat_regex_default = dict(
+    message_save=r'Import change type=save\b',
+    message_expunge=r'Import change type=expunge\b',
+    flag_change=r'Import change type=flag_change\b',
+)
+
+
+def dsyncstat_enable() -> bool:
+    "run dsync with debug output and count imported changes, no by default"
+    return convert_text2bool(os.environ.get('DSYNCSTAT_ENABLE', 'false'))
+
+
+def dsyncstat_stderr_limit() -> int:
+    "retained error text, characters"
+    return int(os.environ.get('DSYNCSTAT_STDERR_LIMIT', 64 * 1024))
+
+
+def dsyncstat_user_limit() -> int:
+    "users retained in per-user table, least recently synced are evicted"
+    return int(os.environ.get('DSYNCSTAT_USER_LIMIT', 1000))
+
+
+def dsyncstat_user_top() -> int:
+    "users in per-user report, ordered by dsync duration"
+    return int(os.environ.get('DSYNCSTAT_USER_TOP', 20))
+
+
+def dsyncstat_user_file(session:str) -> str:
+    "per-user dsync json report of a service"
+    return f"{metrics_report_dir()}/{session}.dsync-user.json"
+
+
+@functools.lru_cache(maxsize=1)
+def dsyncstat_regex_mailbox() -> re.Pattern:
+    "regex pattern in debug line with imported mailbox name as group 1"
+    regex = os.environ.get('DSYNCSTAT_REGEX_MAILBOX', r'brain [MS]: Import (.+?): ')
+    return re.compile(regex)
+
+
+@functools.lru_cache(maxsize=1)
+def dsyncstat_regex_map() -> Mapping[str, re.Pattern]:
+    "counted debug line patterns, override with DSYNCSTAT_REGEX_<NAME>"
+    return dict([
+        (name, re.compile(os.environ.get(f'DSYNCSTAT_REGEX_{name.upper()}', regex)))
+        for name, regex in dsyncstat_regex_default.items()
+    ])
+
+
+@functools.lru_cache(maxsize=1)
+def dsyncstat_regex_lock() -> re.Pattern:
+    "regex pattern in error output which means user lock wait timeout"
+    regex = os.environ.get('DSYNCSTAT_REGEX_LOCK', r"(couldn't|failed to) lock|lock.*(timeout|timed out)")
+    return re.compile(regex, re.RegexFlag.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1)
+def dsyncstat_regex_connect() -> re.Pattern:
+    "regex pattern in error output which means peer connection failure"
+    regex = os.environ.get('DSYNCSTAT_REGEX_CONNECT', r'connect\(.*\) failed|connection refused|disconnected')
+    return re.compile(regex, re.RegexFlag.IGNORECASE)
+
+
+@dataclass
+class DsyncStat:
+    "outcome of single dsync run"
+
+    duration:float = 0  # wall clock, seconds
+    rc:int = 0  # doveadm exit code
+    mailbox:int = 0  # distinct imported mailboxes
+    message_save:int = 0
+    message_expunge:int = 0
+    flag_change:int = 0
+    lock_fail:bool = False  # gave up waiting for user lock
+    connect_fail:bool = False  # could not reach peer
+
+    def failure_kind(self) -> str:
+        if self.rc == 0:
+            return 'none'
+        if self.lock_fail:
+            return 'lock'
+        if self.connect_fail:
+            return 'connect'
+        return 'other'
+
+
+@dataclass
+class DsyncUserEntry:
+    "accumulated dsync figures of single user"
+
+    run:int = 0
+    failure:int = 0
+    duration:float = 0
+    mailbox:int = 0
+    message_save:int = 0
+    message_expunge:int = 0
+    flag_change:int = 0
+
+    def absorb(self, stat:DsyncStat) -> None:
+        self.run += 1
+        self.failure += int(stat.rc != 0)
+        self.duration += stat.duration
+        for name in ('mailbox', 'message_save', 'message_expunge', 'flag_change'):
+            setattr(self, name, getattr(self, name) + getattr(stat, name))
+
+
+class DsyncUserTable():
+    "thread safe per-user figures, capped by least recently used eviction"
+
+    entry_map:OrderedDict  # user -> DsyncUserEntry, most recent last
+    table_lock:threading.Lock
+
+    def __init__(self):
+        self.entry_map = OrderedDict()
+        self.table_lock = threading.Lock()
+
+    def record(self, user:str, stat:DsyncStat) -> None:
+        with self.table_lock:
+            entry = self.entry_map.pop(user, None) or DsyncUserEntry()
+            entry.absorb(stat)
+            self.entry_map[user] = entry
+            while len(self.entry_map) > dsyncstat_user_limit():
+                self.entry_map.popitem(last=False)
+
+    def entry(self, user:str) -> DsyncUserEntry:
+        with self.table_lock:
+            return self.entry_map.get(user, None)
+
+    def report(self, top:int=None) -> Mapping[str, Mapping[str, float]]:
+        "top users by dsync duration"
+        top = dsyncstat_user_top() if top is None else top
+        with self.table_lock:
+            entry_list = sorted(self.entry_map.items(), key=lambda item: item[1].duration, reverse=True)
+            return dict([(user, asdict(entry)) for user, entry in entry_list[:top]])
+
+
+@functools.lru_cache(maxsize=1)
+def dsyncstat_user_table() -> DsyncUserTable:
+    "process wide per-user table"
+    return DsyncUserTable()
+
+
+class DsyncStatReader():
+    "consume dsync stderr lines, count debug lines, keep bounded error text"
+
+    stat:DsyncStat
+    mailbox_set:set
+    error_list:List[str]
+    error_size:int
+    error_limit:int
+
+    def __init__(self):
+        self.stat = DsyncStat()
+        self.mailbox_set = set()
+        self.error_list = list()
+        self.error_size = 0
+        self.error_limit = dsyncstat_stderr_limit()
+        self.regex_mailbox = dsyncstat_regex_mailbox()
+        self.regex_map = dsyncstat_regex_map()
+
+    def line(self, line:str) -> None:
+        if 'Debug:' not in line:
+            if self.error_size < self.error_limit:
+                line = line[:self.error_limit - self.error_size]
+                self.error_list.append(line)
+                self.error_size += len(line)
+            return
+        match = self.regex_mailbox.search(line)
+        if match:
+            self.mailbox_set.add(match.group(1))
+        for name, regex in self.regex_map.items():
+            if regex.search(line):
+                setattr(self.stat, name, getattr(self.stat, name) + 1)
+
+    def error_text(self) -> str:
+        return "".join(self.error_list)
+
+    def finish(self, rc:int, duration:float) -> DsyncStat:
+        stat = self.stat
+        stat.rc = rc
+        stat.duration = duration
+        stat.mailbox = len(self.mailbox_set)
+        if rc != 0:
+            error_text = self.error_text()
+            stat.lock_fail = bool(dsyncstat_regex_lock().search(error_text))
+            stat.connect_fail = bool(dsyncstat_regex_connect().search(error_text))
+        return stat
+
+
+def dsyncstat_error_text(stderr:str) -> str:
+    "stderr without debug lines"
+    line_list = (stderr or "").splitlines()
+    return "\n".join([line for line in line_list if 'Debug:' not in line])
+
+
+def dsyncstat_parse(stderr:str, rc:int, duration:float) -> DsyncStat:
+    "extract statistics from 'doveadm -D sync' stderr"
+    reader = DsyncStatReader()
+    for line in (stderr or "").splitlines(keepends=True):
+        reader.line(line)
+    return reader.finish(rc, duration)
+
+
+def dsyncstat_record(destination:str, stat:DsyncStat, user:str=None) -> None:
+    "aggregate run statistics per node, per user into capped table, user label would be unbounded"
+    if user:
+        dsyncstat_user_table().record(user, stat)
+    label_dict = dict(node=destination)
+    metrics_count('dsync_run', failure=stat.failure_kind(), **label_dict)
+    metrics_count('dsync_seconds', stat.duration, **label_dict)
+    if stat.lock_fail:
+        metrics_count('dsync_lock_seconds', stat.duration, **label_dict)
+    if stat.connect_fail:
+        metrics_count('dsync_connect_seconds', stat.duration, **label_dict)
+    for name in ('mailbox', 'message_save', 'message_expunge', 'flag_change'):
+        value = getattr(stat, name)
+        if value:
+            metrics_count(f'dsync_{name}', value, **label_dict)
+
+
+def dsyncstat_persist_report(session:str) -> None:
+    "dump top users of per-user table as json report"
+    report = dict(
+        time=time.time(),
+        user_count=len(dsyncstat_user_table().entry_map),
+        user=dsyncstat_user_table().report(),
+    )
+    try:
+        fs_persist_json(dsyncstat_user_file(session), report)
+    except Exception as error:
+        logger.warn(f"report failure: {error}")
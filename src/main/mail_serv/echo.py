@@ -0,0 +1,172 @@
+"""
+Replication echo collapse:
+* dsync writes into local mailboxes fire syncer plugin events as well
+* replicating such events back into the mesh only repeats finished work
+* plugin event carries only chng_type, user_name, mbox_name, mbox_guid,
+  so echo is recognized by local dsync session, not by event content
+
+echo collapse, replication task only, sieve invoke and freshness still see the event:
+* event for (user, guid) with local dsync in flight: task is deferred behind that sync,
+  dropped when sync succeeds, released into dispatch when sync fails
+* event for (user, guid) within window after local dsync: task is dropped
+  when mailbox summary (highestmodseq, uidnext, messages) equals one taken at sync finish,
+  i.e. there is no newer change than the sync has seen
+* genuine change which lands during dsync but is missed by it is still recorded
+  by freshness after sync start, so keeper replicates it on next run
+"""
+
+import os
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Mapping, List, Set, Tuple, Callable, Optional
+from mail_serv.diverge import diverge_local_summary, MboxSummary
+from mail_serv.support import convert_text2bool
+
+logger = logging.getLogger(__name__)
+
+# tracked sync scope: (user, guid), guid None means whole user
+EchoScope = Tuple[str, str]
+
+
+def echo_window() -> float:
+    "suppression window after local dsync finish, seconds, covers event batching"
+    return float(os.environ.get('ECHO_WINDOW', 10.0))
+
+
+def echo_collapse() -> bool:
+    "defer and drop replication tasks covered by local dsync, yes by default"
+    return convert_text2bool(os.environ.get('ECHO_COLLAPSE', 'true'))
+
+
+def echo_summary(user:str) -> MboxSummary:
+    "local mailbox summary, compared before and after local dsync"
+    return diverge_local_summary(user)
+
+
+class EchoTracker():
+    "remember local dsync sessions per (user, guid), hold replication tasks behind them"
+
+    inflight_map:Mapping[EchoScope, int]  # scope -> running sync count
+    finish_map:Mapping[EchoScope, float]  # scope -> last finish, monotonic
+    summary_map:Mapping[EchoScope, MboxSummary]  # scope -> local summary at last successful finish
+    defer_map:Mapping[EchoScope, Set[str]]  # scope -> guids of deferred tasks
+    listener_list:List[Callable]  # invoked with (user, guid) of released task
+    tracker_lock:threading.Lock
+
+    def __init__(self):
+        self.inflight_map = dict()
+        self.finish_map = dict()
+        self.summary_map = dict()
+        self.defer_map = dict()
+        self.listener_list = list()
+        self.tracker_lock = threading.Lock()
+
+    def listen(self, listener:Callable) -> None:
+        "invoke listener(user, guid) for deferred task of failed sync"
+        self.listener_list.append(listener)
+
+    def sync_begin(self, user:str, guid:str=None) -> None:
+        scope = (user, guid)
+        with self.tracker_lock:
+            self.inflight_map[scope] = self.inflight_map.get(scope, 0) + 1
+
+    def sync_finish(self, user:str, guid:str=None, summary:MboxSummary=None) -> None:
+        "summary None means failed sync, deferred tasks are released, otherwise dropped"
+        scope = (user, guid)
+        release_list = list()
+        with self.tracker_lock:
+            count = self.inflight_map.get(scope, 0) - 1
+            if count > 0:
+                self.inflight_map[scope] = count
+            else:
+                self.inflight_map.pop(scope, None)
+            self.finish_map[scope] = time.monotonic()
+            if summary is None:
+                self.summary_map.pop(scope, None)
+                release_list = sorted(self.defer_map.pop(scope, set()), key=str)
+            else:
+                self.summary_map[scope] = summary
+                if count <= 0:
+                    self.defer_map.pop(scope, None)
+        for release_guid in release_list:
+            for listener in self.listener_list:
+                listener(user, release_guid)
+
+    @contextmanager
+    def tracking(self, user:str, guid:str=None):
+        "mark enclosed dsync as in flight, remember local summary after success"
+        self.sync_begin(user, guid)
+        try:
+            yield
+        except BaseException:
+            self.sync_finish(user, guid, None)
+            raise
+        summary = None
+        if echo_collapse() and self.listener_list:  # no dispatcher, no syncer: nothing to collapse
+            try:
+                summary = echo_summary(user)
+            except Exception as error:
+                logger.warn(f"summary failure: {user} :: {error}")
+        self.sync_finish(user, guid, summary)
+
+    def defer(self, user:str, guid:str) -> bool:
+        "hold task behind in-flight dsync of this mailbox or of whole user"
+        with self.tracker_lock:
+            for scope in ((user, guid), (user, None)):
+                if scope in self.inflight_map:
+                    self.defer_map.setdefault(scope, set()).add(guid)
+                    return True
+        return False
+
+    def snapshot(self, user:str, guid:str) -> Optional[Tuple]:
+        "mailbox summary at successful dsync finish within window, None when unknown"
+        time_now = time.monotonic()
+        with self.tracker_lock:
+            for scope in ((user, guid), (user, None)):
+                if scope in self.summary_map and self.scope_echo(scope, time_now):
+                    return self.summary_map[scope].get(guid, None)
+        return None
+
+    def scope_echo(self, scope:EchoScope, time_now:float) -> bool:
+        if scope in self.inflight_map:
+            return True
+        time_finish = self.finish_map.get(scope, None)
+        return time_finish is not None and time_now - time_finish <= echo_window()
+
+    def is_echo(self, user:str, guid:str) -> bool:
+        "event is caused by local dsync of this mailbox or of whole user"
+        time_now = time.monotonic()
+        with self.tracker_lock:
+            return self.scope_echo((user, guid), time_now) or self.scope_echo((user, None), time_now)
+
+    def prune(self) -> None:
+        "forget finished sessions outside of window"
+        time_now = time.monotonic()
+        window = echo_window()
+        with self.tracker_lock:
+            for scope, time_finish in list(self.finish_map.items()):
+                if time_now - time_finish > window:
+                    del self.finish_map[scope]
+                    self.summary_map.pop(scope, None)
+
+
+@functools.lru_cache(maxsize=1)
+def echo_tracker() -> EchoTracker:
+    "process wide tracker shared by replication and syncer"
+    return EchoTracker()
+
+
+def echo_task_collapse(user:str, guid:str) -> bool:
+    "replication task is covered by local dsync: deferred behind it or no newer change"
+    if not echo_collapse():
+        return False
+    tracker = echo_tracker()
+    if tracker.defer(user, guid):
+        return True
+    snapshot = tracker.snapshot(user, guid)
+    if snapshot is None:
+        return False
+    return echo_summary(user).get(guid, None) == snapshot
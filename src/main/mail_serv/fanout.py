@@ -0,0 +1,136 @@
+"""
+Concurrent per-user operations:
+* apply user function across user list with worker pool
+* per-user timeout kills child processes of the user, worker slot stays
+  occupied until user function returns, so concurrency never exceeds pool size
+* failure or timeout of one user does not stop the rest
+* periodic progress log, per-user timing report
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from dataclasses import dataclass
+from typing import List, Callable
+from mail_serv.procname import procname_set
+from mail_serv.timing import timing_session
+from mail_serv.process import process_deadline, process_expired
+
+logger = logging.getLogger(__name__)
+
+
+def fanout_progress_period() -> float:
+    "progress log interval, seconds"
+    return float(os.environ.get('FANOUT_PROGRESS_PERIOD', 15.0))
+
+
+@dataclass
+class UserOutcome:
+    "result of user function for single user"
+
+    user:str
+    status:str  # done/fail/timeout
+    duration:float = 0  # seconds, timeout value for timeout
+    error:str = None
+
+
+class FanoutRun():
+    "single fan-out run state"
+
+    session:str
+    user_func:Callable
+    user_timeout:float
+    user_total:int
+    outcome_list:List[UserOutcome]
+    outcome_lock:threading.Lock
+    time_start:float
+    time_report:float
+
+    def __init__(self, session:str, user_func:Callable, user_timeout:float, user_total:int):
+        self.session = session
+        self.user_func = user_func
+        self.user_timeout = user_timeout
+        self.user_total = user_total
+        self.outcome_list = list()
+        self.outcome_lock = threading.Lock()
+        self.time_start = time.monotonic()
+        self.time_report = self.time_start
+
+    def invoke_user(self, user:str) -> UserOutcome:
+        "run user function in worker thread, child processes are killed at deadline"
+        outcome = UserOutcome(user=user, status='done')
+        time_start = time.perf_counter()
+        with process_deadline(self.user_timeout):
+            try:
+                self.user_func(user)
+            except Exception as error:
+                outcome.status = 'fail'
+                outcome.error = str(error)
+            if process_expired():
+                outcome.status = 'timeout'
+        outcome.duration = time.perf_counter() - time_start
+        return outcome
+
+    def report_outcome(self, outcome:UserOutcome, collector) -> None:
+        if outcome.status == 'done':
+            logger.debug(f"{self.session}: {outcome.user} {outcome.duration:.3f} sec")
+        else:
+            logger.warn(f"{self.session} {outcome.status}: {outcome.user} :: {outcome.error}")
+        with self.outcome_lock:
+            self.outcome_list.append(outcome)
+            collector.record(outcome.user, outcome.status, outcome.duration)
+            time_now = time.monotonic()
+            if time_now - self.time_report >= fanout_progress_period() or \
+                    len(self.outcome_list) == self.user_total:
+                self.time_report = time_now
+                self.report_progress(time_now)
+
+    def report_progress(self, time_now:float) -> None:
+        "invoked under outcome lock"
+        status_list = [outcome.status for outcome in self.outcome_list]
+        logger.info(
+            f"{self.session} progress: "
+            f"user={len(status_list)}/{self.user_total} "
+            f"fail={status_list.count('fail')} "
+            f"timeout={status_list.count('timeout')} "
+            f"time_spent={time_now - self.time_start:.1f}"
+        )
+
+
+def fanout_run(
+        session:str,
+        user_func:Callable,
+        user_list:List[str],
+        worker_count:int,
+        user_timeout:float,
+    ) -> List[UserOutcome]:
+    "apply user function to every user, report outcome per user"
+    worker_count = max(1, min(worker_count, len(user_list)))
+    fanout = FanoutRun(session, user_func, user_timeout, len(user_list))
+    user_queue = queue.Queue()
+    for user in user_list:
+        user_queue.put(user)
+
+    with timing_session(session) as collector:
+
+        def worker_task():
+            procname_set(threading.current_thread().name)
+            while True:
+                try:
+                    user = user_queue.get(block=False)
+                except queue.Empty:
+                    return
+                fanout.report_outcome(fanout.invoke_user(user), collector)
+
+        worker_list = [
+            threading.Thread(name=f'{session}-{index}', daemon=True, target=worker_task)
+            for index in range(worker_count)
+        ]
+        for worker in worker_list:
+            worker.start()
+        for worker in worker_list:
+            worker.join()
+
+    return fanout.outcome_list
@@ -0,0 +1,182 @@
+"""
+Replication freshness tracking:
+* remember last local change per (user, mbox_guid)
+* remember last successful dsync per (user, mbox_guid, destination)
+* report replication lag per user and per destination
+* let keeper skip destinations already synced after last change
+
+scope is '*' for whole user, mailbox guid otherwise;
+user sync covers every mailbox change, guid sync covers only own mailbox;
+sync time is dsync start time, so changes during sync are never counted as covered;
+skip decision relies on syncer recording every event, also when echo collapse drops its replication task
+
+store layout: <freshness_dir>/<domain>/<person>.json
+{ "change": { "*": time, "<guid>": time }, "sync": { "tcp:addr:port": { "*": time, "<guid>": time } } }
+"""
+
+import os
+import time
+import logging
+from typing import Mapping, List, Any
+from mail_serv.user import user_path
+from mail_serv.support import convert_text2bool, fs_lock_file, \
+    fs_persist_json, fs_restore_json
+
+logger = logging.getLogger(__name__)
+
+# user record: "change" -> scope -> time, "sync" -> destination -> scope -> time
+FreshRecord = Mapping[str, Any]
+
+
+def freshness_enable() -> bool:
+    "skip keeper replication of fresh destinations, yes by default"
+    return convert_text2bool(os.environ.get('FRESHNESS_ENABLE', 'true'))
+
+
+def freshness_dir() -> str:
+    "freshness table storage folder"
+    return os.environ.get('FRESHNESS_DIR', '/var/lib/mail_serv/freshness')
+
+
+def freshness_max_age() -> float:
+    "force user sync when last one is older, covers untracked changes, seconds"
+    return float(os.environ.get('FRESHNESS_MAX_AGE', 24 * 3600))
+
+
+def freshness_file(user:str) -> str:
+    "freshness record of single user"
+    return f"{freshness_dir()}/{user_path(user)}.json"
+
+
+def freshness_report_file() -> str:
+    "lag report across all users"
+    return f"{freshness_dir()}/lag-report.json"
+
+
+def freshness_load(user:str) -> FreshRecord:
+    record = fs_restore_json(freshness_file(user), dict())
+    record.setdefault('change', dict())
+    record.setdefault('sync', dict())
+    return record
+
+
+def freshness_update(user:str, update_func) -> None:
+    "read-modify-write user record, shared by syncer and keeper processes"
+    path = freshness_file(user)
+    with fs_lock_file(f"{path}.lock"):
+        record = freshness_load(user)
+        update_func(record)
+        freshness_prune(record, time.time())
+        fs_persist_json(path, record)
+
+
+def freshness_prune(record:FreshRecord, time_now:float) -> None:
+    """
+    drop entries which can not affect decisions:
+    * changes older than max age force sync anyway
+    * guid syncs older than user sync of same destination
+    """
+    time_limit = time_now - freshness_max_age()
+    change_map = record['change']
+    for scope, time_change in list(change_map.items()):
+        if time_change < time_limit:
+            del change_map[scope]
+    for sync_map in record['sync'].values():
+        time_user = sync_map.get('*', 0)
+        for scope, time_sync in list(sync_map.items()):
+            if scope != '*' and time_sync <= time_user:
+                del sync_map[scope]
+
+
+def freshness_record_change(user:str, scope_list:List[str], time_change:float=None) -> None:
+    "remember local change of user mailboxes, scope '*' means any mailbox"
+    time_change = time_change or time.time()
+
+    def update(record:FreshRecord) -> None:
+        change_map = record['change']
+        for scope in scope_list:
+            change_map[scope] = max(change_map.get(scope, 0), time_change)
+
+    freshness_update(user, update)
+
+
+def freshness_record_sync(user:str, destination:str, scope:str, time_sync:float) -> None:
+    "remember successful dsync started at given time"
+
+    def update(record:FreshRecord) -> None:
+        sync_map = record['sync'].setdefault(destination, dict())
+        sync_map[scope] = max(sync_map.get(scope, 0), time_sync)
+
+    freshness_update(user, update)
+
+
+def freshness_pending_list(record:FreshRecord, destination:str) -> List[float]:
+    "change times not covered by successful sync to destination"
+    sync_map = record['sync'].get(destination, dict())
+    time_user = sync_map.get('*', 0)
+    pending_list = list()
+    for scope, time_change in record['change'].items():
+        time_sync = time_user if scope == '*' else max(time_user, sync_map.get(scope, 0))
+        if time_sync < time_change:
+            pending_list.append(time_change)
+    return pending_list
+
+
+def freshness_is_fresh(user:str, destination:str, time_now:float=None) -> bool:
+    "destination has every recorded change of the user and recent user sync"
+    time_now = time_now or time.time()
+    record = freshness_load(user)
+    time_user = record['sync'].get(destination, dict()).get('*', None)
+    if time_user is None or time_now - time_user > freshness_max_age():
+        return False
+    return not freshness_pending_list(record, destination)
+
+
+def freshness_user_lag(user:str, time_now:float=None) -> Mapping[str, float]:
+    "destination -> age of oldest unreplicated change, zero when fresh"
+    time_now = time_now or time.time()
+    record = freshness_load(user)
+    lag_map = dict()
+    for destination in record['sync'].keys():
+        pending_list = freshness_pending_list(record, destination)
+        lag_map[destination] = time_now - min(pending_list) if pending_list else 0
+    return lag_map
+
+
+def freshness_user_iterate() -> List[str]:
+    "users with stored freshness record"
+    user_list = list()
+    base_dir = freshness_dir()
+    if not os.path.isdir(base_dir):
+        return user_list
+    for domain in sorted(os.listdir(base_dir)):
+        domain_dir = f"{base_dir}/{domain}"
+        if not os.path.isdir(domain_dir):
+            continue
+        for entry in sorted(os.listdir(domain_dir)):
+            if entry.endswith('.json'):
+                user_list.append(f"{entry[:-len('.json')]}@{domain}")
+    return user_list
+
+
+def freshness_node_lag(time_now:float=None) -> Mapping[str, Mapping[str, float]]:
+    "destination -> lag summary across all users"
+    time_now = time_now or time.time()
+    node_map = dict()
+    for user in freshness_user_iterate():
+        for destination, lag in freshness_user_lag(user, time_now).items():
+            entry = node_map.setdefault(destination, dict(user_count=0, user_behind=0, lag_max=0))
+            entry['user_count'] += 1
+            if lag > 0:
+                entry['user_behind'] += 1
+                entry['lag_max'] = max(entry['lag_max'], lag)
+    return node_map
+
+
+def freshness_persist_report() -> None:
+    "dump per destination lag summary as json report"
+    try:
+        report = dict(time=time.time(), node=freshness_node_lag())
+        fs_persist_json(freshness_report_file(), report)
+    except Exception as error:
+        logger.warn(f"report failure: {error}")
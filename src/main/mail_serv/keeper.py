@@ -3,41 +3,123 @@ Dovecot maintenance service
 """
 
 import os
+import time
 import logging
+from typing import Mapping, List, Tuple, Callable
 from mail_serv.profiler import profiler_session
 from mail_serv.user import user_list
-from mail_serv.tinker import tinker_node_iterate
+from mail_serv.tinker import tinker_node_iterate, tinker_registry
 from mail_serv.maintain import maintain_user
 from mail_serv.subscribe import subscribe_user
-from mail_serv.replicate import replicate_with_user
+from mail_serv.replicate import replicate_with_user, replicate_with_guid, \
+    replicate_destination, replicate_retry
+from mail_serv.diverge import diverge_enable, diverge_guid_list, diverge_batch_size, \
+    diverge_prefetch, diverge_remote_cache
 from mail_serv.support import report_time, fs_size, fs_strip_eol, fs_mkdir, \
     filesys_session
 from mail_serv.config import config_mail_location, config_mail_layout, config_mail_home
 from mail_serv.sieve import sieve_persist_mbox_list
+from mail_serv.timing import timing_session, timing_measure
+from mail_serv.activity import activity_collect
+from mail_serv.checkpoint import checkpoint_begin, RunCheckpoint
+from mail_serv.freshness import freshness_enable, freshness_is_fresh, \
+    freshness_persist_report
+from mail_serv.metrics import metrics_count, metrics_persist
+from mail_serv.dsyncstat import dsyncstat_persist_report
+from mail_serv.priority import priority_restore, priority_persist, \
+    priority_absorb_activity, priority_user_order, UserPriority
 
 logger = logging.getLogger(__name__)
 
 
 def keeper_service() -> None:
     logger.info(f"startup")
-    with profiler_session('keeper-service'):
+    with profiler_session('keeper-service'), timing_session('keeper-service'):
         keeper_process_all()
 
 
+def keeper_time_budget() -> float:
+    "wall clock limit of keeper run in seconds, zero means no limit"
+    return float(os.environ.get('KEEPER_TIME_BUDGET', 0))
+
+
 def keeper_process_all() -> None:
+    "keep users in priority order within time budget, resume unfinished run"
     logger.debug(f"keep all users")
-    for user_name in user_list():
-        keeper_process_user(user_name)
+    checkpoint = checkpoint_begin('keeper-service')
+    priority_map = priority_restore()
+    priority_absorb_activity(priority_map, activity_collect())
+    user_order = priority_user_order(user_list(), priority_map)
+    user_done_set = checkpoint.user_done_set
+    user_order = [user_name for user_name in user_order if user_name not in user_done_set]
+    time_budget = keeper_time_budget()
+    time_start = time.monotonic()
+    try:
+        for user_index, user_name in enumerate(user_order):
+            time_spent = time.monotonic() - time_start
+            if time_budget and time_spent >= time_budget:
+                user_rest = len(user_order) - user_index
+                logger.info(f"budget exhausted: time_budget={time_budget} user_rest={user_rest}")
+                return  # keep checkpoint unfinished
+            if user_index % diverge_batch_size() == 0:
+                keeper_prefetch_diverge(user_order[user_index:user_index + diverge_batch_size()])
+            keeper_process_entry(user_name, priority_map, checkpoint)
+        checkpoint.record_finish()
+    finally:
+        priority_persist(priority_map)
+        freshness_persist_report()
+        metrics_persist('keeper-service')
+        dsyncstat_persist_report('keeper-service')
+
+
+def keeper_process_entry(
+        user_name:str,
+        priority_map:Mapping[str, UserPriority],
+        checkpoint:RunCheckpoint=None,
+    ) -> bool:
+    "keep single user, record outcome in priority state and run checkpoint"
+    try:
+        step_map = keeper_process_user(user_name)
+    except Exception as error:
+        logger.warn(f"failure: {user_name} :: {error}")
+        step_map = dict()
+    success = bool(step_map) and all(status == 'done' for status in step_map.values())
+    entry = priority_map.setdefault(user_name, UserPriority())
+    if success:
+        entry.report_success(time.time())
+    else:
+        entry.report_failure(time.time())
+    if checkpoint:
+        checkpoint.record_user(user_name, step_map)
+    return success
+
+
+def keeper_step_list() -> List[Tuple[str, Callable]]:
+    "keeper steps in order of execution"
+    return [
+        ('maintain', maintain_user),
+        ('subscribe', subscribe_user),
+        ('repair_layout', keeper_repair_layout),
+        ('replicate', keeper_replicate_node),
+        ('home_size', keeper_report_home_size),
+    ]
 
 
 @report_time
-def keeper_process_user(user_name:str) -> None:
+def keeper_process_user(user_name:str) -> Mapping[str, str]:
+    "perform keeper steps, report per-step status: done/fail"
     logger.debug(f"keep single user: {user_name}")
-    maintain_user(user_name)
-    subscribe_user(user_name)
-    keeper_repair_layout(user_name)
-    keeper_replicate_node(user_name)
-    keeper_report_home_size(user_name)
+    step_map = dict()
+    with timing_measure(user_name, 'total'):
+        for step_name, step_func in keeper_step_list():
+            try:
+                with timing_measure(user_name, step_name):
+                    step_func(user_name)
+                step_map[step_name] = 'done'
+            except Exception as error:
+                logger.warn(f"failure: {user_name} {step_name} :: {error}")
+                step_map[step_name] = 'fail'
+    return step_map
 
 
 @report_time
@@ -93,15 +175,56 @@ def keeper_repair_maildir(user_name:str, maildir_name:str) -> None:
 
 @report_time
 def keeper_replicate_node(user_name:str) -> None:
-    "sync single user"
+    "sync single user, skip fresh nodes, fail when any node fails"
+
+    fail_count = 0
 
     @report_time
     def keeper_replicate(node_addr, node_port):
+        nonlocal fail_count
         func_info = f"{user_name} {node_addr}:{node_port}"
         try:
+            destination = replicate_destination(node_addr, node_port)
+            if freshness_enable() and freshness_is_fresh(user_name, destination):
+                logger.debug(f"fresh skip: {func_info}")
+                metrics_count('keeper_fresh_skip')
+                return
             logger.debug(func_info)
-            replicate_with_user(user_name, node_addr, node_port)
+            with timing_measure(user_name, f"replicate {node_addr}"):
+                keeper_replicate_diverge(user_name, node_addr, node_port)
         except Exception as error:
+            fail_count += 1
             logger.warn(f"failure: {func_info} :: {error}")
 
-    tinker_node_iterate(keeper_replicate)
+    tinker_node_iterate(keeper_replicate, user_name)  # replica peers only
+
+    if fail_count:
+        raise RuntimeError(f"replicate failure: fail_count={fail_count}")
+
+
+def keeper_prefetch_diverge(user_list:List[str]) -> None:
+    "fetch peer summaries of upcoming users, single request per peer"
+    if not diverge_enable():
+        return
+    diverge_remote_cache().clear()
+    registry = tinker_registry()
+    addr_user_map = dict()
+    for user_name in user_list:
+        for entry in registry.user_snapshot(user_name):
+            destination = replicate_destination(entry.addr, entry.port)
+            if freshness_enable() and freshness_is_fresh(user_name, destination):
+                continue  # no dsync, no summary needed
+            addr_user_map.setdefault(entry.addr, list()).append(user_name)
+    for node_addr, addr_user_list in addr_user_map.items():
+        diverge_prefetch(node_addr, addr_user_list)
+
+
+def keeper_replicate_diverge(user_name:str, node_addr:str, node_port:str) -> None:
+    "sync only differing mailboxes when summary check is possible"
+    if diverge_enable():
+        guid_list = diverge_guid_list(user_name, node_addr)
+        if guid_list is not None:
+            for guid in guid_list:
+                replicate_retry(replicate_with_guid, user_name, guid, node_addr, node_port)
+            return
+    replicate_retry(replicate_with_user, user_name, node_addr, node_port)
@@ -6,15 +6,23 @@ via configuration stored as magic sieve file
 * https://wiki2.dovecot.org/Tools/Doveadm/Flags
 * https://wiki2.dovecot.org/Tools/Doveadm/Expunge
 * https://wiki2.dovecot.org/Tools/Doveadm/Deduplicate
+
+parsed configuration is cached per user, keyed by fingerprint of
+stored sieve file: users without configuration cost single stat per cycle
 """
 
+import os
 import re
 import shlex
 import logging
-from typing import List, Callable
+import threading
+from dataclasses import dataclass
+from typing import List, Mapping, Set, Tuple, Optional, Callable
 from mail_serv.command import doveadm
 from mail_serv.user import user_list
-from mail_serv.support import report_time
+from mail_serv.config import config_sieve_path
+from mail_serv.support import report_time, convert_text2bool
+from mail_serv.freshness import freshness_record_change
 
 logger = logging.getLogger(__name__)
 
@@ -36,17 +44,94 @@ maintain_regex_map = dict([
 ])
 
 
+def maintain_cache_enable() -> bool:
+    "detect configuration via stored sieve file fingerprint, yes by default"
+    return convert_text2bool(os.environ.get('MAINTAIN_CACHE_ENABLE', 'true'))
+
+
+def maintain_conf_name() -> str:
+    "user sieve config entry name"
+    return os.environ.get('MAINTAIN_CONF_NAME', "A_R_K_O_N.maintain")
+
+
+@dataclass(frozen=True)
+class MaintainRule:
+    "single configuration entry"
+
+    action:str  # doveadm verb and opts
+    search:str  # doveadm search query
+
+
+# stored file fingerprint: (mtime_ns, size)
+MaintainPrint = Tuple[int, int]
+
+
+class MaintainCache():
+    "parsed configuration per user, valid while fingerprint is unchanged"
+
+    entry_map:Mapping[str, Tuple[MaintainPrint, List[MaintainRule]]]
+    entry_lock:threading.Lock
+
+    def __init__(self):
+        self.entry_map = dict()
+        self.entry_lock = threading.Lock()
+
+    def lookup(self, user_name:str, fingerprint:MaintainPrint) -> Optional[List[MaintainRule]]:
+        with self.entry_lock:
+            entry = self.entry_map.get(user_name, None)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+        return None
+
+    def update(self, user_name:str, fingerprint:MaintainPrint, rule_list:List[MaintainRule]) -> None:
+        with self.entry_lock:
+            self.entry_map[user_name] = (fingerprint, rule_list)
+
+    def discard(self, user_name:str) -> None:
+        with self.entry_lock:
+            self.entry_map.pop(user_name, None)
+
+
+maintain_cache = MaintainCache()
+
+
+def maintain_conf_file(user_name:str) -> str:
+    "stored sieve file of configuration entry"
+    return f"{config_sieve_path(user_name)}/{maintain_conf_name()}.sieve"
+
+
+def maintain_fingerprint(conf_file:str) -> Optional[MaintainPrint]:
+    "stored file change marker, None when missing"
+    try:
+        stat = os.stat(conf_file)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def maintain_user_list(user_list:List[str]) -> List[str]:
+    "users which have configuration entry, without invoking doveadm"
+    return [
+        user_name for user_name in user_list
+        if maintain_fingerprint(maintain_conf_file(user_name)) is not None
+    ]
+
+
 def maintain_all() -> None:
-    for user in user_list():
+    entry_list = user_list()
+    if maintain_cache_enable():
+        entry_list = maintain_user_list(entry_list)
+    for user in entry_list:
         maintain_user(user)
 
 
 def maintain_conf_list(
         user_name:str,
         # user sieve config entry name
-        conf_name:str="A_R_K_O_N.maintain",
+        conf_name:str=None,
     ) -> List[str]:
     "load configuration from magic sieve user_name entry"
+    conf_name = conf_name or maintain_conf_name()
     conf_list = list()
     try:
         conf_text = doveadm('sieve' , 'get', '-u', user_name, conf_name)
@@ -62,22 +147,224 @@ def maintain_apply(user_name:str, action:str, search:str) -> None:
     try:
         logger.debug(f"command: {command}")
         doveadm(*command)
+        freshness_record_change(user_name, ['*'])  # before syncer event arrives
     except Exception as error:
         logger.warn(f"failure: {command} :: {error}")
 
 
+def maintain_parse(entry_list:List[str]) -> List[MaintainRule]:
+    "extract supported entries in configuration order"
+    rule_list = list()
+    for entry in entry_list:
+        for action, matcher in maintain_regex_map.items() :
+            match = matcher.match(entry)
+            if match:
+                rule_list.append(MaintainRule(action, match.group(1)))
+    return rule_list
+
+
+def maintain_rule_list(user_name:str) -> List[MaintainRule]:
+    "parsed user configuration, re-read only after stored file change"
+    if not maintain_cache_enable():
+        return maintain_parse(maintain_conf_list(user_name))
+    try:
+        conf_file = maintain_conf_file(user_name)
+    except Exception as error:
+        logger.warn(f"conf file failure: {user_name} :: {error}")
+        return maintain_parse(maintain_conf_list(user_name))
+    fingerprint = maintain_fingerprint(conf_file)
+    if fingerprint is None:
+        maintain_cache.discard(user_name)
+        return []
+    rule_list = maintain_cache.lookup(user_name, fingerprint)
+    if rule_list is None:
+        with open(conf_file, "r") as conf_text:  # same content as 'doveadm sieve get'
+            rule_list = maintain_parse(conf_text.read().splitlines())
+        maintain_cache.update(user_name, fingerprint, rule_list)
+    return rule_list
+
+
+def maintain_plan_enable() -> bool:
+    "merge and parallelize configuration entries, yes by default"
+    return convert_text2bool(os.environ.get('MAINTAIN_PLAN_ENABLE', 'true'))
+
+
+def maintain_merge_limit() -> int:
+    "entries combined into single search query"
+    return int(os.environ.get('MAINTAIN_MERGE_LIMIT', 20))
+
+
+def maintain_worker_count() -> int:
+    "concurrent independent steps per user, 1 means serial"
+    return int(os.environ.get('MAINTAIN_WORKER_COUNT', 4))
+
+
+# actions where consecutive runs equal single run over union of searches:
+# expunge leaves other messages intact, flag change is idempotent
+maintain_merge_action_set = set(['expunge', 'flags add', 'flags remove'])
+
+# actions with target argument before search query: flags or destination
+maintain_target_action_set = set(['flags add', 'flags remove', 'move'])
+
+
+@dataclass
+class MaintainStep:
+    "single doveadm invocation, covers one or more configuration entries"
+
+    action:str
+    target:Optional[str]  # flags or destination, None for search-only actions
+    query_list:List[List[str]]  # search query terms per entry
+    mbox_set:Optional[Set[str]]  # touched mailboxes, None means unknown
+    mbox_key:Optional[str]  # single mailbox shared by every entry, None means unknown
+
+    def search(self) -> str:
+        "target and search query, merged: mailbox X OR ( q1 ) OR ( q2 ) ( q3 )"
+        if len(self.query_list) == 1:
+            term_list = self.query_list[0]
+        else:
+            query_list = [maintain_query_strip(query) or ['ALL'] for query in self.query_list]
+            term_list = query_list[-1]
+            for query in reversed(query_list[:-1]):
+                term_list = ['OR', '('] + query + [')', '('] + term_list + [')']
+            term_list = ['mailbox', self.mbox_key] + term_list
+        if self.target is not None:
+            term_list = [self.target] + term_list
+        return shlex.join(term_list)
+
+    def commute(self, other:'MaintainStep') -> bool:
+        "execution order does not matter for steps on disjoint known mailboxes"
+        if self.mbox_set is None or other.mbox_set is None:
+            return False
+        return self.mbox_set.isdisjoint(other.mbox_set)
+
+
+def maintain_mbox_name(mbox:str) -> str:
+    "mailbox name for comparison, INBOX is case-insensitive"
+    return 'INBOX' if mbox.upper() == 'INBOX' else mbox
+
+
+def maintain_query_mbox_set(query:List[str]) -> Optional[Set[str]]:
+    "mailboxes selected by search query, None when not limited to named mailboxes"
+    mbox_set = set()
+    for index, term in enumerate(query):
+        term_upper = term.upper()
+        if term_upper in ('OR', 'NOT', 'MAILBOX-GUID'):
+            return None
+        if term_upper == 'MAILBOX':
+            if index + 1 >= len(query):
+                return None
+            mbox = query[index + 1]
+            if '*' in mbox or '%' in mbox:
+                return None
+            mbox_set.add(maintain_mbox_name(mbox))
+    return mbox_set or None
+
+
+def maintain_query_strip(query:List[str]) -> List[str]:
+    "search query without mailbox terms, for query with hoisted mailbox"
+    term_list = list()
+    index = 0
+    while index < len(query):
+        if query[index].upper() == 'MAILBOX':
+            index += 2
+        else:
+            term_list.append(query[index])
+            index += 1
+    return term_list
+
+
+def maintain_step(rule:MaintainRule) -> MaintainStep:
+    "invocation of single configuration entry"
+    term_list = shlex.split(rule.search.strip())
+    target = None
+    if rule.action in maintain_target_action_set and term_list:
+        target = term_list[0]
+        term_list = term_list[1:]
+    mbox_set = maintain_query_mbox_set(term_list)
+    mbox_key = list(mbox_set)[0] if mbox_set is not None and len(mbox_set) == 1 else None
+    if rule.action == 'move' and mbox_set is not None:
+        mbox_set = mbox_set | set([maintain_mbox_name(target)])
+    return MaintainStep(rule.action, target, [term_list], mbox_set, mbox_key)
+
+
+def maintain_plan(rule_list:List[MaintainRule]) -> List[List[MaintainStep]]:
+    """
+    produce execution stages, steps inside stage are independent:
+    * entry merges into earlier step of same action, target and single mailbox,
+      when it commutes with every step in between
+    * entries on different mailboxes stay separate steps, which run concurrently
+    * step runs in stage after every earlier step it does not commute with
+    """
+    step_list = list()
+    merge_limit = maintain_merge_limit()
+    for rule in rule_list:
+        step = maintain_step(rule)
+        if step.action in maintain_merge_action_set and step.mbox_key is not None:
+            for index in reversed(range(len(step_list))):
+                past = step_list[index]
+                if past.action == step.action and past.target == step.target and \
+                        past.mbox_key == step.mbox_key and len(past.query_list) < merge_limit:
+                    past.query_list.append(step.query_list[0])
+                    step = None
+                    break
+                if not step.commute(past):
+                    break
+        if step is not None:
+            step_list.append(step)
+    stage_list = list()
+    level_list = list()
+    for index, step in enumerate(step_list):
+        level = 1 + max([
+            level_list[past] for past in range(index)
+            if not step.commute(step_list[past])
+        ], default=-1)
+        level_list.append(level)
+        if level == len(stage_list):
+            stage_list.append(list())
+        stage_list[level].append(step)
+    return stage_list
+
+
+def maintain_execute(user_name:str, stage_list:List[List[MaintainStep]], apply_func:Callable) -> None:
+    "run stages in order, independent steps of stage concurrently"
+    worker_count = maintain_worker_count()
+    for stage in stage_list:
+        if worker_count <= 1 or len(stage) == 1:
+            for step in stage:
+                apply_func(user_name, step.action, step.search())
+            continue
+        step_queue = list(stage)
+        queue_lock = threading.Lock()
+
+        def worker_task():
+            while True:
+                with queue_lock:
+                    if not step_queue:
+                        return
+                    step = step_queue.pop(0)
+                apply_func(user_name, step.action, step.search())
+
+        worker_list = [
+            threading.Thread(name=f'maintain-{index}', daemon=True, target=worker_task)
+            for index in range(min(worker_count, len(stage)))
+        ]
+        for worker in worker_list:
+            worker.start()
+        for worker in worker_list:
+            worker.join()
+
+
 @report_time
 def maintain_user(user_name:str, apply_func:Callable=maintain_apply) -> None:
     "update user mailbox based on sieve search entry"
 
-    entry_list = maintain_conf_list(user_name)
+    rule_list = maintain_rule_list(user_name)
 
-    for entry in entry_list:
-        for action, matcher in maintain_regex_map.items() :
-            match = matcher.match(entry)
-            if match:
-                search = match.group(1)
-                apply_func(user_name, action, search)
+    if maintain_plan_enable():
+        maintain_execute(user_name, maintain_plan(rule_list), apply_func)
+    else:
+        for rule in rule_list:
+            apply_func(user_name, rule.action, rule.search)
 
 
 def maintain_command(user_name:str, action:str, search:str) -> List[str]:
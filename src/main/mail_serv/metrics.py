@@ -0,0 +1,148 @@
+"""
+Service metrics:
+* named counters with optional labels
+* running total and rolling window sum per counter
+* dump as json report or prometheus text
+"""
+
+import os
+import time
+import logging
+import threading
+import functools
+from typing import Mapping, Tuple, Any
+from mail_serv.support import fs_persist_json
+
+logger = logging.getLogger(__name__)
+
+# counter identity: (name, ((label, value), ...))
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def metrics_report_dir() -> str:
+    "metrics report output folder"
+    return os.environ.get('METRICS_REPORT_DIR', '/var/lib/mail_serv/metrics')
+
+
+def metrics_report_file(session:str) -> str:
+    "metrics json report of a service"
+    return f"{metrics_report_dir()}/{session}.json"
+
+
+def metrics_window() -> float:
+    "rolling window length, seconds"
+    return float(os.environ.get('METRICS_WINDOW', 900))
+
+
+def metrics_bucket() -> float:
+    "rolling window resolution, seconds"
+    return float(os.environ.get('METRICS_BUCKET', 60))
+
+
+def metrics_key(name:str, label_dict:Mapping[str, Any]) -> MetricKey:
+    "counter identity with sorted labels"
+    return (name, tuple(sorted((label, str(entry)) for label, entry in label_dict.items())))
+
+
+def metrics_render_key(key:MetricKey) -> str:
+    'prometheus style name{label="value"}'
+    name, label_tuple = key
+    if not label_tuple:
+        return name
+    label_text = ",".join([f'{label}="{value}"' for label, value in label_tuple])
+    return f"{name}{{{label_text}}}"
+
+
+class MetricCounter():
+    "running total with bucketed rolling window"
+
+    total:float
+    bucket_map:Mapping[int, float]  # bucket index -> sum
+
+    def __init__(self):
+        self.total = 0
+        self.bucket_map = dict()
+
+    def add(self, value:float, time_now:float) -> None:
+        self.total += value
+        bucket = int(time_now // metrics_bucket())
+        self.bucket_map[bucket] = self.bucket_map.get(bucket, 0) + value
+        self.prune(time_now)
+
+    def prune(self, time_now:float) -> None:
+        bucket_first = int((time_now - metrics_window()) // metrics_bucket())
+        for bucket in list(self.bucket_map.keys()):
+            if bucket < bucket_first:
+                del self.bucket_map[bucket]
+
+    def window_sum(self, time_now:float) -> float:
+        self.prune(time_now)
+        return sum(self.bucket_map.values())
+
+
+class MetricRegistry():
+    "thread safe counter collection"
+
+    counter_map:Mapping[MetricKey, MetricCounter]
+    registry_lock:threading.Lock
+
+    def __init__(self):
+        self.counter_map = dict()
+        self.registry_lock = threading.Lock()
+
+    def count(self, name:str, value:float=1, **label_dict) -> None:
+        "add value to counter identified by name and labels"
+        key = metrics_key(name, label_dict)
+        time_now = time.time()
+        with self.registry_lock:
+            counter = self.counter_map.get(key, None)
+            if counter is None:
+                counter = self.counter_map[key] = MetricCounter()
+            counter.add(value, time_now)
+
+    def total(self, name:str, **label_dict) -> float:
+        "running total of single counter"
+        key = metrics_key(name, label_dict)
+        with self.registry_lock:
+            counter = self.counter_map.get(key, None)
+            return counter.total if counter else 0
+
+    def snapshot(self) -> Mapping[str, Mapping[str, float]]:
+        "rendered key -> total and window sum"
+        time_now = time.time()
+        with self.registry_lock:
+            return dict([
+                (metrics_render_key(key), dict(total=counter.total, window=counter.window_sum(time_now)))
+                for key, counter in self.counter_map.items()
+            ])
+
+    def render_text(self) -> str:
+        "prometheus text exposition of totals"
+        line_list = [
+            f"{key} {entry['total']}" for key, entry in sorted(self.snapshot().items())
+        ]
+        return "\n".join(line_list) + "\n"
+
+
+@functools.lru_cache(maxsize=1)
+def metrics_instance() -> MetricRegistry:
+    "process wide metrics"
+    return MetricRegistry()
+
+
+def metrics_count(name:str, value:float=1, **label_dict) -> None:
+    "add value to process wide counter"
+    metrics_instance().count(name, value, **label_dict)
+
+
+def metrics_persist(session:str) -> None:
+    "dump process wide metrics as json report"
+    report = dict(
+        time=time.time(),
+        window=metrics_window(),
+        metric=metrics_instance().snapshot(),
+    )
+    try:
+        fs_persist_json(metrics_report_file(session), report)
+    except Exception as error:
+        logger.warn(f"report failure: {error}")
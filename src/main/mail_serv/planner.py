@@ -0,0 +1,85 @@
+"""
+Replication planner:
+* a folder tree move or rename produces hundreds of mailbox guid events
+* one dsync per guid per node does not scale for such a storm
+* escalate user with too many guids in a batch or in a sliding window
+  into single user-level replication per node
+"""
+
+import os
+import time
+import logging
+import threading
+import functools
+from collections import deque
+from typing import Mapping, List, Set, Tuple, Deque
+from mail_serv.metrics import metrics_count
+
+logger = logging.getLogger(__name__)
+
+
+def planner_guid_limit() -> int:
+    "distinct guids per user above which replication escalates to user sync"
+    return int(os.environ.get('PLANNER_GUID_LIMIT', 20))
+
+
+def planner_window() -> float:
+    "sliding window for guid counting, seconds"
+    return float(os.environ.get('PLANNER_WINDOW', 60))
+
+
+class ReplicatePlanner():
+    "turn per-user guid sets into replication tasks"
+
+    history_map:Mapping[str, Deque[Tuple[float, str]]]  # user -> (time, guid)
+    planner_lock:threading.Lock
+
+    def __init__(self):
+        self.history_map = dict()
+        self.planner_lock = threading.Lock()
+
+    def window_guid_set(self, user:str, guid_set:Set[str], time_now:float) -> Set[str]:
+        "remember batch guids, report distinct guids within window"
+        time_first = time_now - planner_window()
+        history = self.history_map.setdefault(user, deque())
+        for guid in guid_set:
+            history.append((time_now, guid))
+        while history and history[0][0] < time_first:
+            history.popleft()
+        return set(guid for _, guid in history)
+
+    def prune(self, time_now:float) -> None:
+        time_first = time_now - planner_window()
+        for user, history in list(self.history_map.items()):
+            if not history or history[-1][0] < time_first:
+                del self.history_map[user]
+
+    def plan(
+            self,
+            replicate_task_map:Mapping[str, Set[str]],
+            time_now:float=None,
+        ) -> List[Tuple[str, str]]:
+        "produce (user, guid) tasks, guid None means user-level sync"
+        if time_now is None:
+            time_now = time.time()
+        guid_limit = planner_guid_limit()
+        task_list = list()
+        with self.planner_lock:
+            for user, guid_set in replicate_task_map.items():
+                window_set = self.window_guid_set(user, guid_set, time_now)
+                if len(guid_set) > guid_limit or len(window_set) > guid_limit:
+                    logger.info(f"escalate: {user} batch_guid={len(guid_set)} window_guid={len(window_set)}")
+                    metrics_count('planner_escalate')
+                    metrics_count('planner_guid_collapse', len(guid_set))
+                    task_list.append((user, None))
+                else:
+                    metrics_count('planner_guid_task', len(guid_set))
+                    task_list.extend([(user, guid) for guid in sorted(guid_set)])
+            self.prune(time_now)
+        return task_list
+
+
+@functools.lru_cache(maxsize=1)
+def planner_instance() -> ReplicatePlanner:
+    "process wide planner, keeps sliding window"
+    return ReplicatePlanner()
@@ -0,0 +1,158 @@
+"""
+Keeper work priority scheduling:
+* order users by priority score
+* score combines recent activity, keep staleness, last failure
+* users left over by exhausted time budget keep aging and move up
+"""
+
+import os
+import math
+import time
+import logging
+from dataclasses import dataclass, asdict
+from typing import Mapping, List, Tuple
+from mail_serv.support import fs_persist_json, fs_restore_json
+
+logger = logging.getLogger(__name__)
+
+
+def priority_state_dir() -> str:
+    "keeper state storage folder"
+    return os.environ.get('PRIORITY_STATE_DIR', '/var/lib/mail_serv/keeper')
+
+
+def priority_state_file() -> str:
+    "persisted per-user priority state"
+    return f"{priority_state_dir()}/priority.json"
+
+
+def priority_keep_period() -> float:
+    "expected interval between keeper runs, seconds"
+    return float(os.environ.get('PRIORITY_KEEP_PERIOD', 6 * 3600))
+
+
+def priority_activity_halflife() -> float:
+    "activity score decay half life, seconds"
+    return float(os.environ.get('PRIORITY_ACTIVITY_HALFLIFE', 6 * 3600))
+
+
+def priority_weight_activity() -> float:
+    "score weight of recent mailbox activity"
+    return float(os.environ.get('PRIORITY_WEIGHT_ACTIVITY', 1.0))
+
+
+def priority_weight_staleness() -> float:
+    "score weight of time since user was last kept"
+    return float(os.environ.get('PRIORITY_WEIGHT_STALENESS', 1.0))
+
+
+def priority_weight_failure() -> float:
+    "score weight of failure during last keep"
+    return float(os.environ.get('PRIORITY_WEIGHT_FAILURE', 2.0))
+
+
+def priority_stale_limit() -> float:
+    "staleness cap in keep periods, applies to never kept users"
+    return float(os.environ.get('PRIORITY_STALE_LIMIT', 8.0))
+
+
+@dataclass
+class UserPriority:
+    "per-user keeper scheduling state"
+
+    time_kept:float = 0  # last successful keep, epoch
+    time_fail:float = 0  # last failed keep, epoch
+    fail_count:int = 0  # consecutive keep failures
+    activity:float = 0  # decayed mailbox event count
+    time_activity:float = 0  # activity decay reference, epoch
+
+    def decay_activity(self, time_now:float) -> None:
+        "move activity reference to present time"
+        if self.time_activity and time_now > self.time_activity:
+            time_diff = time_now - self.time_activity
+            self.activity *= math.pow(0.5, time_diff / priority_activity_halflife())
+        self.time_activity = time_now
+
+    def absorb_activity(self, event_time:float, event_count:int, time_now:float) -> None:
+        "fold activity log entry into decayed activity"
+        self.decay_activity(time_now)
+        event_age = max(0, time_now - event_time)
+        self.activity += event_count * math.pow(0.5, event_age / priority_activity_halflife())
+
+    def report_success(self, time_now:float) -> None:
+        self.time_kept = time_now
+        self.fail_count = 0
+
+    def report_failure(self, time_now:float) -> None:
+        self.time_fail = time_now
+        self.fail_count += 1
+
+    def score(self, time_now:float) -> float:
+        "higher score means earlier keep"
+        stale_limit = priority_stale_limit()
+        if self.time_kept:
+            staleness = (time_now - self.time_kept) / priority_keep_period()
+            staleness = min(max(0, staleness), stale_limit)
+        else:
+            staleness = stale_limit
+        self.decay_activity(time_now)
+        activity = math.log1p(self.activity)  # compress bursts
+        failure = 1.0 / self.fail_count if self.fail_count else 0  # retry, but do not hog
+        return (
+            priority_weight_staleness() * staleness +
+            priority_weight_activity() * activity +
+            priority_weight_failure() * failure
+        )
+
+
+def priority_restore() -> Mapping[str, UserPriority]:
+    "load per-user priority state"
+    state_dict = fs_restore_json(priority_state_file(), dict())
+    priority_map = dict()
+    for user_name, entry in state_dict.items():
+        try:
+            priority_map[user_name] = UserPriority(**entry)
+        except Exception as error:
+            logger.warn(f"wrong state: {user_name} :: {error}")
+    return priority_map
+
+
+def priority_persist(priority_map:Mapping[str, UserPriority]) -> None:
+    "save per-user priority state"
+    state_dict = dict([
+        (user_name, asdict(entry)) for user_name, entry in priority_map.items()
+    ])
+    fs_persist_json(priority_state_file(), state_dict)
+
+
+def priority_absorb_activity(
+        priority_map:Mapping[str, UserPriority],
+        activity_map:Mapping[str, List[Tuple[float, int]]],
+        time_now:float=None,
+    ) -> None:
+    "fold collected activity log into priority state"
+    if time_now is None:
+        time_now = time.time()
+    for user_name, entry_list in activity_map.items():
+        entry = priority_map.setdefault(user_name, UserPriority())
+        for event_time, event_count in entry_list:
+            entry.absorb_activity(event_time, event_count, time_now)
+
+
+def priority_user_order(
+        user_list:List[str],
+        priority_map:Mapping[str, UserPriority],
+        time_now:float=None,
+    ) -> List[str]:
+    "order users by descending priority score, drop state of removed users"
+    if time_now is None:
+        time_now = time.time()
+    user_set = set(user_list)
+    for user_name in list(priority_map.keys()):
+        if user_name not in user_set:
+            del priority_map[user_name]
+    score_map = dict()
+    for user_name in user_list:
+        entry = priority_map.setdefault(user_name, UserPriority())
+        score_map[user_name] = entry.score(time_now)
+    return sorted(user_list, key=lambda user_name: -score_map[user_name])
@@ -0,0 +1,190 @@
+"""
+Replication peer liveness probing:
+* probe all peers concurrently with non-blocking tcp connect
+* cache health with timestamps, track connect round trip time
+* per-node circuit breaker with exponential backoff
+"""
+
+import os
+import time
+import errno
+import socket
+import logging
+import selectors
+import threading
+import functools
+from dataclasses import dataclass
+from typing import Mapping, List, Tuple
+
+from mail_serv.support import convert_text2bool
+
+logger = logging.getLogger(__name__)
+
+# probe target: (addr, port)
+ProbeTarget = Tuple[str, int]
+
+
+def prober_enable() -> bool:
+    "enable liveness checks before replication, yes by default"
+    return convert_text2bool(os.environ.get('PROBER_ENABLE', 'true'))
+
+
+def prober_timeout() -> float:
+    "connect timeout for single probe round, seconds"
+    return float(os.environ.get('PROBER_TIMEOUT', 3.0))
+
+
+def prober_cache_time() -> float:
+    "reuse probe result for this long, seconds"
+    return float(os.environ.get('PROBER_CACHE_TIME', 10.0))
+
+
+def prober_failure_limit() -> int:
+    "consecutive probe failures which open node circuit"
+    return int(os.environ.get('PROBER_FAILURE_LIMIT', 2))
+
+
+def prober_backoff_base() -> float:
+    "initial open circuit duration, seconds"
+    return float(os.environ.get('PROBER_BACKOFF_BASE', 5.0))
+
+
+def prober_backoff_limit() -> float:
+    "maximum open circuit duration, seconds"
+    return float(os.environ.get('PROBER_BACKOFF_LIMIT', 300.0))
+
+
+@dataclass
+class NodeHealth:
+    "liveness state of single peer"
+
+    addr:str
+    port:int
+    alive:bool = False  # last probe outcome
+    rtt:float = None  # last connect round trip, seconds
+    time_probe:float = 0  # last probe, monotonic
+    fail_count:int = 0  # consecutive probe failures
+    time_retry:float = 0  # open circuit end, monotonic
+
+    def circuit_state(self, time_now:float) -> str:
+        "closed: use node, open: skip node, half-open: probe node once more"
+        if self.fail_count < prober_failure_limit():
+            return 'closed'
+        if time_now < self.time_retry:
+            return 'open'
+        return 'half-open'
+
+    def needs_probe(self, time_now:float) -> bool:
+        state = self.circuit_state(time_now)
+        if state == 'open':
+            return False
+        if state == 'half-open':
+            return True
+        return time_now - self.time_probe >= prober_cache_time()
+
+    def report_probe(self, rtt:float, time_now:float) -> None:
+        "apply probe outcome, rtt is None on failure"
+        self.time_probe = time_now
+        self.rtt = rtt
+        if rtt is None:
+            self.alive = False
+            self.fail_count += 1
+            failure_limit = prober_failure_limit()
+            if self.fail_count >= failure_limit:
+                backoff = prober_backoff_base() * 2 ** (self.fail_count - failure_limit)
+                self.time_retry = time_now + min(backoff, prober_backoff_limit())
+        else:
+            self.alive = True
+            self.fail_count = 0
+            self.time_retry = 0
+
+    def is_available(self, time_now:float) -> bool:
+        return self.alive and self.circuit_state(time_now) != 'open'
+
+
+def prober_connect_all(
+        target_list:List[ProbeTarget],
+        timeout:float,
+    ) -> Mapping[ProbeTarget, float]:
+    "concurrent tcp connect, report round trip per target, None on failure"
+    result_map = dict([(target, None) for target in target_list])
+    selector = selectors.DefaultSelector()
+    time_start = time.perf_counter()
+    try:
+        for target in target_list:
+            addr, port = target
+            try:
+                family, kind, proto, _, sock_addr = socket.getaddrinfo(
+                    addr, port, type=socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, kind, proto)
+                sock.setblocking(False)
+                code = sock.connect_ex(sock_addr)
+                if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    selector.register(sock, selectors.EVENT_WRITE, target)
+                else:
+                    sock.close()
+            except Exception as error:
+                logger.debug(f"probe failure: {addr}:{port} :: {error}")
+        while selector.get_map():
+            time_left = timeout - (time.perf_counter() - time_start)
+            if time_left <= 0:
+                break
+            for key, _ in selector.select(time_left):
+                sock = key.fileobj
+                selector.unregister(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    result_map[key.data] = time.perf_counter() - time_start
+                sock.close()
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    return result_map
+
+
+class NodeProber():
+    "cached concurrent liveness prober with per-node circuit breaker"
+
+    health_map:Mapping[ProbeTarget, NodeHealth]
+    prober_lock:threading.Lock
+
+    def __init__(self):
+        self.health_map = dict()
+        self.prober_lock = threading.Lock()
+
+    def node_health(self, target:ProbeTarget) -> NodeHealth:
+        with self.prober_lock:
+            if target not in self.health_map:
+                self.health_map[target] = NodeHealth(*target)
+            return self.health_map[target]
+
+    def probe_all(self, target_list:List[ProbeTarget]) -> Mapping[ProbeTarget, NodeHealth]:
+        "refresh expired health entries in single concurrent round"
+        time_now = time.monotonic()
+        health_map = dict([(target, self.node_health(target)) for target in target_list])
+        probe_list = [
+            target for target, health in health_map.items()
+            if health.needs_probe(time_now)
+        ]
+        if probe_list:
+            result_map = prober_connect_all(probe_list, prober_timeout())
+            time_now = time.monotonic()
+            with self.prober_lock:
+                for target, rtt in result_map.items():
+                    health_map[target].report_probe(rtt, time_now)
+        return health_map
+
+    def live_list(self, target_list:List[ProbeTarget]) -> List[ProbeTarget]:
+        "select available targets, skip open circuit nodes"
+        health_map = self.probe_all(target_list)
+        time_now = time.monotonic()
+        return [
+            target for target in target_list
+            if health_map[target].is_available(time_now)
+        ]
+
+
+@functools.lru_cache(maxsize=1)
+def prober_instance() -> NodeProber:
+    "process wide prober, keeps health cache between calls"
+    return NodeProber()
@@ -3,12 +3,15 @@ External process operations
 """
 
 import sys
+import time
 import shlex
 import typing
 import asyncio
 import logging
+import threading
 import subprocess
 from enum import Enum
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 
 logger = logging.getLogger(__name__)
@@ -74,6 +77,37 @@ async def stream_program(command, stdin, react_stdout, react_stderr, encoding):
     return await process.wait()
 
 
+# per-thread child process deadline, monotonic time
+process_local = threading.local()
+
+
+@contextmanager
+def process_deadline(timeout:float):
+    "kill child processes started by this thread after timeout, zero means no limit"
+    deadline_past = getattr(process_local, 'deadline', None)
+    deadline = time.monotonic() + timeout if timeout else None
+    if deadline_past is not None and (deadline is None or deadline_past < deadline):
+        deadline = deadline_past
+    process_local.deadline = deadline
+    try:
+        yield
+    finally:
+        process_local.deadline = deadline_past
+
+
+def process_time_left() -> typing.Optional[float]:
+    "time until thread deadline, None without deadline"
+    deadline = getattr(process_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def process_expired() -> bool:
+    "thread deadline has passed"
+    return process_time_left() == 0.0
+
+
 default_react_stdout = lambda line: sys.stdout.write(f"[stdout] {line}")
 default_react_stderr = lambda line: sys.stderr.write(f"[stderr] {line}")
 
@@ -177,10 +211,45 @@ def execute_process_unit(command, stdin=None) -> ExecuteResult:
         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
     )
     try:
-        stdout, stderr = process.communicate(stdin)
+        stdout, stderr = process.communicate(stdin, timeout=process_time_left())
         rc = process.returncode
         return ExecuteResult(command=command, rc=rc, stdout=stdout, stderr=stderr)
     except Exception as error:
+        process.kill()
+        process.communicate()
+        return ExecuteResult(command=command, error=error)
+
+
+def execute_process_line(command, react_stderr:typing.Callable[[str], None]) -> ExecuteResult:
+    "collect stdout, pass stderr lines to reaction without retaining them"
+    process = subprocess.Popen(
+        command, shell=False, encoding='utf8',
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    try:
+
+        def stderr_task():
+            for line in process.stderr:
+                react_stderr(line)
+
+        stdout_list = list()
+
+        def stdout_task():
+            stdout_list.append(process.stdout.read())
+
+        reader_list = [
+            threading.Thread(name='process-stderr', daemon=True, target=stderr_task),
+            threading.Thread(name='process-stdout', daemon=True, target=stdout_task),
+        ]
+        for reader in reader_list:
+            reader.start()
+        rc = process.wait(timeout=process_time_left())
+        for reader in reader_list:
+            reader.join()
+        return ExecuteResult(command=command, rc=rc, stdout="".join(stdout_list))
+    except Exception as error:
+        process.kill()
+        process.wait()
         return ExecuteResult(command=command, error=error)
 
 
@@ -35,7 +35,8 @@ class DoveAdmHTTPClient(object):
         if self.password:
             self.reqs.auth = (self.username, self.password)
         if self.apikey:
-            self.reqs.headers.update({'Authorization': 'X-Dovecot-API ' + b64encode(self.apikey)})
+            apikey = b64encode(self.apikey.encode()).decode()
+            self.reqs.headers.update({'Authorization': 'X-Dovecot-API ' + apikey})
 
     def get_commands(self):
         """ Retrieve list of available commands and their parameters from API """
@@ -59,9 +60,9 @@ class DoveAdmHTTPClient(object):
         import json
         curl_string = 'curl -H "Authorization: '
         if self.password:
-            curl_string += 'Basic %s"' % b64encode('doveadm:' + self.password)
+            curl_string += 'Basic %s"' % b64encode(('doveadm:' + self.password).encode()).decode()
         elif self.apikey:
-            curl_string += 'X-Dovecot-API %s"' % b64encode(self.apikey)
+            curl_string += 'X-Dovecot-API %s"' % b64encode(self.apikey.encode()).decode()
         curl_string += ' -H "Content-Type: application/json"'
         curl_string += " -d '%s'" % json.dumps([[command, parameters, "c01"]])
         curl_string += " %s" % self.apiurl
@@ -76,3 +77,15 @@ class DoveAdmHTTPClient(object):
             return [["error", {"type": "httpError", "httpError": req.status_code}, "c01"]]
         except requests.exceptions.ConnectionError:
             return [["error", {"type": "fatalError"}, "c01"]]
+
+    def run_batch(self, command_list, timeout=None):
+        """ Run several (command, parameters) in single request, responses in the same order """
+        payload = [[command, parameters, "c%02d" % index] for index, (command, parameters) in enumerate(command_list)]
+        try:
+            req = self.reqs.post(self.apiurl, json=payload, timeout=timeout)
+            if req.status_code == 200:
+                response_map = dict([(response[2], response) for response in req.json()])
+                return [response_map.get(entry[2], ["error", {"type": "missingResponse"}, entry[2]]) for entry in payload]
+            return [["error", {"type": "httpError", "httpError": req.status_code}, entry[2]] for entry in payload]
+        except requests.exceptions.RequestException:
+            return [["error", {"type": "fatalError"}, entry[2]] for entry in payload]
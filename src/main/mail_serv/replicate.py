@@ -7,28 +7,43 @@ https://wiki2.dovecot.org/Tools/Doveadm/Sync
 -u user/mask    Run the command only for the given user.
 -m mailbox    Synchronize only this mailbox name
 -g mailbox_guid    Synchronize only this mailbox guid
+-s state    Incremental sync from previous state, "" for full sync, prints new state
 destination    tcp:host[:port] Connects to remote doveadm server via TCP
 """
 
 import os
+import re
+import time
+import random
 import logging
-from typing import List
+import functools
+from typing import List, Callable
 from mail_serv.config import config_doveadm_port
-from mail_serv.command import doveadm
+from mail_serv.command import doveadm_line
+from mail_serv.support import convert_text2bool
+from mail_serv.syncstate import syncstate_get, syncstate_put, syncstate_drop
+from mail_serv.prober import prober_instance
+from mail_serv.echo import echo_tracker
+from mail_serv.freshness import freshness_record_sync
+from mail_serv.process import ExecuteResult
+from mail_serv.dsyncstat import dsyncstat_enable, dsyncstat_record, \
+    dsyncstat_error_text, dsyncstat_regex_lock, DsyncStatReader
+from mail_serv.userlock import userlock_hold, UserLockBusy
+from mail_serv.metrics import metrics_count
 
 logger = logging.getLogger(__name__)
 
 
+class ReplicateTempFail(RuntimeError):
+    "transient failure, user locked locally or by dsync, retry later"
+
+
 def replication_list(host_list:List[str]) -> List[str] :
     "find active server host list"
-    port = config_doveadm_port()
-    live_list = []
-    timeout = 3
-    for host in host_list:
-        rv = os.system(f"netcat --tcp --zero --wait={timeout} {host} {port}")
-        if rv == 0:
-            live_list.append(host)
-    return live_list
+    port = int(config_doveadm_port())
+    target_list = [(host, port) for host in host_list]
+    live_list = prober_instance().live_list(target_list)
+    return [host for host, _ in live_list]
 
 
 def replicate_lock_time(lock_time:int=3) -> str:
@@ -48,22 +63,126 @@ def replicate_destination(addr:str, port:str) -> str:
     return destination
 
 
-def replicate_with_user(user:str, addr:str, port:str) -> None:
-    "replicate all out-of-sync mailboxes for the user"
+def replicate_stateful() -> bool:
+    "use incremental dsync with stored state, yes by default"
+    return convert_text2bool(os.environ.get('REPLICATE_STATEFUL', 'true'))
+
+
+def replicate_tempfail_retry() -> int:
+    "in-place attempts on temporary failure, for callers without work queue"
+    return int(os.environ.get('REPLICATE_TEMPFAIL_RETRY', 3))
+
+
+def replicate_tempfail_delay() -> float:
+    "initial in-place retry delay, seconds"
+    return float(os.environ.get('REPLICATE_TEMPFAIL_DELAY', 2.0))
+
+
+@functools.lru_cache(maxsize=1)
+def replicate_regex_state() -> re.Pattern:
+    "regex pattern in dsync error output which means rejected sync state"
+    regex = os.environ.get('REPLICATE_REGEX_STATE', '(invalid|corrupted|old|unknown).*state|state.*(invalid|corrupted|mismatch)')
+    return re.compile(regex, re.RegexFlag.IGNORECASE)
+
+
+def replicate_parse_state(stdout:str) -> str:
+    "new state is the last line printed by 'doveadm sync -s'"
+    line_list = [line.strip() for line in (stdout or "").splitlines() if line.strip()]
+    return line_list[-1] if line_list else ""
+
+
+def replicate_dsync(user:str, scope:str, scope_opts:List[str], addr:str, port:str) -> None:
+    """
+    replicate with dsync under user mutex, track session for echo collapse and freshness
+    scope: state key, '*' for user, guid or 'mbox:<name>'
+    """
+    echo_guid = scope_opts[1] if scope_opts[0] == '-g' else None
+    try:
+        with userlock_hold(user):
+            time_start = time.time()
+            with echo_tracker().tracking(user, echo_guid):
+                replicate_dsync_state(user, scope, scope_opts, addr, port)
+    except UserLockBusy as error:
+        raise ReplicateTempFail(str(error)) from error
+    if not scope.startswith('mbox:'):  # name scope has no guid identity
+        try:
+            freshness_record_sync(user, replicate_destination(addr, port), scope, time_start)
+        except Exception as error:
+            logger.warn(f"freshness failure: {user} {scope} :: {error}")
+
+
+def replicate_execute(user:str, destination:str, *sync_opts:str) -> ExecuteResult:
+    "invoke 'doveadm sync', collect statistics, result carries bounded error text"
+    debug_opts = ['-D'] if dsyncstat_enable() else []
+    reader = DsyncStatReader()
+    time_start = time.perf_counter()
+    result = doveadm_line(reader.line, *debug_opts, 'sync', *sync_opts, destination)
+    result = ExecuteResult(
+        command=result.command, rc=result.rc, stdout=result.stdout,
+        stderr=reader.error_text(), error=result.error,
+    )
+    try:
+        dsyncstat_record(destination, reader.finish(result.rc, time.perf_counter() - time_start), user)
+    except Exception as error:
+        logger.warn(f"stat failure: {user} {destination} :: {error}")
+    return result
+
+
+def replicate_verify(user:str, destination:str, rc:int, error_text:str) -> None:
+    "raise on dsync failure, only user lock failure is temporary, other EX_TEMPFAIL is not"
+    if rc == 0:
+        return
+    if dsyncstat_regex_lock().search(error_text):
+        metrics_count('replicate_tempfail', node=destination)
+        raise ReplicateTempFail(f"temporary failure: {user} {rc} {error_text}")
+    assert rc == 0, f"failure: {rc} {error_text}"
+
+
+def replicate_retry(replicate_func:Callable, *args) -> None:
+    "invoke replication, retry temporary failure in place with backoff"
+    attempt_limit = max(1, replicate_tempfail_retry())
+    for attempt in range(1, attempt_limit + 1):
+        try:
+            replicate_func(*args)
+            return
+        except ReplicateTempFail as error:
+            if attempt >= attempt_limit:
+                raise
+            delay = replicate_tempfail_delay() * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            logger.info(f"retry: attempt={attempt} delay={delay:.1f} :: {error}")
+            time.sleep(delay)
+
+
+def replicate_dsync_state(user:str, scope:str, scope_opts:List[str], addr:str, port:str) -> None:
+    "replicate with dsync, incremental when state is known"
     lock_time = replicate_lock_time()
     destination = replicate_destination(addr, port)
-    doveadm('sync', '-N', '-l', lock_time, '-u', user, '-m', '*', destination)
+    if not replicate_stateful():
+        result = replicate_execute(user, destination, '-N', '-l', lock_time, '-u', user, *scope_opts)
+        replicate_verify(user, destination, result.rc, dsyncstat_error_text(result.stderr))
+        return
+    state = syncstate_get(user, destination, scope)
+    result = replicate_execute(user, destination, '-N', '-l', lock_time, '-u', user, '-s', state, *scope_opts)
+    error_text = dsyncstat_error_text(result.stderr)
+    if result.rc != 0 and state and replicate_regex_state().search(error_text):
+        logger.warn(f"state rejected, full sync: {user} {scope} {destination}")
+        syncstate_drop(user, destination, scope)
+        result = replicate_execute(user, destination, '-N', '-l', lock_time, '-u', user, '-s', "", *scope_opts)
+        error_text = dsyncstat_error_text(result.stderr)
+    replicate_verify(user, destination, result.rc, error_text)
+    syncstate_put(user, destination, scope, replicate_parse_state(result.stdout))
+
+
+def replicate_with_user(user:str, addr:str, port:str) -> None:
+    "replicate all out-of-sync mailboxes for the user"
+    replicate_dsync(user, '*', ['-m', '*'], addr, port)
 
 
 def replicate_with_mbox(user:str, mbox:str, addr:str, port:str) -> None:
     "replicate single mailbox for the user, selected by mailbox name"
-    lock_time = replicate_lock_time()
-    destination = replicate_destination(addr, port)
-    doveadm('sync', '-N', '-l', lock_time, '-u', user, '-m', mbox, destination)
+    replicate_dsync(user, f"mbox:{mbox}", ['-m', mbox], addr, port)
 
 
 def replicate_with_guid(user:str, guid:str, addr:str, port:str) -> None:
     "replicate single mailbox for the user, selected by mailbox guid"
-    lock_time = replicate_lock_time()
-    destination = replicate_destination(addr, port)
-    doveadm('sync', '-N', '-l', lock_time, '-u', user, '-g', guid, destination)
+    replicate_dsync(user, guid, ['-g', guid], addr, port)
@@ -0,0 +1,248 @@
+"""
+Resident keeper service:
+* cycle through users continuously instead of periodic bursts
+* spread users evenly over target cycle time
+* bound concurrent doveadm users with worker count
+* cap storage io rate of keeper and its doveadm children
+* keep warm state between users, report progress
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from dataclasses import dataclass, field, asdict
+from typing import Mapping, List
+
+from mail_serv.user import user_list
+from mail_serv.keeper import keeper_process_entry, keeper_prefetch_diverge
+from mail_serv.diverge import diverge_batch_size
+from mail_serv.activity import activity_collect
+from mail_serv.priority import priority_restore, priority_persist, \
+    priority_absorb_activity, priority_user_order, priority_state_dir, \
+    UserPriority
+from mail_serv.support import fs_persist_json
+from mail_serv.procname import procname_set
+from mail_serv.tinker import tinker_registry_watch
+from mail_serv.timing import timing_session
+from mail_serv.checkpoint import checkpoint_begin, RunCheckpoint
+from mail_serv.freshness import freshness_persist_report
+from mail_serv.metrics import metrics_persist
+from mail_serv.dsyncstat import dsyncstat_persist_report
+
+logger = logging.getLogger(__name__)
+
+
+def resident_cycle_time() -> float:
+    "target duration of full pass over all users, seconds"
+    return float(os.environ.get('RESIDENT_CYCLE_TIME', 6 * 3600))
+
+
+def resident_doveadm_limit() -> int:
+    "number of concurrent keeper workers, each runs one doveadm at a time"
+    return max(1, int(os.environ.get('RESIDENT_DOVEADM_LIMIT', 2)))
+
+
+def resident_io_rate() -> float:
+    "storage io rate cap in bytes per second, zero means no cap"
+    return float(os.environ.get('RESIDENT_IO_RATE', 0))
+
+
+def resident_progress_file() -> str:
+    "progress report location"
+    return os.environ.get('RESIDENT_PROGRESS_FILE', f"{priority_state_dir()}/progress.json")
+
+
+def resident_io_bytes() -> int:
+    "storage io of this process and its reaped children, from /proc/self/io"
+    try:
+        with open("/proc/self/io", "r") as line_list:
+            io_dict = dict()
+            for line in line_list:
+                key, value = line.partition(":")[::2]
+                io_dict[key.strip()] = int(value.strip())
+        return io_dict.get('read_bytes', 0) + io_dict.get('write_bytes', 0)
+    except Exception:
+        return 0
+
+
+class IoRateLimiter():
+    "delay callers so that average storage io stays below the rate cap"
+
+    io_rate:float
+    io_start:int
+    time_start:float
+    limiter_lock:threading.Lock
+
+    def __init__(self, io_rate:float):
+        self.io_rate = io_rate
+        self.io_start = resident_io_bytes()
+        self.time_start = time.monotonic()
+        self.limiter_lock = threading.Lock()
+
+    @property
+    def io_total(self) -> int:
+        return resident_io_bytes() - self.io_start
+
+    def throttle(self) -> float:
+        "sleep off io debt, report sleep time"
+        if not self.io_rate:
+            return 0
+        with self.limiter_lock:  # serialize sleepers
+            time_spent = time.monotonic() - self.time_start
+            time_owed = self.io_total / self.io_rate
+            time_debt = time_owed - time_spent
+            if time_debt > 0:
+                time.sleep(time_debt)
+                return time_debt
+            return 0
+
+
+@dataclass
+class ResidentProgress:
+    "resident keeper progress report"
+
+    cycle_count:int = 0  # completed cycles
+    cycle_start:float = 0  # current cycle start, epoch
+    cycle_time:float = 0  # target cycle duration, seconds
+    user_total:int = 0  # users in current cycle
+    user_done:int = 0  # users processed in current cycle
+    user_fail:int = 0  # users failed in current cycle
+    user_active:List[str] = field(default_factory=list)  # users in progress
+    io_total:int = 0  # storage io since startup, bytes
+    time_behind:float = 0  # schedule lag of last dispatch, seconds
+
+
+class ResidentKeeper():
+    "continuous rate-limited keeper"
+
+    cycle_time:float
+    worker_count:int
+    io_limiter:IoRateLimiter
+    user_queue:queue.Queue
+    state_lock:threading.Lock
+    priority_map:Mapping[str, UserPriority]
+    progress:ResidentProgress
+    checkpoint:RunCheckpoint
+
+    def __init__(self,
+            cycle_time:float,
+            worker_count:int,
+            io_rate:float,
+        ):
+        self.cycle_time = cycle_time
+        self.worker_count = worker_count
+        self.io_limiter = IoRateLimiter(io_rate)
+        self.user_queue = queue.Queue(maxsize=worker_count)
+        self.state_lock = threading.Lock()
+        self.priority_map = priority_restore()
+        self.progress = ResidentProgress(cycle_time=cycle_time)
+        self.checkpoint = None
+
+    def setup_workers(self) -> None:
+        "ensure worker threads"
+        for index in range(self.worker_count):
+            threading.Thread(
+                name=f'keeper-worker-{index}',
+                daemon=True,
+                target=self.worker_task,
+            ).start()
+
+    def worker_task(self) -> None:
+        "process users handed out by cycle dispatcher"
+        procname_set(threading.current_thread().name)
+        while True:
+            user_name = self.user_queue.get()
+            try:
+                self.process_user(user_name)
+            except Exception as error:
+                logger.warn(f"failure: {user_name} :: {error}")
+            finally:
+                self.user_queue.task_done()
+
+    def process_user(self, user_name:str) -> None:
+        with self.state_lock:
+            self.progress.user_active.append(user_name)
+        success = keeper_process_entry(user_name, self.priority_map, self.checkpoint)
+        self.io_limiter.throttle()
+        with self.state_lock:
+            self.progress.user_active.remove(user_name)
+            self.progress.user_done += 1
+            if not success:
+                self.progress.user_fail += 1
+            self.report_progress()
+
+    def report_progress(self) -> None:
+        "persist progress report, invoked under state lock"
+        self.progress.io_total = self.io_limiter.io_total
+        try:
+            fs_persist_json(resident_progress_file(), asdict(self.progress))
+        except Exception as error:
+            logger.warn(f"progress failure: {error}")
+
+    def process_cycle(self) -> None:
+        "dispatch all users evenly spread over cycle time, report step timing"
+        with timing_session('keeper-resident'):
+            self.dispatch_cycle()
+        time_rest = self.cycle_time - (time.time() - self.progress.cycle_start)
+        if time_rest > 0:
+            time.sleep(time_rest)
+
+    def dispatch_cycle(self) -> None:
+        "hand out users to workers at paced intervals"
+        self.checkpoint = checkpoint_begin('keeper-resident')
+        with self.state_lock:
+            priority_absorb_activity(self.priority_map, activity_collect())
+            user_order = priority_user_order(user_list(), self.priority_map)
+            user_done_set = self.checkpoint.user_done_set
+            user_order = [user_name for user_name in user_order if user_name not in user_done_set]
+            self.progress.cycle_start = time.time()
+            self.progress.user_total = len(user_order)
+            self.progress.user_done = 0
+            self.progress.user_fail = 0
+            self.report_progress()
+        logger.info(f"cycle start: user_total={len(user_order)} cycle_time={self.cycle_time}")
+        slot_time = self.cycle_time / max(1, len(user_order))
+        time_start = time.monotonic()
+        for user_index, user_name in enumerate(user_order):
+            time_slot = time_start + user_index * slot_time
+            time_wait = time_slot - time.monotonic()
+            if time_wait > 0:
+                time.sleep(time_wait)
+            self.progress.time_behind = max(0, -time_wait)
+            if user_index % diverge_batch_size() == 0:
+                keeper_prefetch_diverge(user_order[user_index:user_index + diverge_batch_size()])
+            self.user_queue.put(user_name)  # blocks while workers are busy
+        self.user_queue.join()
+        self.checkpoint.record_finish()
+        with self.state_lock:
+            self.progress.cycle_count += 1
+            self.report_progress()
+            priority_persist(self.priority_map)
+        freshness_persist_report()
+        metrics_persist('keeper-resident')
+        dsyncstat_persist_report('keeper-resident')
+        time_spent = time.monotonic() - time_start
+        logger.info(
+            f"cycle finish: time_spent={time_spent:.3f} "
+            f"user_fail={self.progress.user_fail} io_total={self.progress.io_total:,}"
+        )
+
+
+def resident_service() -> None:
+    "service entry"
+    logger.info(f"startup")
+    keeper = ResidentKeeper(
+        cycle_time=resident_cycle_time(),
+        worker_count=resident_doveadm_limit(),
+        io_rate=resident_io_rate(),
+    )
+    tinker_registry_watch()
+    keeper.setup_workers()
+    while True:  # perform forever
+        try:
+            keeper.process_cycle()
+        except Exception as error:
+            logger.warn(f"failure: {error}")
+            time.sleep(1)  # prevent error spin
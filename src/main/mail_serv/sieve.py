@@ -8,11 +8,19 @@ http://www.gyford.com/phil/writing/2010/07/02/sieve-filters.php
 
 import os
 import re
+import hashlib
 import logging
-from mail_serv.user import user_list
-from mail_serv.config import config_sieve_active, config_sieve_path
-from mail_serv.command import sieve_filter, shell
-from mail_serv.support import fs_strip_eol, fs_rmany, fs_mkdir
+import itertools
+from dataclasses import dataclass, field
+from typing import Mapping, List, Iterable
+from mail_serv.user import user_list, user_path
+from mail_serv.config import config_sieve_active, config_sieve_path, config_mail_home
+from mail_serv.command import sieve_filter, sievec, shell, doveadm
+from mail_serv.process import process_time_left
+from mail_serv.fanout import fanout_run, UserOutcome
+from mail_serv.userlock import userlock_hold
+from mail_serv.support import fs_strip_eol, fs_rmany, fs_mkdir, \
+    fs_persist_json, fs_restore_json, fs_lock_file, convert_text2bool
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +29,15 @@ def sieve_suffix() -> str:
     return "sieve"
 
 
+def sieve_binary_suffix() -> str:
+    return "svbin"
+
+
+def sieve_compile_enable() -> bool:
+    "pre-compile generated filters with sievec, yes by default"
+    return convert_text2bool(os.environ.get('SIEVE_COMPILE', 'true'))
+
+
 def sieve_system_name(name:str) -> str:
     "name of system-generated sieve filter for a mailbox"
     return f"{name}.system"
@@ -32,20 +49,154 @@ def sieve_system_file(base_dir:str, name:str) -> str:
     return f"{base_dir}/{system_name}.{sieve_suffix()}"
 
 
-def sieve_invoke_all() -> None:
+def sieve_worker_count() -> int:
+    "concurrent users in build/invoke of all users, 1 means serial"
+    return int(os.environ.get('SIEVE_WORKER_COUNT', 4))
+
+
+def sieve_user_timeout() -> float:
+    "limit for single user in build/invoke of all users, seconds, zero means no limit"
+    return float(os.environ.get('SIEVE_USER_TIMEOUT', 600))
+
+
+def sieve_lock_wait() -> float:
+    "maximum wait for concurrent build/invoke of the same user, seconds"
+    return float(os.environ.get('SIEVE_LOCK_WAIT', 300))
+
+
+def sieve_user_lock(user:str):
+    "serialize build and invoke of single user, wait is bounded by user timeout when present"
+    wait = sieve_lock_wait()
+    time_left = process_time_left()
+    if time_left is not None:
+        wait = min(wait, time_left)
+    return userlock_hold(user, wait=wait, kind='sieve')
+
+
+def sieve_invoke_all() -> List[UserOutcome]:
     "apply sieve filters for all users"
-    for user in user_list():
-        sieve_invoke_user(user)
+    return fanout_run(
+        'sieve-invoke', sieve_invoke_user, user_list(),
+        sieve_worker_count(), sieve_user_timeout(),
+    )
 
 
 def sieve_invoke_user(user:str, mbox:str='INBOX') -> None:
-    "apply sieve filters for single user"
-    script = config_sieve_active(user)
-    if os.path.isfile(script):
-        logger.debug(f"sieve filter: {user} {script}")
-        sieve_filter('-e', '-W', '-u', user, script, mbox)
-    else:
-        logger.debug(f"sieve filter: {user} no-active-script")
+    "apply sieve filters for single user, serialized with build of the same user"
+    with sieve_user_lock(user):
+        script = config_sieve_active(user)
+        if os.path.isfile(script):
+            logger.debug(f"sieve filter: {user} {script}")
+            if sieve_incremental():
+                sieve_invoke_incremental(user, mbox, script)
+            else:
+                sieve_filter('-e', '-W', '-u', user, script, mbox)
+        else:
+            logger.debug(f"sieve filter: {user} no-active-script")
+
+
+def sieve_incremental() -> bool:
+    "filter only messages which arrived after last pass, no by default, needs virtual namespace"
+    return convert_text2bool(os.environ.get('SIEVE_INCREMENTAL', 'false'))
+
+
+def sieve_state_dir() -> str:
+    "per-user filter high-water storage folder"
+    return os.environ.get('SIEVE_STATE_DIR', '/var/lib/mail_serv/sieve')
+
+
+def sieve_state_file(user:str) -> str:
+    "filter high-water record of single user"
+    return f"{sieve_state_dir()}/{user_path(user)}.json"
+
+
+def sieve_virtual_root() -> str:
+    "location of dovecot virtual namespace, relative to user home"
+    return os.environ.get('SIEVE_VIRTUAL_ROOT', '~/virtual')
+
+
+def sieve_virtual_prefix() -> str:
+    "prefix of dovecot virtual namespace"
+    return os.environ.get('SIEVE_VIRTUAL_PREFIX', 'virtual/')
+
+
+def sieve_virtual_name() -> str:
+    "virtual mailbox of incremental filter pass, must not interfere with any user mailbox names"
+    return os.environ.get('SIEVE_VIRTUAL_NAME', f"{sieve_arkon()}_fresh")
+
+
+def sieve_virtual_mbox() -> str:
+    "virtual mailbox as seen by sieve-filter"
+    return f"{sieve_virtual_prefix()}{sieve_virtual_name()}"
+
+
+def sieve_virtual_file(user:str) -> str:
+    "definition file of virtual mailbox of single user"
+    virtual_root = sieve_virtual_root().replace('~', config_mail_home(user))
+    return f"{virtual_root}/{sieve_virtual_name()}/dovecot-virtual"
+
+
+def sieve_parse_table(text:str) -> List[Mapping[str, str]]:
+    "parse 'doveadm -f tab' output with header line"
+    line_list = [line for line in (text or "").splitlines() if line.strip()]
+    if not line_list:
+        return list()
+    header = line_list[0].split('\t')
+    return [dict(zip(header, line.split('\t'))) for line in line_list[1:]]
+
+
+def sieve_mbox_status(user:str, mbox:str) -> Mapping[str, str]:
+    "mailbox uidvalidity and uidnext"
+    text = doveadm('-f', 'tab', 'mailbox', 'status', '-u', user, 'uidvalidity uidnext', mbox)
+    return sieve_parse_table(text)[0]
+
+
+def sieve_uid_set(uid_list:List[int]) -> str:
+    "compact imap uid set: [1, 2, 3, 7] -> 1:3,7"
+    range_list = list()
+    for uid in sorted(uid_list):
+        if range_list and range_list[-1][1] + 1 == uid:
+            range_list[-1][1] = uid
+        else:
+            range_list.append([uid, uid])
+    return ",".join([
+        f"{head}:{tail}" if head != tail else f"{head}"
+        for head, tail in range_list
+    ])
+
+
+def sieve_virtual_define(user:str, mbox:str, uid_head:int, uid_tail:int) -> None:
+    "point virtual mailbox at uid range of source mailbox"
+    path = sieve_virtual_file(user)
+    fs_mkdir(os.path.dirname(path))
+    with open(path, "w") as define_text:
+        define_text.write(f"{mbox}\n  UID {uid_head}:{uid_tail}\n")
+
+
+def sieve_invoke_incremental(user:str, mbox:str, script:str) -> None:
+    """
+    filter only messages above per-mailbox high-water uid:
+    * sieve-filter runs over virtual mailbox limited to new uid range
+    * source mailbox is left untouched, implicit keep changes nothing,
+      only messages filed by rules are moved, same as in full pass
+    * no new uids means no filter pass at all
+    * uidvalidity change or missing record means full pass over mailbox
+    """
+    path = sieve_state_file(user)
+    with fs_lock_file(f"{path}.lock"):
+        state_map = fs_restore_json(path, dict())
+        state = state_map.get(mbox, dict())
+        status = sieve_mbox_status(user, mbox)
+        uid_last = int(status['uidnext']) - 1
+        if state.get('uidvalidity', None) != status['uidvalidity']:
+            logger.debug(f"sieve filter full: {user} {mbox}")
+            sieve_filter('-e', '-W', '-u', user, script, mbox)
+        elif state['uid'] < uid_last:
+            logger.debug(f"sieve filter range: {user} {mbox} uid={state['uid'] + 1}:{uid_last}")
+            sieve_virtual_define(user, mbox, state['uid'] + 1, uid_last)
+            sieve_filter('-e', '-W', '-u', user, script, sieve_virtual_mbox())
+        state_map[mbox] = dict(uidvalidity=status['uidvalidity'], uid=uid_last)
+        fs_persist_json(path, state_map)
 
 
 # match base mailbox
@@ -67,10 +218,12 @@ sieve_regex_define = re.compile(
 )
 
 
-def sieve_build_all() -> None:
+def sieve_build_all() -> List[UserOutcome]:
     "build sieve filters for all users"
-    for user_name in user_list():
-        sieve_build_user(user_name)
+    return fanout_run(
+        'sieve-build', sieve_build_user, user_list(),
+        sieve_worker_count(), sieve_user_timeout(),
+    )
 
 
 def sieve_arkon() -> str:
@@ -78,80 +231,284 @@ def sieve_arkon() -> str:
     return os.environ.get('SIEVE_ARKON', 'A_R_K_O_N')
 
 
-def sieve_build_user(user_name:str) -> None:
-    "build sieve filters for single user"
+@dataclass(frozen=True)
+class SieveRule:
+    "routing rule from define mailbox"
+
+    define_subj:str  # keyword without [], optional
+    define_addr:str
+    mbox_path:str
+
 
-    logger.debug(f"sieve build: {user_name}")
+@dataclass
+class SieveModel:
+    "user filter tree: base mailbox -> ordered routing rules"
 
-    sieve_dir = config_sieve_path(user_name)
-    build_dir = f"{sieve_dir}/sys"
+    base_list:List[str] = field(default_factory=list)  # in mailbox list order
+    rule_map:Mapping[str, List[SieveRule]] = field(default_factory=dict)
 
-    # ensure build folder
-    fs_rmany(build_dir)
-    fs_mkdir(build_dir)
+    def base_rule_list(self, base_mbox:str) -> List[SieveRule]:
+        return self.rule_map.get(base_mbox, [])
 
-    # persist user mailbox list
-    mailbox_list = f"{build_dir}/a_mailbox_list.txt"
-    sieve_persist_mbox_list(user_name, mailbox_list)
 
-    # collect base mailbox list
-    include_list = f"{build_dir}/a_include_list.txt"
+@dataclass(frozen=True)
+class SieveScript:
+    "generated filter ready for upload"
 
-    # sieve root script
+    name:str
+    file:str
+    text:str
+
+    def content_hash(self) -> str:
+        return hashlib.sha256(self.text.encode('utf-8')).hexdigest()
+
+    def is_root(self) -> bool:
+        return self.name == sieve_system_name(sieve_arkon())
+
+
+def sieve_build_model(mbox_list:Iterable[str]) -> SieveModel:
+    "single pass over mailbox list, rules of undeclared base mailbox are ignored"
+    model = SieveModel()
+    virtual_mbox = sieve_virtual_mbox()
+    for mbox_path in mbox_list:
+        if mbox_path == virtual_mbox:
+            continue
+        match_root = sieve_regex_base.match(mbox_path)
+        if match_root:
+            model.base_list.append(match_root.group(1))
+            continue
+        match_define = sieve_regex_define.match(mbox_path)
+        if match_define:
+            base_mbox = match_define.group(1)
+            define_subj = match_define.group(2)
+            define_addr = match_define.group(3)
+            if define_subj:
+                define_subj = define_subj[1:-1]  # remove []
+            rule = SieveRule(define_subj, define_addr, mbox_path)
+            model.rule_map.setdefault(base_mbox, []).append(rule)
+    return model
+
+
+def sieve_render_base(base_mbox:str, rule_list:List[SieveRule]) -> str:
+    "base filter text"
+    base_name = sieve_system_name(base_mbox)
+    if sieve_optimize():
+        code_list = sieve_code_optimize(rule_list)
+    else:
+        code_list = [
+            sieve_code_entry(rule.define_subj, rule.define_addr, rule.mbox_path) for rule in rule_list
+        ]
+    line_list = [
+        f'# {base_name}',
+        f'require "fileinto";',
+    ] + code_list
+    return "\n".join(line_list) + "\n"
+
+
+def sieve_render_arkon(base_list:List[str]) -> str:
+    "root filter text, includes every base filter"
+    arkon_name = sieve_system_name(sieve_arkon())
+    line_list = [
+        f'# {arkon_name}',
+        f'require "include";',
+    ] + [
+        f'include :personal "{sieve_system_name(base_mbox)}";' for base_mbox in base_list
+    ]
+    return "\n".join(line_list) + "\n"
+
+
+def sieve_render_model(model:SieveModel, build_dir:str) -> List[SieveScript]:
+    "base filters followed by root filter, in upload order"
+    script_list = [
+        SieveScript(
+            name=sieve_system_name(base_mbox),
+            file=sieve_system_file(build_dir, base_mbox),
+            text=sieve_render_base(base_mbox, model.base_rule_list(base_mbox)),
+        ) for base_mbox in model.base_list
+    ]
     arkon = sieve_arkon()
-    arkon_name = sieve_system_name(arkon)
-    arkon_file = sieve_system_file(build_dir, arkon)
-
-    # create filter tree
-    with open(arkon_file, "w") as arkon_text, open(include_list, "w") as include_text:
-        arkon_text.write(f'# {arkon_name}\n')
-        arkon_text.write(f'require "include";\n')
-
-        # create base filters
-        with open(mailbox_list, "r") as entry_list:
-            for entry in entry_list:
-                mbox_path = fs_strip_eol(entry)
-                match_root = sieve_regex_base.match(mbox_path)
-                if match_root:
-                    base_mbox = match_root.group(1)
-                    base_name = sieve_system_name(base_mbox)
-                    base_file = sieve_system_file(build_dir, base_mbox)
-                    # arkon uses base script
-                    arkon_text.write(f'include :personal "{base_name}";\n')
-                    # setup initial base script
-                    with open(base_file, "w") as script:  # create
-                        script.write(f'# {base_name}\n')
-                        script.write(f'require "fileinto";\n')
-                    # remember base filters
-                    include_text.write(f'{base_mbox}\n')
-
-        # populate base filters
-        with open(mailbox_list, "r") as entry_list:
-            for entry in entry_list:
-                mbox_path = fs_strip_eol(entry)
-                match_define = sieve_regex_define.match(mbox_path)
-                if match_define:
-                    base_mbox = match_define.group(1)
-                    base_name = sieve_system_name(base_mbox)
-                    base_file = sieve_system_file(build_dir, base_mbox)
-                    define_subj = match_define.group(2)
-                    define_addr = match_define.group(3)
-                    if define_subj:
-                        define_subj = define_subj[1:-1]  # remove []
-                    # provide filter expression
-                    sieve_code = sieve_code_entry(define_subj, define_addr, mbox_path)
-                    with open(base_file, "a") as script:  # append
-                        script.write(f"{sieve_code}\n")
-
-    # activate generated filters
-    with open(include_list, "r") as entry_list:
-        for entry in entry_list:
-            base_mbox = fs_strip_eol(entry)
-            base_name = sieve_system_name(base_mbox)
-            base_file = sieve_system_file(build_dir, base_mbox)
-            sieve_persist_filter(user_name, base_name, base_file)
-
-    sieve_persist_filter(user_name, arkon_name, arkon_file)
+    script_list.append(SieveScript(
+        name=sieve_system_name(arkon),
+        file=sieve_system_file(build_dir, arkon),
+        text=sieve_render_arkon(model.base_list),
+    ))
+    return script_list
+
+
+def sieve_read_mbox_list(mbox_list_file:str) -> List[str]:
+    with open(mbox_list_file, "r") as entry_list:
+        return [fs_strip_eol(entry) for entry in entry_list]
+
+
+def sieve_build_user(user_name:str) -> None:
+    "build sieve filters for single user, serialized with filter pass of the same user"
+    with sieve_user_lock(user_name):
+        logger.debug(f"sieve build: {user_name}")
+
+        sieve_dir = config_sieve_path(user_name)
+        build_dir = f"{sieve_dir}/sys"
+
+        # ensure build folder, keep manifest of past build
+        fs_mkdir(build_dir)
+        sieve_clean_build(build_dir)
+
+        # persist user mailbox list
+        mailbox_list = f"{build_dir}/a_mailbox_list.txt"
+        sieve_persist_mbox_list(user_name, mailbox_list)
+
+        # create filter tree in memory, write each filter once
+        model = sieve_build_model(sieve_read_mbox_list(mailbox_list))
+        script_list = sieve_render_model(model, build_dir)
+        for script in script_list:
+            with open(script.file, "w") as script_text:
+                script_text.write(script.text)
+
+        # report compile errors before anything is uploaded
+        if sieve_compile_enable():
+            sieve_compile_build(build_dir, script_list)
+
+        # activate generated filters
+        sieve_publish_user(user_name, build_dir, script_list)
+
+        # provide fresh binaries next to stored filters
+        if sieve_compile_enable():
+            sieve_compile_install(user_name, sieve_dir, build_dir, script_list)
+
+
+def sieve_manifest_file(build_dir:str) -> str:
+    "hashes of last uploaded filters"
+    return f"{build_dir}/a_manifest.json"
+
+
+def sieve_binary_manifest_file(build_dir:str) -> str:
+    "hashes of filters compiled in user sieve storage"
+    return f"{build_dir}/a_binary.json"
+
+
+def sieve_cache_dir(build_dir:str) -> str:
+    "compiled filters keyed by content hash, build time error report only"
+    return f"{build_dir}/cache"
+
+
+def sieve_cache_file(build_dir:str, content_hash:str) -> str:
+    return f"{sieve_cache_dir(build_dir)}/{content_hash}.{sieve_binary_suffix()}"
+
+
+def sieve_clean_build(build_dir:str) -> None:
+    "remove generated files of past build, keep manifests and compile cache"
+    keep_list = [
+        sieve_manifest_file(build_dir), sieve_binary_manifest_file(build_dir), sieve_cache_dir(build_dir),
+    ]
+    for entry in os.listdir(build_dir):
+        path = f"{build_dir}/{entry}"
+        if path not in keep_list:
+            fs_rmany(path)
+
+
+def sieve_compile_build(build_dir:str, script_list:List[SieveScript]) -> None:
+    """
+    compile base filters missing from cache, fail build on first error;
+    root filter includes user storage scripts, it is compiled after upload
+    """
+    cache_dir = sieve_cache_dir(build_dir)
+    fs_mkdir(cache_dir)
+    keep_set = set()
+    for script in script_list:
+        if script.is_root():
+            continue
+        binary_file = sieve_cache_file(build_dir, script.content_hash())
+        keep_set.add(binary_file)
+        if os.path.isfile(binary_file):
+            continue
+        try:
+            sievec(script.file, binary_file)
+        except Exception as error:
+            fs_rmany(binary_file)
+            raise RuntimeError(f"sieve compile failure: {script.name} :: {error}") from error
+    for entry in os.listdir(cache_dir):  # forget binaries of past content
+        path = f"{cache_dir}/{entry}"
+        if path not in keep_set:
+            fs_rmany(path)
+
+
+def sieve_compile_install(user_name:str, sieve_dir:str, build_dir:str, script_list:List[SieveScript]) -> None:
+    """
+    compile stored filters in place in user context:
+    binary records its storage location and belongs to the user, so dovecot accepts it;
+    filter with unchanged content keeps its binary, root binary embeds included filters
+    """
+    manifest_file = sieve_binary_manifest_file(build_dir)
+    manifest = fs_restore_json(manifest_file, dict())
+    has_change = False
+    try:
+        for script in script_list:  # root filter is last
+            stored_file = f"{sieve_dir}/{script.name}.{sieve_suffix()}"
+            stored_binary = f"{sieve_dir}/{script.name}.{sieve_binary_suffix()}"
+            if not os.path.isfile(stored_file):
+                manifest.pop(script.name, None)
+                continue
+            content_hash = script.content_hash()
+            is_fresh = manifest.get(script.name, None) == content_hash and os.path.isfile(stored_binary)
+            if is_fresh and not (script.is_root() and has_change):
+                continue  # unchanged filter keeps its binary
+            has_change = True
+            try:
+                sievec('-u', user_name, stored_file, stored_binary)
+                manifest[script.name] = content_hash
+            except Exception as error:
+                manifest.pop(script.name, None)
+                logger.warn(f"binary install failure: {user_name} {script.name} :: {error}")
+        for filter_name in set(manifest.keys()) - set([script.name for script in script_list]):
+            del manifest[filter_name]
+    finally:
+        fs_persist_json(manifest_file, manifest)
+
+
+# 'doveadm sieve list' marks active script
+sieve_regex_active = re.compile(r'\s+ACTIVE$')
+
+
+def sieve_list_filter(user_name:str) -> List[str]:
+    "names of sieve scripts stored by dovecot"
+    text = doveadm('sieve', 'list', '-u', user_name)
+    return [sieve_regex_active.sub('', line) for line in text.splitlines() if line.strip()]
+
+
+def sieve_remove_filter(user_name:str, filter_name:str) -> None:
+    "delete sieve script from dovecot"
+    doveadm('sieve', 'delete', '-u', user_name, filter_name)
+
+
+def sieve_publish_user(user_name:str, build_dir:str, script_list:List[SieveScript]) -> None:
+    """
+    upload only changed filters, delete filters of removed base mailboxes
+    script_list: generated filters in upload order
+    """
+    manifest_file = sieve_manifest_file(build_dir)
+    manifest = fs_restore_json(manifest_file, dict())
+    stored_set = set(sieve_list_filter(user_name))
+    upload_count = 0
+    try:
+        for script in script_list:
+            content_hash = script.content_hash()
+            if manifest.get(script.name, None) == content_hash and script.name in stored_set:
+                continue
+            sieve_persist_filter(user_name, script.name, script.file)
+            manifest[script.name] = content_hash
+            upload_count += 1
+        # system filters which are no longer included by root script
+        system_suffix = sieve_system_name('')
+        remove_set = set(manifest.keys()) | set([
+            filter_name for filter_name in stored_set if filter_name.endswith(system_suffix)
+        ])
+        remove_set -= set([script.name for script in script_list])
+        for filter_name in sorted(remove_set):
+            if filter_name in stored_set:
+                sieve_remove_filter(user_name, filter_name)
+            manifest.pop(filter_name, None)
+    finally:
+        fs_persist_json(manifest_file, manifest)
+    logger.debug(f"sieve publish: {user_name} upload={upload_count} remove={len(remove_set)}")
 
 
 def sieve_persist_mbox_list(user_name:str, mbox_list_file:str) -> None:
@@ -168,14 +525,126 @@ def sieve_persist_filter(user_name:str, filter_name:str, filter_file:str) -> Non
     )
 
 
+# match <name@domain> field in these headers
+sieve_header_addr = '[ "To", "CC", "From", "Sender", "Reply-To" ]'
+
+# match [subject] string in these headers
+sieve_header_subj = '[ "From", "Subject" ]'
+
+
 def sieve_code_entry(define_subj:str, define_addr:str, mbox_path:str) -> str:
     "generate sieve filter code snippet based on subject/address"
-    # match <name@domain> field in these headers
-    test_addr = f'address :contains [ "To", "CC", "From", "Sender", "Reply-To" ] "{define_addr}"'
+    test_addr = f'address :contains {sieve_header_addr} "{define_addr}"'
     body_file = f'{{ fileinto "{mbox_path}"; stop; }}'
     if define_subj :
-        # match [subject] string in these headers
-        test_subj = f'header :contains [ "From", "Subject" ] "{define_subj}"'
+        test_subj = f'header :contains {sieve_header_subj} "{define_subj}"'
         return f"if allof( {test_addr} , {test_subj} ) {body_file}"
     else :
         return f"if {test_addr} {body_file}"
+
+
+def sieve_optimize() -> bool:
+    "emit grouped pre-dispatch filter code, yes by default"
+    return convert_text2bool(os.environ.get('SIEVE_OPTIMIZE', 'true'))
+
+
+def sieve_group_min() -> int:
+    "consecutive rules sharing domain or keyword which get own guard"
+    return max(2, int(os.environ.get('SIEVE_GROUP_MIN', 2)))
+
+
+def sieve_group_chunk() -> int:
+    "consecutive domain runs behind single domain list guard"
+    return max(2, int(os.environ.get('SIEVE_GROUP_CHUNK', 16)))
+
+
+def sieve_rule_domain(rule:SieveRule) -> str:
+    """
+    domain implied by rule address: address containing "name@domain"
+    has domain part containing "domain", guard is necessary condition;
+    None for address without single '@' which can not be guarded
+    """
+    term_list = rule.define_addr.split('@')
+    if len(term_list) != 2 or not term_list[1]:
+        return None
+    return term_list[1].lower()
+
+
+def sieve_code_key_list(key_list:List[str]) -> str:
+    if len(key_list) == 1:
+        return f'"{key_list[0]}"'
+    return "[ " + ", ".join([f'"{key}"' for key in key_list]) + " ]"
+
+
+def sieve_code_block(test:str, body_list:List[str], indent:str) -> List[str]:
+    return [f"{indent}if {test} {{"] + body_list + [f"{indent}}}"]
+
+
+def sieve_code_rule_list(rule_list:List[SieveRule], indent:str, subj_guarded:bool=False) -> List[str]:
+    "rule tests in order, consecutive rules with identical target share single action"
+    line_list = list()
+    for mbox_path, rule_group in itertools.groupby(rule_list, key=lambda rule: rule.mbox_path):
+        test_list = list()
+        for rule in rule_group:
+            test_addr = f'address :contains {sieve_header_addr} "{rule.define_addr}"'
+            if rule.define_subj and not subj_guarded:
+                test_subj = f'header :contains {sieve_header_subj} "{rule.define_subj}"'
+                test_list.append(f"allof( {test_addr} , {test_subj} )")
+            else:
+                test_list.append(test_addr)
+        test = test_list[0] if len(test_list) == 1 else f"anyof( {' , '.join(test_list)} )"
+        line_list.append(f'{indent}if {test} {{ fileinto "{mbox_path}"; stop; }}')
+    return line_list
+
+
+def sieve_code_domain_run(domain:str, rule_list:List[SieveRule], indent:str) -> List[str]:
+    "rules of single domain, guarded when run is long enough"
+    if len(rule_list) < sieve_group_min():
+        return sieve_code_rule_list(rule_list, indent)
+    inner = indent + "    "
+    body_list = list()
+    for define_subj, rule_group in itertools.groupby(rule_list, key=lambda rule: rule.define_subj):
+        rule_group = list(rule_group)
+        if define_subj and len(rule_group) >= sieve_group_min():
+            test_subj = f'header :contains {sieve_header_subj} "{define_subj}"'
+            body_list += sieve_code_block(test_subj, sieve_code_rule_list(rule_group, inner + "    ", True), inner)
+        else:
+            body_list += sieve_code_rule_list(rule_group, inner)
+    test_domain = f'address :domain :contains {sieve_header_addr} "{domain}"'
+    return sieve_code_block(test_domain, body_list, indent)
+
+
+def sieve_code_optimize(rule_list:List[SieveRule]) -> List[str]:
+    """
+    pre-dispatch rules by address domain and subject keyword:
+    * consecutive runs of same domain get domain guard
+    * consecutive domain runs are chunked behind domain list guard
+    * rule order is kept, so first match wins as in plain code
+    """
+    line_list = list()
+    chunk_list = list()  # pending (domain, rule_list)
+
+    def chunk_flush():
+        if len(chunk_list) < 2:
+            for domain, run_list in chunk_list:
+                line_list.extend(sieve_code_domain_run(domain, run_list, ""))
+        else:
+            body_list = list()
+            for domain, run_list in chunk_list:
+                body_list += sieve_code_domain_run(domain, run_list, "    ")
+            domain_list = sorted(set([domain for domain, _ in chunk_list]))
+            test_chunk = f'address :domain :contains {sieve_header_addr} {sieve_code_key_list(domain_list)}'
+            line_list.extend(sieve_code_block(test_chunk, body_list, ""))
+        chunk_list.clear()
+
+    for domain, run_list in itertools.groupby(rule_list, key=sieve_rule_domain):
+        run_list = list(run_list)
+        if domain is None:
+            chunk_flush()
+            line_list.extend(sieve_code_rule_list(run_list, ""))
+        else:
+            chunk_list.append((domain, run_list))
+            if len(chunk_list) >= sieve_group_chunk():
+                chunk_flush()
+    chunk_flush()
+    return line_list
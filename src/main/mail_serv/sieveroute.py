@@ -0,0 +1,255 @@
+"""
+In-process routing of generated sieve filters:
+* compile user routing rules into multi-pattern automaton (aho-corasick)
+* scan lowercased address and subject headers once per message
+* first matching rule in filter order wins, like 'fileinto; stop;'
+* one batched 'doveadm move' per target mailbox
+
+intended for bulk re-filter of large mailbox, where sieve-filter
+interprets every rule for every message;
+covers only system-generated routing rules, not user-authored sieve scripts
+"""
+
+import os
+import logging
+from email.parser import HeaderParser
+from email.header import decode_header, make_header
+from email.message import Message
+from email.utils import getaddresses
+from typing import Mapping, List, Set, Tuple, Iterator, Optional
+from mail_serv.user import user_list
+from mail_serv.command import doveadm
+from mail_serv.config import config_sieve_path
+from mail_serv.fanout import fanout_run, UserOutcome
+from mail_serv.support import fs_mkdir
+from mail_serv.sieve import SieveModel, SieveRule, sieve_build_model, \
+    sieve_read_mbox_list, sieve_persist_mbox_list, sieve_uid_set, \
+    sieve_worker_count, sieve_user_timeout
+
+logger = logging.getLogger(__name__)
+
+# headers of 'address' test, see sieve_header_addr
+sieveroute_header_addr = ["To", "CC", "From", "Sender", "Reply-To"]
+
+# headers of 'header' test, see sieve_header_subj
+sieveroute_header_subj = ["From", "Subject"]
+
+
+def sieveroute_fetch_chunk() -> int:
+    "messages per header fetch request"
+    return int(os.environ.get('SIEVEROUTE_FETCH_CHUNK', 5000))
+
+
+class PatternAutomaton():
+    "aho-corasick automaton: report every pattern contained in text"
+
+    goto_list:List[Mapping[str, int]]  # state -> char -> state
+    fail_list:List[int]  # state -> fallback state
+    emit_list:List[List[int]]  # state -> pattern index list
+
+    def __init__(self, pattern_list:List[str]):
+        self.goto_list = [dict()]
+        self.fail_list = [0]
+        self.emit_list = [list()]
+        for index, pattern in enumerate(pattern_list):
+            self.insert(index, pattern)
+        self.link()
+
+    def insert(self, index:int, pattern:str) -> None:
+        state = 0
+        for char in pattern:
+            if char not in self.goto_list[state]:
+                self.goto_list.append(dict())
+                self.fail_list.append(0)
+                self.emit_list.append(list())
+                self.goto_list[state][char] = len(self.goto_list) - 1
+            state = self.goto_list[state][char]
+        self.emit_list[state].append(index)
+
+    def link(self) -> None:
+        "breadth first fallback links, merge outputs of fallback states"
+        queue = list(self.goto_list[0].values())
+        for state in queue:
+            for char, target in self.goto_list[state].items():
+                queue.append(target)
+                fallback = self.fail_list[state]
+                while fallback and char not in self.goto_list[fallback]:
+                    fallback = self.fail_list[fallback]
+                fallback = self.goto_list[fallback].get(char, 0)
+                self.fail_list[target] = fallback
+                self.emit_list[target] = self.emit_list[target] + self.emit_list[self.fail_list[target]]
+
+    def search(self, text:str) -> Set[int]:
+        "indexes of patterns contained in text"
+        found_set = set()
+        goto_list = self.goto_list
+        fail_list = self.fail_list
+        emit_list = self.emit_list
+        state = 0
+        for char in text:
+            while state and char not in goto_list[state]:
+                state = fail_list[state]
+            state = goto_list[state].get(char, 0)
+            if emit_list[state]:
+                found_set.update(emit_list[state])
+        return found_set
+
+
+class SieveRouter():
+    "routing table of single user, rule order matches generated filters"
+
+    rule_list:List[SieveRule]
+    addr_key_list:List[str]  # distinct lowercased address keys
+    addr_rule_map:Mapping[int, List[int]]  # address key index -> rule indexes
+    subj_key_list:List[str]  # distinct lowercased subject keys
+    rule_subj_list:List[Optional[int]]  # rule index -> subject key index
+    addr_automaton:PatternAutomaton
+    subj_automaton:PatternAutomaton
+
+    def __init__(self, model:SieveModel):
+        self.rule_list = [
+            rule
+            for base_mbox in model.base_list
+            for rule in model.base_rule_list(base_mbox)
+        ]
+        addr_index_map = dict()
+        subj_index_map = dict()
+        self.addr_rule_map = dict()
+        self.rule_subj_list = list()
+        for rule_index, rule in enumerate(self.rule_list):
+            addr_key = rule.define_addr.lower()
+            addr_index = addr_index_map.setdefault(addr_key, len(addr_index_map))
+            self.addr_rule_map.setdefault(addr_index, []).append(rule_index)
+            if rule.define_subj:
+                subj_key = rule.define_subj.lower()
+                self.rule_subj_list.append(subj_index_map.setdefault(subj_key, len(subj_index_map)))
+            else:
+                self.rule_subj_list.append(None)
+        self.addr_key_list = list(addr_index_map.keys())
+        self.subj_key_list = list(subj_index_map.keys())
+        self.addr_automaton = PatternAutomaton(self.addr_key_list)
+        self.subj_automaton = PatternAutomaton(self.subj_key_list)
+
+    def route(self, header:Message) -> Optional[str]:
+        "target mailbox of first matching rule, None means keep"
+        addr_found = set()
+        for addr_text in sieveroute_address_list(header):
+            addr_found.update(self.addr_automaton.search(addr_text))
+        if not addr_found:
+            return None
+        rule_index_list = sorted([
+            rule_index
+            for addr_index in addr_found
+            for rule_index in self.addr_rule_map[addr_index]
+        ])
+        subj_found = None  # scan subject only when needed
+        for rule_index in rule_index_list:
+            subj_index = self.rule_subj_list[rule_index]
+            if subj_index is not None:
+                if subj_found is None:
+                    subj_found = set()
+                    for subj_text in sieveroute_subject_list(header):
+                        subj_found.update(self.subj_automaton.search(subj_text))
+                if subj_index not in subj_found:
+                    continue
+            return self.rule_list[rule_index].mbox_path
+        return None
+
+
+def sieveroute_decode(value:str) -> str:
+    "header value with rfc 2047 encoded words resolved"
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+
+def sieveroute_address_list(header:Message) -> List[str]:
+    "lowercased 'local@domain' of every address in address headers"
+    value_list = [
+        str(value)
+        for name in sieveroute_header_addr
+        for value in header.get_all(name, [])
+    ]
+    return [addr.lower() for _, addr in getaddresses(value_list) if addr]
+
+
+def sieveroute_subject_list(header:Message) -> List[str]:
+    "lowercased full values of subject test headers"
+    return [
+        sieveroute_decode(value).lower()
+        for name in sieveroute_header_subj
+        for value in header.get_all(name, [])
+    ]
+
+
+def sieveroute_model(user:str) -> SieveModel:
+    "routing rules from mailbox list of last filter build"
+    mbox_list_file = f"{config_sieve_path(user)}/sys/a_mailbox_list.txt"
+    if not os.path.isfile(mbox_list_file):
+        fs_mkdir(os.path.dirname(mbox_list_file))
+        sieve_persist_mbox_list(user, mbox_list_file)
+    return sieve_build_model(sieve_read_mbox_list(mbox_list_file))
+
+
+def sieveroute_parse_fetch(text:str) -> Iterator[Tuple[int, Message]]:
+    """
+    parse 'doveadm fetch uid hdr' default pager format:
+    records separated by form feed, 'uid: N' line, then 'hdr:' and header block
+    """
+    parser = HeaderParser()
+    for record in text.split('\f'):
+        record = record.lstrip('\n')
+        if not record.startswith('uid:'):
+            continue
+        uid_line, _, header_text = record.partition('\n')
+        if header_text.startswith('hdr:'):
+            header_text = header_text[len('hdr:'):].lstrip(' ').lstrip('\n')
+        yield (int(uid_line[len('uid:'):].strip()), parser.parsestr(header_text))
+
+
+def sieveroute_fetch_header(user:str, mbox:str) -> Iterator[Tuple[int, Message]]:
+    "headers of every message, fetched in uid chunks"
+    text = doveadm('-f', 'tab', 'fetch', '-u', user, 'uid', 'mailbox', mbox, 'all')
+    uid_list = sorted([int(line) for line in text.splitlines()[1:] if line.strip()])
+    chunk = sieveroute_fetch_chunk()
+    for index in range(0, len(uid_list), chunk):
+        uid_set = sieve_uid_set(uid_list[index:index + chunk])
+        yield from sieveroute_parse_fetch(
+            doveadm('fetch', '-u', user, 'uid hdr', 'mailbox', mbox, 'uid', uid_set)
+        )
+
+
+def sieveroute_plan(router:SieveRouter, header_iter:Iterator[Tuple[int, Message]]) -> Mapping[str, List[int]]:
+    "target mailbox -> message uids, kept messages are omitted"
+    route_map = dict()
+    for uid, header in header_iter:
+        target = router.route(header)
+        if target:
+            route_map.setdefault(target, []).append(uid)
+    return route_map
+
+
+def sieveroute_apply(user:str, mbox:str, route_map:Mapping[str, List[int]]) -> None:
+    "single move per target mailbox"
+    for target, uid_list in route_map.items():
+        logger.debug(f"sieve route: {user} {mbox} -> {target} count={len(uid_list)}")
+        doveadm('move', '-u', user, target, 'mailbox', mbox, 'uid', sieve_uid_set(uid_list))
+
+
+def sieveroute_refilter_user(user:str, mbox:str='INBOX') -> Mapping[str, int]:
+    "route every message of mailbox by generated rules, report moved count per target"
+    router = SieveRouter(sieveroute_model(user))
+    if not router.rule_list:
+        return dict()
+    route_map = sieveroute_plan(router, sieveroute_fetch_header(user, mbox))
+    sieveroute_apply(user, mbox, route_map)
+    return dict([(target, len(uid_list)) for target, uid_list in route_map.items()])
+
+
+def sieveroute_refilter_all() -> List[UserOutcome]:
+    "route inbox of all users"
+    return fanout_run(
+        'sieve-route', sieveroute_refilter_user, user_list(),
+        sieve_worker_count(), sieve_user_timeout(),
+    )
@@ -4,7 +4,9 @@ Support functions
 
 import os
 import stat
+import json
 import time
+import fcntl
 import shutil
 import logging
 import functools
@@ -188,6 +190,39 @@ def fs_size(root_path:str) -> int:
     return path_size
 
 
+def fs_persist_json(path:str, data:Any) -> None:
+    "write json document atomically via temporary file and rename"
+    fs_mkdir(os.path.dirname(path))
+    work_path = f"{path}.work"
+    with open(work_path, "w") as work_file:
+        json.dump(data, work_file, indent=1, sort_keys=True)
+    os.replace(work_path, path)
+
+
+def fs_restore_json(path:str, default:Any=None) -> Any:
+    "read json document, use default when missing or damaged"
+    try:
+        with open(path, "r") as data_file:
+            return json.load(data_file)
+    except FileNotFoundError:
+        return default
+    except Exception as error:
+        logger.warn(f"failure: {path} :: {error}")
+        return default
+
+
+@contextmanager
+def fs_lock_file(path:str):
+    "exclusive inter-process lock on a lock file"
+    fs_mkdir(os.path.dirname(path))
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def fs_mask() -> int:
     "extract current umask"
     mask = os.umask(0)
@@ -200,12 +235,12 @@ def report_time(func:Callable) -> Any:
 
     @functools.wraps(func)
     def with_time(*args, **kwargs):
-        time_start = time.time()
+        time_start = time.perf_counter()
         result = func(*args, **kwargs)
-        time_finish = time.time()
-        time_diff = int(time_finish - time_start)
+        time_finish = time.perf_counter()
+        time_diff = time_finish - time_start
         func_name = func.__name__
-        logger.debug(f"{func_name} @ {time_diff} sec")
+        logger.debug(f"{func_name} @ {time_diff:.3f} sec")
         return result
 
     return with_time
@@ -19,13 +19,19 @@ from collections import defaultdict
 
 from mail_serv.config import config_syncer_pipe
 from mail_serv.sieve import sieve_build_user, sieve_invoke_user
-from mail_serv.tinker import tinker_node_iterate
-from mail_serv.replicate import replicate_with_guid
+from mail_serv.tinker import tinker_registry_watch
+from mail_serv.dispatch import dispatch_instance
+from mail_serv.planner import planner_instance
+from mail_serv.metrics import metrics_persist
+from mail_serv.dsyncstat import dsyncstat_persist_report
 from mail_serv.support import parse_conf_text, count_dict_list
 from mail_serv.support import fs_mkdir, fs_rmany, fs_chmod, fs_chown
 from mail_serv.profiler import profiler_interval, profiler_enable, profiler_report_file
 from mail_serv.profiler import SystemProfiler, update_stat_tree, render_stat_tree
 from mail_serv.procname import procname_set
+from mail_serv.activity import activity_record
+from mail_serv.echo import echo_task_collapse, echo_tracker
+from mail_serv.freshness import freshness_record_change
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +48,8 @@ def syncer_service():
     logger.info(f"startup")
     syncer_setup_consumer()
     syncer_setup_profiler()
+    tinker_registry_watch()
+    dispatch_instance()  # drain persisted backlog
     pipe_path = config_syncer_pipe()
     event_reactor = syncer_event_reactor
     syncer_make_pipe(pipe_path)
@@ -220,7 +228,10 @@ def syncer_process_events(event_list: List[str]) -> None:
 
     sieve_build_set = set()  # set of user_name
     sieve_invoke_map = defaultdict(set)  # map: user_name -> set of mbox_name
+    replicate_change_map = defaultdict(set)  # map: user_name -> set of mbox_guid
     replicate_task_map = defaultdict(set)  # map: user_name -> set of mbox_guid
+    activity_count_map = defaultdict(int)  # map: user_name -> event count
+    echo_count = 0  # replication tasks covered by local dsync
 
     regex_change = syncer_regex_change()
     regex_define = syncer_regex_define()
@@ -234,6 +245,8 @@ def syncer_process_events(event_list: List[str]) -> None:
         user_name = conf_dict['user_name']
         mbox_name = conf_dict['mbox_name']
         mbox_guid = conf_dict['mbox_guid']
+        # collect user activity for keeper priority
+        activity_count_map[user_name] += 1
         # collect sieve biuld request
         if regex_change.match(chng_type) and regex_define.match(mbox_name):
             sieve_build_set.add(user_name)
@@ -242,6 +255,17 @@ def syncer_process_events(event_list: List[str]) -> None:
             sieve_invoke_map[user_name].add(mbox_name)
         # collect mailbox replicate request
         if regex_replicate.match(mbox_name):
+            replicate_change_map[user_name].add(mbox_guid)
+
+    # collapse tasks covered by local dsync, once per mailbox
+    for user_name, mbox_guid_set in replicate_change_map.items():
+        for mbox_guid in mbox_guid_set:
+            try:
+                if echo_task_collapse(user_name, mbox_guid):
+                    echo_count += 1
+                    continue
+            except Exception as error:
+                logger.warn(f"echo failure: {user_name} :: {error}")
             replicate_task_map[user_name].add(mbox_guid)
 
     logger.debug(
@@ -250,8 +274,17 @@ def syncer_process_events(event_list: List[str]) -> None:
         f"filter_build={len(sieve_build_set)} "
         f"filter_invoke={count_dict_list(sieve_invoke_map)} "
         f"replicate_task={count_dict_list(replicate_task_map)} "
+        f"echo_collapse={echo_count} "
     )
 
+    echo_tracker().prune()
+
+    # report user activity
+    try:
+        activity_record(activity_count_map)
+    except Exception as error:
+        logger.warn(f"activity record failure: {error}")
+
     # build sieve filter
     for user_name in sieve_build_set:
         try:
@@ -267,16 +300,17 @@ def syncer_process_events(event_list: List[str]) -> None:
             except Exception as error:
                 logger.warn(f"sieve invoke failure: {user_name} :: {error}")
 
-    # replicate user mailbox
-    for user_name, guid_list in replicate_task_map.items():
-        for mbox_guid in guid_list:
+    # remember local changes for replication lag tracking, including collapsed ones
+    for user_name, mbox_guid_set in replicate_change_map.items():
+        try:
+            freshness_record_change(user_name, sorted(mbox_guid_set))
+        except Exception as error:
+            logger.warn(f"freshness failure: {user_name} :: {error}")
 
-            def syncer_replicate(node_addr, node_port):
-                func_info = f"{user_name}/{mbox_guid} {node_addr}:{node_port}"
-                try:
-                    logger.debug(func_info)
-                    replicate_with_guid(user_name, mbox_guid, node_addr, node_port)
-                except Exception as error:
-                    logger.warn(f"failure: {func_info} :: {error}")
+    # replicate user mailbox via per-peer queues
+    dispatcher = dispatch_instance()
+    for user_name, mbox_guid in planner_instance().plan(replicate_task_map):
+        dispatcher.submit(user_name, mbox_guid)
 
-            tinker_node_iterate(syncer_replicate)
+    metrics_persist('syncer-service')
+    dsyncstat_persist_report('syncer-service')
@@ -0,0 +1,63 @@
+"""
+Stateful dsync state store:
+* keep state string returned by 'doveadm sync -s' per user and destination
+* scope is '*' for whole user sync, mailbox guid or 'mbox:<name>' otherwise
+
+store layout: <syncstate_dir>/<domain>/<person>.json
+{ "tcp:addr:port": { "*": "state", "<guid>": "state" } }
+"""
+
+import os
+import logging
+import threading
+from typing import Mapping
+from mail_serv.user import user_path
+from mail_serv.support import fs_persist_json, fs_restore_json
+
+logger = logging.getLogger(__name__)
+
+# serialize read-modify-write of user state files
+syncstate_lock = threading.Lock()
+
+
+def syncstate_dir() -> str:
+    "dsync state storage folder"
+    return os.environ.get('SYNCSTATE_DIR', '/var/lib/mail_serv/syncstate')
+
+
+def syncstate_file(user:str) -> str:
+    "dsync state file of single user"
+    return f"{syncstate_dir()}/{user_path(user)}.json"
+
+
+def syncstate_load(user:str) -> Mapping[str, Mapping[str, str]]:
+    "all destination states of a user"
+    return fs_restore_json(syncstate_file(user), dict())
+
+
+def syncstate_get(user:str, destination:str, scope:str) -> str:
+    "previous state or empty string for initial full sync"
+    with syncstate_lock:
+        state_dict = syncstate_load(user)
+    return state_dict.get(destination, dict()).get(scope, "")
+
+
+def syncstate_put(user:str, destination:str, scope:str, state:str) -> None:
+    "remember state for next incremental sync"
+    with syncstate_lock:
+        state_dict = syncstate_load(user)
+        state_dict.setdefault(destination, dict())[scope] = state
+        fs_persist_json(syncstate_file(user), state_dict)
+
+
+def syncstate_drop(user:str, destination:str, scope:str=None) -> None:
+    "forget state of scope, or of the whole destination"
+    with syncstate_lock:
+        state_dict = syncstate_load(user)
+        if destination not in state_dict:
+            return
+        if scope is None:
+            del state_dict[destination]
+        else:
+            state_dict[destination].pop(scope, None)
+        fs_persist_json(syncstate_file(user), state_dict)
@@ -0,0 +1,149 @@
+"""
+Per-step timing collector:
+* measure user processing steps with perf_counter precision
+* aggregate p50/p95/max per step and the slowest users per run
+* append run report as json line
+"""
+
+import os
+import json
+import math
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Mapping, List, Any
+from mail_serv.support import fs_mkdir
+
+logger = logging.getLogger(__name__)
+
+
+def timing_report_dir() -> str:
+    "timing report output folder"
+    return os.environ.get('TIMING_REPORT_DIR', '/var/lib/mail_serv/timing')
+
+
+def timing_report_file(session:str) -> str:
+    "timing report json lines file"
+    return f"{timing_report_dir()}/{session}.jsonl"
+
+
+def timing_slowest_count() -> int:
+    "number of slowest users in run report"
+    return int(os.environ.get('TIMING_SLOWEST_COUNT', 10))
+
+
+def timing_percentile(value_list:List[float], percent:float) -> float:
+    "nearest rank percentile of sorted value list"
+    if not value_list:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(value_list)) - 1
+    rank = min(max(rank, 0), len(value_list) - 1)
+    return value_list[rank]
+
+
+class TimingCollector():
+    "thread safe step timing accumulator for a single run"
+
+    session:str
+    run_id:str
+    time_start:float  # epoch
+    clock_start:float  # perf_counter
+    step_map:Mapping[str, List[float]]  # step -> durations
+    user_map:Mapping[str, Mapping[str, float]]  # user -> step -> duration
+    collector_lock:threading.Lock
+
+    def __init__(self, session:str):
+        self.session = session
+        self.run_id = uuid.uuid4().hex
+        self.time_start = time.time()
+        self.clock_start = time.perf_counter()
+        self.step_map = dict()
+        self.user_map = dict()
+        self.collector_lock = threading.Lock()
+
+    def record(self, user_name:str, step:str, duration:float) -> None:
+        with self.collector_lock:
+            self.step_map.setdefault(step, list()).append(duration)
+            user_step = self.user_map.setdefault(user_name, dict())
+            user_step[step] = user_step.get(step, 0) + duration
+
+    @contextmanager
+    def measure(self, user_name:str, step:str):
+        "record duration of enclosed code, also on failure"
+        clock_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(user_name, step, time.perf_counter() - clock_start)
+
+    def render_report(self) -> Mapping[str, Any]:
+        "produce run summary"
+        with self.collector_lock:
+            step_report = dict()
+            for step, duration_list in self.step_map.items():
+                duration_list = sorted(duration_list)
+                step_report[step] = dict(
+                    count=len(duration_list),
+                    total=round(sum(duration_list), 6),
+                    p50=round(timing_percentile(duration_list, 50), 6),
+                    p95=round(timing_percentile(duration_list, 95), 6),
+                    max=round(duration_list[-1], 6),
+                )
+            user_total_list = [
+                (user_name, user_step.get('total', sum(user_step.values())))
+                for user_name, user_step in self.user_map.items()
+            ]
+        user_total_list.sort(key=lambda entry:-entry[1])
+        slowest_user = [
+            dict(user=user_name, time=round(user_time, 6))
+            for user_name, user_time in user_total_list[:timing_slowest_count()]
+        ]
+        return dict(
+            session=self.session,
+            run_id=self.run_id,
+            time_start=self.time_start,
+            time_spent=round(time.perf_counter() - self.clock_start, 6),
+            user_count=len(user_total_list),
+            step=step_report,
+            slowest_user=slowest_user,
+        )
+
+    def persist_report(self) -> None:
+        "append run summary to json lines report"
+        report = self.render_report()
+        fs_mkdir(timing_report_dir())
+        with open(timing_report_file(self.session), "a") as report_text:
+            report_text.write(json.dumps(report, sort_keys=True) + "\n")
+
+
+# collector of current run, shared by worker threads
+timing_collector_active:TimingCollector = None
+
+
+@contextmanager
+def timing_session(session:str):
+    "collect step timing during enclosed run, then persist report"
+    global timing_collector_active
+    collector = TimingCollector(session)
+    timing_collector_active = collector
+    try:
+        yield collector
+    finally:
+        timing_collector_active = None
+        try:
+            collector.persist_report()
+        except Exception as error:
+            logger.warn(f"report failure: {error}")
+
+
+@contextmanager
+def timing_measure(user_name:str, step:str):
+    "record step duration in active run, no-op outside of session"
+    collector = timing_collector_active
+    if collector is None:
+        yield
+    else:
+        with collector.measure(user_name, step):
+            yield
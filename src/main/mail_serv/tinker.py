@@ -7,16 +7,32 @@ note on naming:
 * 'host' means own declared node from /etc/tinc/mail/tinc.conf
 * 'hosts' means configured nodes from /etc/tinc/mail/hosts/<host>
 * 'nodes' means discovered nodes from /etc/tinc/mail/nodes/<node>
+
+replication topology:
+* 'mesh' replicates every user to every live node
+* 'ring' replicates user only to k replica peers from consistent hash ring:
+  user home set is k nodes following user hash on the ring, self included;
+  home node syncs to the rest of home set, other nodes sync to whole home set;
+  since dsync is two-way, other nodes converge through home set on keeper pass
 """
 
 import os
+import time
 import shlex
+import bisect
+import hashlib
 import logging
+import threading
+import functools
+import inotify.adapters
+import inotify.constants
 from datetime import datetime
-from typing import Mapping, List, Callable
+from dataclasses import dataclass
+from typing import Mapping, List, Tuple, Callable
 from mail_serv.support import parse_conf_file
 from mail_serv.command import shell
 from mail_serv.config import config_doveadm_port
+from mail_serv.prober import prober_enable, prober_instance
 
 logger = logging.getLogger(__name__)
 
@@ -130,14 +146,251 @@ def tinker_node_list() -> List[str]:
     return node_list
 
 
-def tinker_node_iterate(node_func:Callable) -> None:
-    "apply function on live node list"
-    node_list = tinker_node_list()
-    logger.debug(f"node_list: {node_list}")
-    for node_name in node_list:
-        conf_dict = tinker_node_conf(node_name)
-        node_addr = conf_dict['node_addr']  # from up/down script
-        node_port = config_doveadm_port()
+def tinker_topology() -> str:
+    "replication topology: mesh or ring"
+    return os.environ.get('TINKER_TOPOLOGY', 'mesh')
+
+
+def tinker_ring_replica() -> int:
+    "replica peers per user in ring topology"
+    return max(1, int(os.environ.get('TINKER_RING_REPLICA', 2)))
+
+
+def tinker_ring_vnode() -> int:
+    "virtual points per node on hash ring, evens out user spread"
+    return max(1, int(os.environ.get('TINKER_RING_VNODE', 64)))
+
+
+def tinker_ring_hash(key:str) -> int:
+    "stable across processes and hosts, unlike builtin hash"
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing():
+    """
+    consistent hash ring over node names:
+    node join or leave moves only users adjacent to its points
+    """
+
+    point_list:List[int]  # sorted ring positions
+    owner_list:List[str]  # node name per position
+    node_count:int
+
+    def __init__(self, name_tuple:Tuple[str, ...], vnode_count:int):
+        entry_list = sorted([
+            (tinker_ring_hash(f"{name}#{index}"), name)
+            for name in set(name_tuple) for index in range(vnode_count)
+        ])
+        self.point_list = [point for point, _ in entry_list]
+        self.owner_list = [name for _, name in entry_list]
+        self.node_count = len(set(name_tuple))
+
+    def replica_list(self, key:str, count:int) -> List[str]:
+        "first distinct nodes clockwise from key position"
+        count = min(count, self.node_count)
+        replica_list = list()
+        if not count:
+            return replica_list
+        index = bisect.bisect(self.point_list, tinker_ring_hash(key))
+        total = len(self.point_list)
+        while len(replica_list) < count:
+            name = self.owner_list[index % total]
+            if name not in replica_list:
+                replica_list.append(name)
+            index += 1
+        return replica_list
+
+
+@functools.lru_cache(maxsize=8)
+def tinker_ring(name_tuple:Tuple[str, ...], vnode_count:int) -> HashRing:
+    "ring per node set, rebuilt only on subnet up/down"
+    return HashRing(name_tuple, vnode_count)
+
+
+def tinker_user_peer_list(user:str, host_name:str, node_name_list:List[str]) -> List[str]:
+    "replica peers of a user among active node names"
+    if tinker_topology() != 'ring' or not host_name:
+        return list(node_name_list)
+    name_tuple = tuple(sorted(set(node_name_list) | {host_name}))
+    ring = tinker_ring(name_tuple, tinker_ring_vnode())
+    home_list = ring.replica_list(user, tinker_ring_replica())
+    return [name for name in node_name_list if name in home_list and name != host_name]
+
+
+def tinker_node_probe(node_entry_list:List[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+    "drop nodes which fail liveness probe or have open circuit"
+    if not prober_enable():
+        return node_entry_list
+    target_list = [(node_addr, int(node_port)) for _, node_addr, node_port in node_entry_list]
+    live_set = set(prober_instance().live_list(target_list))
+    live_list = list()
+    for node_entry in node_entry_list:
+        node_name, node_addr, node_port = node_entry
+        if (node_addr, int(node_port)) in live_set:
+            live_list.append(node_entry)
+        else:
+            logger.debug(f"skip node: {node_name} {node_addr}:{node_port}")
+    return live_list
+
+
+@dataclass(frozen=True)
+class NodeEntry:
+    "immutable view of active node"
+
+    name:str
+    addr:str  # from up/down script
+    port:str  # doveadm port
+    up_since:str  # iso time from up script
+
+
+class NodeRegistry():
+    """
+    in-memory active node registry:
+    * refreshed by inotify events on nodes/ when watcher thread runs
+    * otherwise refreshed on cheap nodes/ listing fingerprint change
+    """
+
+    node_tuple:Tuple[NodeEntry, ...]
+    node_print:Tuple
+    host_name:str  # self node, for ring placement
+    watch_active:bool
+    registry_lock:threading.Lock
+    listener_list:List[Callable]
+
+    def __init__(self):
+        self.node_tuple = tuple()
+        self.node_print = None
+        self.host_name = None
+        self.watch_active = False
+        self.registry_lock = threading.Lock()
+        self.listener_list = list()
+
+    def listen(self, listener:Callable) -> None:
+        "invoke listener(node_tuple) after each node set change"
+        self.listener_list.append(listener)
+
+    def fingerprint(self) -> Tuple:
+        "identity of nodes/ content without parsing node files"
+        node_dir = tinker_node_dir()
+        if not os.path.isdir(node_dir):
+            return (node_dir,)
+        entry_list = [
+            (entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(node_dir)
+        ]
+        entry_list.sort()
+        return (node_dir, tuple(entry_list))
+
+    def refresh(self) -> None:
+        "rebuild node snapshot from nodes/"
+        node_print = self.fingerprint()
+        node_list = tinker_node_list()
+        node_port = config_doveadm_port() if node_list else None
+        entry_list = list()
+        for node_name in node_list:
+            try:
+                conf_dict = tinker_node_conf(node_name)
+                entry_list.append(NodeEntry(
+                    name=node_name,
+                    addr=conf_dict['node_addr'],
+                    port=node_port,
+                    up_since=conf_dict.get('node_time', None),
+                ))
+            except Exception as error:  # file is being written
+                logger.warn(f"wrong node: {node_name} :: {error}")
+        node_tuple = tuple(entry_list)
+        host_name = tinker_host_name() if node_list else self.host_name
+        with self.registry_lock:
+            has_change = node_tuple != self.node_tuple
+            self.node_tuple = node_tuple
+            self.node_print = node_print
+            self.host_name = host_name
+        logger.debug(f"node_list: {[entry.name for entry in entry_list]}")
+        if has_change:
+            for listener in self.listener_list:
+                try:
+                    listener(node_tuple)
+                except Exception as error:
+                    logger.warn(f"listener failure: {error}")
+
+    def snapshot(self) -> Tuple[NodeEntry, ...]:
+        "current immutable node list"
+        if not self.watch_active and self.fingerprint() != self.node_print:
+            self.refresh()
+        return self.node_tuple
+
+    def user_snapshot(self, user:str) -> Tuple[NodeEntry, ...]:
+        "active replica peers of a user in configured topology"
+        node_tuple = self.snapshot()
+        peer_list = tinker_user_peer_list(user, self.host_name, [entry.name for entry in node_tuple])
+        return tuple(entry for entry in node_tuple if entry.name in peer_list)
+
+    def node_entry(self, node_name:str) -> NodeEntry:
+        "active node by name, None when node is down"
+        for entry in self.snapshot():
+            if entry.name == node_name:
+                return entry
+        return None
+
+    def watch_start(self) -> None:
+        "ensure inotify watcher thread"
+        self.watch_active = True
+        threading.Thread(
+            name='tinker-registry',
+            daemon=True,
+            target=self.watch_task,
+        ).start()
+
+    def watch_task(self) -> None:
+        "refresh snapshot on nodes/ changes made by subnet up/down scripts"
+        event_mask = (
+            inotify.constants.IN_CREATE | inotify.constants.IN_DELETE |
+            inotify.constants.IN_CLOSE_WRITE | inotify.constants.IN_MOVED_TO |
+            inotify.constants.IN_MOVED_FROM | inotify.constants.IN_DELETE_SELF
+        )
+        while True:
+            try:
+                node_dir = tinker_node_dir()
+                if not os.path.isdir(node_dir):  # removed by tinc-down
+                    if self.node_tuple:
+                        self.refresh()
+                    time.sleep(1)
+                    continue
+                notify = inotify.adapters.Inotify()
+                notify.add_watch(node_dir, event_mask)
+                self.refresh()  # watch is in place, no event is lost
+                for event in notify.event_gen(yield_nones=True):
+                    if event is None:  # idle period
+                        if not os.path.isdir(node_dir):
+                            break
+                        continue
+                    _, type_names, _, _ = event
+                    if 'IN_DELETE_SELF' in type_names or 'IN_IGNORED' in type_names:
+                        break
+                    self.refresh()
+            except Exception as error:
+                logger.warn(f"failure: {error}")
+                time.sleep(1)  # prevent error spin
+
+
+@functools.lru_cache(maxsize=1)
+def tinker_registry() -> NodeRegistry:
+    "process wide node registry"
+    return NodeRegistry()
+
+
+def tinker_registry_watch() -> None:
+    "activate inotify refresh for long running services"
+    tinker_registry().watch_start()
+
+
+def tinker_node_iterate(node_func:Callable, user_name:str=None) -> None:
+    "apply function on live node list, or on live replica peers of a user"
+    registry = tinker_registry()
+    node_tuple = registry.user_snapshot(user_name) if user_name else registry.snapshot()
+    node_entry_list = [
+        (entry.name, entry.addr, entry.port) for entry in node_tuple
+    ]
+    for node_name, node_addr, node_port in tinker_node_probe(node_entry_list):
         func_name = node_func.__name__
         func_info = f"{func_name} :: {node_name} {node_addr}:{node_port}"
         try:
@@ -0,0 +1,126 @@
+"""
+Per-user replication mutex:
+* in-process lock serializes dispatch workers and keeper threads
+* lock file serializes syncer and keeper processes on the same host
+* bounded wait, caller requeues on timeout instead of racing dsync user lock
+* count contention: waits and timeouts, per scope: process/host
+* optional lock kind separates other per-user activities, i.e. sieve build/filter
+"""
+
+import os
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Mapping
+from mail_serv.user import user_path
+from mail_serv.support import fs_mkdir
+from mail_serv.metrics import metrics_count
+
+logger = logging.getLogger(__name__)
+
+
+def userlock_dir() -> str:
+    "per-user lock file folder"
+    return os.environ.get('USERLOCK_DIR', '/run/mail_serv/userlock')
+
+
+def userlock_wait() -> float:
+    "maximum wait for user mutex, seconds"
+    return float(os.environ.get('USERLOCK_WAIT', 30.0))
+
+
+def userlock_file(user:str, kind:str=None) -> str:
+    "lock file of single user, kind separates independent activities"
+    suffix = f"{kind}.lock" if kind else "lock"
+    return f"{userlock_dir()}/{user_path(user)}.{suffix}"
+
+
+class UserLockBusy(TimeoutError):
+    "user mutex not obtained within wait time"
+
+
+class UserLockTable():
+    "in-process user locks, entries live while in use"
+
+    lock_map:Mapping[str, threading.Lock]
+    usage_map:Mapping[str, int]
+    table_lock:threading.Lock
+
+    def __init__(self):
+        self.lock_map = dict()
+        self.usage_map = dict()
+        self.table_lock = threading.Lock()
+
+    def obtain(self, user:str) -> threading.Lock:
+        with self.table_lock:
+            if user not in self.lock_map:
+                self.lock_map[user] = threading.Lock()
+            self.usage_map[user] = self.usage_map.get(user, 0) + 1
+            return self.lock_map[user]
+
+    def release(self, user:str) -> None:
+        with self.table_lock:
+            count = self.usage_map[user] - 1
+            if count > 0:
+                self.usage_map[user] = count
+            else:
+                del self.usage_map[user]
+                del self.lock_map[user]
+
+
+userlock_table = UserLockTable()
+
+
+def userlock_try(lock_file) -> bool:
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def userlock_flock(lock_file, time_limit:float) -> bool:
+    "poll non-blocking file lock until monotonic time limit"
+    delay = 0.01
+    while True:
+        if userlock_try(lock_file):
+            return True
+        time_left = time_limit - time.monotonic()
+        if time_left <= 0:
+            return False
+        time.sleep(min(delay, time_left))
+        delay = min(delay * 2, 0.5)
+
+
+@contextmanager
+def userlock_hold(user:str, wait:float=None, kind:str=None):
+    "hold user mutex for enclosed replication or other kind, raise UserLockBusy on timeout"
+    wait = userlock_wait() if wait is None else wait
+    time_limit = time.monotonic() + wait
+    entry = f"{kind}:{user}" if kind else user
+    thread_lock = userlock_table.obtain(entry)
+    try:
+        if not thread_lock.acquire(blocking=False):
+            metrics_count('userlock_wait', scope='process')
+            if not thread_lock.acquire(timeout=wait):
+                metrics_count('userlock_busy', scope='process')
+                raise UserLockBusy(f"user busy in process: {user}")
+        try:
+            path = userlock_file(user, kind)
+            fs_mkdir(os.path.dirname(path))
+            with open(path, "a") as lock_file:
+                if not userlock_try(lock_file):
+                    metrics_count('userlock_wait', scope='host')
+                    if not userlock_flock(lock_file, time_limit):
+                        metrics_count('userlock_busy', scope='host')
+                        raise UserLockBusy(f"user busy on host: {user}")
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            thread_lock.release()
+    finally:
+        userlock_table.release(entry)
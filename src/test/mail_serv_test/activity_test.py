@@ -0,0 +1,22 @@
+
+from mail_serv_test import *
+from mail_serv.activity import *
+
+os.environ['ACTIVITY_LOG_DIR'] = f"{THIS_DIR}/tmp/activity"
+
+
+def test_activity_collect():
+    print()
+    activity_collect()  # drain past runs
+    activity_record(dict([('user-1@domain', 3), ('user-2@domain', 1)]), event_time=1000)
+    activity_record(dict([('user-1@domain', 2)]), event_time=2000)
+    activity_map = activity_collect()
+    print(activity_map)
+    assert activity_map['user-1@domain'] == [(1000, 3), (2000, 2)]
+    assert activity_map['user-2@domain'] == [(1000, 1)]
+    assert activity_collect() == dict()
+
+
+def test_activity_parse_line():
+    print()
+    assert activity_parse_line("123\tuser@domain\t7\n") == ('user@domain', 123, 7)
@@ -0,0 +1,38 @@
+
+from mail_serv_test import *
+from mail_serv.checkpoint import *
+
+os.environ['CHECKPOINT_DIR'] = f"{THIS_DIR}/tmp/checkpoint"
+
+
+def test_checkpoint_resume():
+    print()
+    session = 'tester-resume'
+    checkpoint = RunCheckpoint(session)
+    checkpoint.persist_header()
+    checkpoint.record_user('user-1@domain', dict(maintain='done', replicate='fail'))
+    checkpoint.record_user('user-2@domain', dict(maintain='done'))
+    checkpoint.record_user('user-3@domain', dict())  # keeper process error
+    with open(checkpoint_file(session), "a") as journal_text:
+        journal_text.write('{"user": "torn')  # interrupted write
+
+    resumed = checkpoint_begin(session)
+    assert resumed.run_id == checkpoint.run_id
+    assert resumed.user_done_set == set(['user-2@domain'])  # failed users are retried
+    assert resumed.user_step_map['user-1@domain']['replicate'] == 'fail'
+
+    resumed.record_finish()
+    fresh = checkpoint_begin(session)
+    assert fresh.run_id != checkpoint.run_id
+    assert fresh.user_done_set == set()
+
+
+def test_checkpoint_stale():
+    print()
+    session = 'tester-stale'
+    stale_time = checkpoint_stale_time()
+    checkpoint = RunCheckpoint(session, time_start=time.time() - 2 * stale_time)
+    checkpoint.persist_header()
+    assert checkpoint_restore(session).is_stale()
+    fresh = checkpoint_begin(session)
+    assert fresh.run_id != checkpoint.run_id
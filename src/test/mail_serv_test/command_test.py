@@ -0,0 +1,42 @@
+
+import time
+import subprocess
+from mail_serv_test import *
+from mail_serv.command import *
+from mail_serv.support import fs_rmany
+
+
+def test_doveconf_cache():
+    print()
+    cache_key = (dove_config_file(), '-h', 'cache_tester')
+    doveconf_cache_map[cache_key] = (time.monotonic(), 'cached')
+    assert doveconf('-h', 'cache_tester') == 'cached'
+    del doveconf_cache_map[cache_key]
+
+
+def test_shell_deadline():
+    print()
+    from mail_serv.process import process_deadline
+    pid_file = f"{THIS_DIR}/tmp/shell-deadline.pid"
+    fs_rmany(pid_file)
+    time_start = time.monotonic()
+    try:
+        with process_deadline(0.5):
+            shell(f"sh -c 'echo $$ > {pid_file}; exec sleep 30' | cat")
+        assert False, "expect timeout"
+    except subprocess.TimeoutExpired:
+        pass
+    assert time.monotonic() - time_start < 2
+    with open(pid_file, "r") as pid_text:
+        pid = int(pid_text.read())
+    for _ in range(20):  # pipeline member is killed, not only the shell
+        try:
+            with open(f"/proc/{pid}/stat", "r") as stat_text:
+                if stat_text.read().split(')')[-1].split()[0] == 'Z':
+                    break  # killed, not reaped yet
+            time.sleep(0.1)
+        except FileNotFoundError:
+            break
+    else:
+        assert False, f"pipeline survived: {pid}"
+    assert shell("echo hello | cat") == b"hello\n"
@@ -0,0 +1,169 @@
+
+from mail_serv_test import *
+from mail_serv import dispatch
+from mail_serv.dispatch import *
+from mail_serv.support import fs_rmany
+
+os.environ['DISPATCH_BACKLOG_DIR'] = f"{THIS_DIR}/tmp/dispatch"
+
+
+class RegistryStub():
+
+    def __init__(self, node_list):
+        self.node_list = node_list
+
+    def snapshot(self):
+        return tuple(NodeEntry(name, '127.0.0.1', '1234', None) for name in self.node_list)
+
+    def user_snapshot(self, user):
+        return self.snapshot()
+
+    def node_entry(self, node_name):
+        return NodeEntry(node_name, '127.0.0.1', '1234', None) if node_name in self.node_list else None
+
+
+def wait_until(condition, timeout=5.0):
+    time_start = time.monotonic()
+    while not condition():
+        assert time.monotonic() - time_start < timeout, "timeout"
+        time.sleep(0.01)
+
+
+def test_dispatch_coalesce():
+    print()
+    fs_rmany(dispatch_backlog_file('coalesce'))
+    peer = PeerQueue('coalesce', execute_func=None, worker_count=0)
+    peer.submit(ReplicateTask('user@domain', 'guid-1'))
+    peer.submit(ReplicateTask('user@domain', 'guid-1'))
+    peer.submit(ReplicateTask('user@domain', 'guid-2'))
+    peer.submit(ReplicateTask('other@domain', 'guid-3'))
+    assert len(peer.pending) == 3
+    peer.submit(ReplicateTask('user@domain'))  # subsumes guid tasks
+    assert list(peer.pending.keys()) == [
+        ReplicateTask('other@domain', 'guid-3'),
+        ReplicateTask('user@domain'),
+    ]
+    peer.submit(ReplicateTask('user@domain', 'guid-4'))
+    assert len(peer.pending) == 2
+
+
+def test_dispatch_retry_backlog(monkeypatch):
+    print()
+    monkeypatch.setenv('DISPATCH_RETRY_LIMIT', '2')
+    monkeypatch.setenv('DISPATCH_BACKOFF_BASE', '0.01')
+    registry = RegistryStub(['serv_2'])
+    monkeypatch.setattr(dispatch, 'tinker_registry', lambda: registry)
+    fs_rmany(dispatch_backlog_file('serv_2'))
+
+    attempt_list = list()
+    node_health = dict(alive=False)
+
+    def execute_func(node, task):
+        attempt_list.append(task)
+        if not node_health['alive']:
+            raise RuntimeError("node down")
+
+    dispatcher = ReplicateDispatcher(execute_func)
+    dispatcher.submit('user@domain', 'guid-1')
+    peer = dispatcher.peer_queue('serv_2')
+    wait_until(lambda: peer.report_size()['backlog'] == 1)
+    assert len(attempt_list) == 2
+    assert os.path.isfile(dispatch_backlog_file('serv_2'))
+
+    node_health['alive'] = True
+    dispatcher.node_change(registry.snapshot())  # node reappears
+    wait_until(lambda: peer.report_size() == dict(pending=0, active=0, backlog=0))
+    assert len(attempt_list) == 3
+    assert not os.path.isfile(dispatch_backlog_file('serv_2'))
+
+
+def test_dispatch_node_gone(monkeypatch):
+    print()
+    registry = RegistryStub(['serv_3'])
+    monkeypatch.setattr(dispatch, 'tinker_registry', lambda: registry)
+    fs_rmany(dispatch_backlog_file('serv_3'))
+
+    dispatcher = ReplicateDispatcher(lambda node, task: None)
+    registry.node_list = []  # node is down at execution time
+    dispatcher.peer_queue('serv_3').submit(ReplicateTask('user@domain'))
+    peer = dispatcher.peer_queue('serv_3')
+    wait_until(lambda: peer.report_size()['backlog'] == 1)
+    restored = PeerQueue('serv_3', execute_func=None, worker_count=0)
+    assert restored.backlog == set([ReplicateTask('user@domain')])
+
+
+def test_dispatch_tempfail_requeue(monkeypatch):
+    print()
+    monkeypatch.setenv('DISPATCH_RETRY_LIMIT', '2')
+    monkeypatch.setenv('DISPATCH_BACKOFF_BASE', '0.01')
+    registry = RegistryStub(['serv_4'])
+    monkeypatch.setattr(dispatch, 'tinker_registry', lambda: registry)
+    fs_rmany(dispatch_backlog_file('serv_4'))
+
+    attempt_list = list()
+
+    def execute_func(node, task):
+        attempt_list.append(task)
+        if len(attempt_list) <= 4:
+            raise ReplicateTempFail("user locked")
+
+    dispatcher = ReplicateDispatcher(execute_func)
+    dispatcher.submit('user@domain')
+    peer = dispatcher.peer_queue('serv_4')
+    wait_until(lambda: len(attempt_list) == 5 and peer.report_size() == dict(pending=0, active=0, backlog=0))
+    assert not os.path.isfile(dispatch_backlog_file('serv_4'))  # contention does not exhaust retries
+
+
+def test_dispatch_contention_limit(monkeypatch):
+    print()
+    monkeypatch.setenv('DISPATCH_RETRY_LIMIT', '2')
+    monkeypatch.setenv('DISPATCH_CONTENTION_LIMIT', '3')
+    monkeypatch.setenv('DISPATCH_BACKOFF_BASE', '0.01')
+    registry = RegistryStub(['serv_5'])
+    monkeypatch.setattr(dispatch, 'tinker_registry', lambda: registry)
+    fs_rmany(dispatch_backlog_file('serv_5'))
+
+    attempt_list = list()
+
+    def execute_func(node, task):
+        attempt_list.append(task)
+        raise ReplicateTempFail("user locked forever")
+
+    dispatcher = ReplicateDispatcher(execute_func)
+    dispatcher.submit('user@domain')
+    peer = dispatcher.peer_queue('serv_5')
+    wait_until(lambda: peer.report_size()['backlog'] == 1)
+    assert len(attempt_list) == 3 + 2  # contention limit, then retry limit
+
+
+def test_dispatch_backlog_drain(monkeypatch):
+    print()
+    monkeypatch.setenv('DISPATCH_RETRY_LIMIT', '1')
+    monkeypatch.setenv('DISPATCH_BACKLOG_PERIOD', '0.3')
+    registry = RegistryStub(['serv_6'])
+    monkeypatch.setattr(dispatch, 'tinker_registry', lambda: registry)
+    fs_rmany(dispatch_backlog_file('serv_6'))
+
+    attempt_list = list()
+    node_health = dict(alive=False)
+
+    def execute_func(node, task):
+        attempt_list.append(task)
+        if not node_health['alive']:
+            raise RuntimeError("node down")
+
+    dispatcher = ReplicateDispatcher(execute_func)
+    peer = dispatcher.peer_queue('serv_6')
+    dispatcher.submit('user@domain', 'guid-1')
+    wait_until(lambda: peer.report_size()['backlog'] == 1)
+    wait_until(lambda: len(attempt_list) == 2)  # periodic drain, node stays listed
+    wait_until(lambda: peer.report_size()['backlog'] == 1)
+
+    monkeypatch.setenv('DISPATCH_BACKLOG_PERIOD', '300')
+    with peer.condition:
+        peer.time_drain = time.monotonic() + 300
+    node_health['alive'] = True
+    dispatcher.submit('user@domain', 'guid-2')  # success drains backlog at once
+    wait_until(lambda: peer.report_size() == dict(pending=0, active=0, backlog=0))
+    assert attempt_list[-2:] == [ReplicateTask('user@domain', 'guid-2'), ReplicateTask('user@domain', 'guid-1')]
+    assert not os.path.isfile(dispatch_backlog_file('serv_6'))
@@ -0,0 +1,114 @@
+
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from mail_serv_test import *
+from mail_serv import diverge
+from mail_serv.diverge import *
+
+
+class DoveadmStandIn(BaseHTTPRequestHandler):
+    "answer 'mailboxStatus' like doveadm http api, from user summary table"
+
+    user_map = dict()
+    request_log = list()  # user list per request
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        request_list = json.loads(self.rfile.read(length))
+        self.request_log.append([parameters['user'] for _, parameters, _ in request_list])
+        response_list = list()
+        for command, parameters, tag in request_list:
+            user = parameters['user']
+            if command == 'mailboxStatus' and user in self.user_map:
+                response_list.append(['doveadmResponse', self.user_map[user], tag])
+            else:
+                response_list.append(['error', {'type': 'exitCode', 'exitCode': 67}, tag])
+        body = json.dumps(response_list).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def stand_in_server() -> HTTPServer:
+    server = HTTPServer(('127.0.0.1', 0), DoveadmStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_diverge_parse_table():
+    print()
+    text = "guid\thighestmodseq\tuidnext\tmessages\nguid-1\t10\t5\t4\nguid-2\t3\t2\t1\n"
+    assert diverge_parse_table(text) == {
+        'guid-1': ('10', '5', '4'),
+        'guid-2': ('3', '2', '1'),
+    }
+    assert diverge_parse_table("") == {}
+
+
+def test_diverge_compare():
+    print()
+    local = {'guid-1': ('10', '5', '4'), 'guid-2': ('3', '2', '1')}
+    assert diverge_compare(local, dict(local)) == []
+    assert diverge_compare(local, {'guid-1': ('10', '5', '4'), 'guid-2': ('4', '2', '1')}) == ['guid-2']
+    assert diverge_compare(local, {'guid-1': ('10', '5', '4')}) is None
+
+
+def test_diverge_guid_list(monkeypatch):
+    print()
+    server = stand_in_server()
+    try:
+        monkeypatch.setenv('DIVERGE_HTTP_PORT', str(server.server_port))
+        diverge_client.cache_clear()
+        DoveadmStandIn.user_map = {
+            'idle@domain': [
+                {'mailbox': 'INBOX', 'guid': 'guid-1', 'highestmodseq': 10, 'uidnext': 5, 'messages': 4},
+                {'mailbox': 'Sent', 'guid': 'guid-2', 'highestmodseq': 3, 'uidnext': 2, 'messages': 1},
+            ],
+        }
+        local_text = "guid\thighestmodseq\tuidnext\tmessages\nguid-1\t10\t5\t4\nguid-2\t3\t2\t1\n"
+        monkeypatch.setattr(diverge, 'doveadm', lambda *args: local_text)
+        assert diverge_guid_list('idle@domain', '127.0.0.1') == []
+        local_text = "guid\thighestmodseq\tuidnext\tmessages\nguid-1\t11\t6\t5\nguid-2\t3\t2\t1\n"
+        assert diverge_guid_list('idle@domain', '127.0.0.1') == ['guid-1']
+        assert diverge_guid_list('missing@domain', '127.0.0.1') is None
+        summary_list = diverge_remote_summary_list('127.0.0.1', ['missing@domain', 'idle@domain'])
+        assert summary_list[0] is None
+        assert summary_list[1]['guid-2'] == ('3', '2', '1')
+    finally:
+        server.shutdown()
+        diverge_client.cache_clear()
+
+
+def test_diverge_prefetch(monkeypatch):
+    print()
+    server = stand_in_server()
+    try:
+        monkeypatch.setenv('DIVERGE_HTTP_PORT', str(server.server_port))
+        diverge_client.cache_clear()
+        diverge_remote_cache().clear()
+        entry_list = [{'mailbox': 'INBOX', 'guid': 'guid-1', 'highestmodseq': 10, 'uidnext': 5, 'messages': 4}]
+        DoveadmStandIn.user_map = {'user-1@domain': entry_list, 'user-2@domain': entry_list}
+        DoveadmStandIn.request_log.clear()
+        local_text = "guid\thighestmodseq\tuidnext\tmessages\nguid-1\t11\t6\t5\n"
+        monkeypatch.setattr(diverge, 'doveadm', lambda *args: local_text)
+        diverge_prefetch('127.0.0.1', ['user-1@domain', 'user-2@domain', 'missing@domain'])
+        assert diverge_guid_list('user-1@domain', '127.0.0.1') == ['guid-1']
+        assert diverge_guid_list('user-2@domain', '127.0.0.1') == ['guid-1']
+        assert DoveadmStandIn.request_log == [['user-1@domain', 'user-2@domain', 'missing@domain']]
+        assert diverge_guid_list('user-1@domain', '127.0.0.1') == ['guid-1']  # prefetch used once
+        assert DoveadmStandIn.request_log[-1] == ['user-1@domain']
+
+        monkeypatch.setenv('DIVERGE_PREFETCH_AGE', '0')
+        diverge_prefetch('127.0.0.1', ['user-2@domain'])
+        time.sleep(0.01)
+        assert diverge_remote_cache().take('127.0.0.1', 'user-2@domain') is None  # too old
+    finally:
+        server.shutdown()
+        diverge_client.cache_clear()
+        diverge_remote_cache().clear()
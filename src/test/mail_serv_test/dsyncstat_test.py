@@ -0,0 +1,80 @@
+
+from mail_serv_test import *
+import json
+from mail_serv import dsyncstat
+from mail_serv.dsyncstat import *
+from mail_serv.metrics import metrics_instance
+
+dsync_stderr = """\
+dsync-local(user@domain): Debug: brain M: Local mailbox tree: INBOX guid=aaa
+dsync-local(user@domain): Debug: brain M: Import INBOX: Import change type=save GUID=m1 UID=5 hdr_hash= result=New mail
+dsync-local(user@domain): Debug: brain M: Import INBOX: Import change type=save GUID=m2 UID=6 hdr_hash= result=New mail
+dsync-local(user@domain): Debug: brain S: Import Sent: Import change type=expunge GUID=m3 UID=2 hdr_hash= result=Expunged
+dsync-local(user@domain): Debug: brain S: Import Sent: Import change type=flag_change GUID=m4 UID=3 hdr_hash= result=Changed
+"""
+
+
+def test_dsyncstat_parse():
+    print()
+    stat = dsyncstat_parse(dsync_stderr, 0, 1.5)
+    assert stat.mailbox == 2
+    assert stat.message_save == 2
+    assert stat.message_expunge == 1
+    assert stat.flag_change == 1
+    assert stat.failure_kind() == 'none'
+
+
+def test_dsyncstat_failure():
+    print()
+    stderr = dsync_stderr + "dsync-local(user@domain): Error: Couldn't lock /home/user/.dovecot-sync.lock: Timed out\n"
+    stat = dsyncstat_parse(stderr, 75, 3.0)
+    assert stat.failure_kind() == 'lock'
+    assert "Debug:" not in dsyncstat_error_text(stderr)
+    stat = dsyncstat_parse("Error: connect(1.2.3.4:12345) failed: Connection refused\n", 1, 0.1)
+    assert stat.failure_kind() == 'connect'
+
+
+def test_dsyncstat_record():
+    print()
+    stat = dsyncstat_parse(dsync_stderr, 0, 1.5)
+    dsyncstat_record('tcp:stat-node:1234', stat)
+    registry = metrics_instance()
+    assert registry.total('dsync_message_save', node='tcp:stat-node:1234') == 2
+    assert registry.total('dsync_message_save', user='stat-user@domain') == 0  # no per-user label
+    assert registry.total('dsync_seconds', node='tcp:stat-node:1234') == 1.5
+    assert registry.total('dsync_run', failure='none', node='tcp:stat-node:1234') == 1
+
+
+def test_dsyncstat_user_table(monkeypatch):
+    print()
+    monkeypatch.setenv('DSYNCSTAT_USER_LIMIT', '3')
+    monkeypatch.setenv('METRICS_REPORT_DIR', f"{THIS_DIR}/tmp/dsyncstat")
+    table = DsyncUserTable()
+    monkeypatch.setattr(dsyncstat, 'dsyncstat_user_table', lambda: table)
+    stat = dsyncstat_parse(dsync_stderr, 0, 1.5)
+    for index in range(5):
+        dsyncstat_record('tcp:stat-node:1234', stat, f"user-{index}@domain")
+    dsyncstat_record('tcp:stat-node:1234', dsyncstat_parse("", 1, 4.0), 'user-2@domain')
+    assert list(table.entry_map.keys()) == ['user-3@domain', 'user-4@domain', 'user-2@domain']  # oldest evicted
+    entry = table.entry('user-2@domain')
+    assert (entry.run, entry.failure, entry.duration, entry.message_save) == (2, 1, 5.5, 2)
+    assert list(table.report(top=1).keys()) == ['user-2@domain']
+
+    dsyncstat_persist_report('tester')
+    with open(dsyncstat_user_file('tester')) as report_file:
+        report = json.load(report_file)
+    assert report['user_count'] == 3
+    assert report['user']['user-2@domain']['duration'] == 5.5
+
+
+def test_dsyncstat_reader_limit(monkeypatch):
+    print()
+    monkeypatch.setenv('DSYNCSTAT_STDERR_LIMIT', '100')
+    reader = DsyncStatReader()
+    for _ in range(1000):
+        reader.line(dsync_stderr.splitlines(keepends=True)[1])
+        reader.line("dsync-local(user@domain): Error: something went wrong\n")
+    assert len(reader.error_text()) == 100
+    stat = reader.finish(1, 2.0)
+    assert stat.message_save == 1000
+    assert stat.failure_kind() == 'other'
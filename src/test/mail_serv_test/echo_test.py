@@ -0,0 +1,62 @@
+
+from mail_serv_test import *
+from mail_serv import echo
+from mail_serv.echo import *
+
+
+def test_echo_tracker():
+    print()
+    tracker = EchoTracker()
+    assert not tracker.is_echo('user@domain', 'guid-1')
+    with tracker.tracking('user@domain', 'guid-1'):
+        assert tracker.is_echo('user@domain', 'guid-1')
+        assert not tracker.is_echo('user@domain', 'guid-2')
+    assert tracker.is_echo('user@domain', 'guid-1')  # within window
+    with tracker.tracking('user@domain'):
+        assert tracker.is_echo('user@domain', 'guid-2')  # whole user sync
+    tracker.finish_map[('user@domain', 'guid-1')] -= 2 * echo_window()
+    tracker.finish_map[('user@domain', None)] -= 2 * echo_window()
+    assert not tracker.is_echo('user@domain', 'guid-1')
+    tracker.prune()
+    assert tracker.finish_map == dict()
+
+
+def test_echo_tracker_defer(monkeypatch):
+    print()
+    summary = dict([('guid-1', ('7', '10', '9'))])
+    monkeypatch.setattr(echo, 'echo_summary', lambda user: dict(summary))
+    tracker = EchoTracker()
+    release_list = list()
+    tracker.listen(lambda user, guid: release_list.append((user, guid)))
+    assert not tracker.defer('user@domain', 'guid-1')
+
+    with tracker.tracking('user@domain', 'guid-1'):  # successful sync: deferred task dropped
+        assert tracker.defer('user@domain', 'guid-1')
+    assert release_list == []
+    assert tracker.snapshot('user@domain', 'guid-1') == ('7', '10', '9')
+
+    try:
+        with tracker.tracking('user@domain'):  # failed sync: deferred task released
+            assert tracker.defer('user@domain', 'guid-2')
+            raise RuntimeError("dsync failure")
+    except RuntimeError:
+        pass
+    assert release_list == [('user@domain', 'guid-2')]
+    assert tracker.snapshot('user@domain', 'guid-2') is None
+
+
+def test_echo_task_collapse(monkeypatch):
+    print()
+    summary = dict([('guid-5', ('7', '10', '9'))])
+    monkeypatch.setattr(echo, 'echo_summary', lambda user: dict(summary))
+    tracker = echo_tracker()
+    tracker.listen(lambda user, guid: None)
+    with tracker.tracking('collapse@domain', 'guid-5'):
+        assert echo_task_collapse('collapse@domain', 'guid-5')  # deferred behind sync
+    assert echo_task_collapse('collapse@domain', 'guid-5')  # no newer change
+    summary['guid-5'] = ('8', '11', '10')
+    assert not echo_task_collapse('collapse@domain', 'guid-5')  # newer change
+    assert not echo_task_collapse('collapse@domain', 'guid-6')  # no local dsync
+    monkeypatch.setenv('ECHO_COLLAPSE', 'false')
+    summary['guid-5'] = ('7', '10', '9')
+    assert not echo_task_collapse('collapse@domain', 'guid-5')
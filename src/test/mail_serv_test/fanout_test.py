@@ -0,0 +1,42 @@
+
+import time
+import threading
+from mail_serv_test import *
+from mail_serv.fanout import *
+from mail_serv.process import execute_process_sert
+
+os.environ['TIMING_REPORT_DIR'] = f"{THIS_DIR}/tmp/timing"
+
+
+def test_fanout_run():
+    print()
+    active_count = 0
+    active_max = 0
+    active_lock = threading.Lock()
+
+    def user_func(user):
+        nonlocal active_count, active_max
+        with active_lock:
+            active_count += 1
+            active_max = max(active_max, active_count)
+        try:
+            if user == 'fail@domain':
+                raise RuntimeError("broken user")
+            if user == 'hang@domain':
+                execute_process_sert(['sleep', '5'])  # killed at deadline
+            time.sleep(0.05)
+        finally:
+            with active_lock:
+                active_count -= 1
+
+    user_list = [f"user-{index}@domain" for index in range(12)] + ['fail@domain', 'hang@domain']
+    time_start = time.monotonic()
+    outcome_list = fanout_run('fanout-test', user_func, user_list, worker_count=3, user_timeout=0.5)
+    assert time.monotonic() - time_start < 1.5  # hung child process killed
+    status_map = dict([(outcome.user, outcome.status) for outcome in outcome_list])
+    assert len(status_map) == len(user_list)
+    assert status_map['fail@domain'] == 'fail'
+    assert status_map['hang@domain'] == 'timeout'
+    assert list(status_map.values()).count('done') == 12
+    assert active_max <= 3
+    assert os.path.isfile(f"{THIS_DIR}/tmp/timing/fanout-test.jsonl")
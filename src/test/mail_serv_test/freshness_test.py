@@ -0,0 +1,98 @@
+
+import time
+from mail_serv_test import *
+from mail_serv.freshness import *
+from mail_serv.support import fs_rmany
+
+os.environ['FRESHNESS_DIR'] = f"{THIS_DIR}/tmp/freshness"
+
+
+def test_freshness_guid_sync():
+    print()
+    user = 'fresh-guid@domain'
+    destination = 'tcp:1.2.3.4:1234'
+    base = time.time()
+    fs_rmany(freshness_file(user))
+    assert not freshness_is_fresh(user, destination, base)
+    freshness_record_sync(user, destination, '*', base)
+    assert freshness_is_fresh(user, destination, base + 1)
+    freshness_record_change(user, ['guid-1', 'guid-2'], base + 10)
+    assert not freshness_is_fresh(user, destination, base + 20)
+    assert freshness_user_lag(user, base + 20) == {destination: 10}
+    freshness_record_sync(user, destination, 'guid-1', base + 15)
+    assert not freshness_is_fresh(user, destination, base + 20)
+    freshness_record_sync(user, destination, 'guid-2', base + 15)
+    assert freshness_is_fresh(user, destination, base + 20)
+    assert freshness_user_lag(user, base + 20) == {destination: 0}
+
+
+def test_freshness_user_change():
+    print()
+    user = 'fresh-user@domain'
+    destination = 'tcp:1.2.3.4:1234'
+    base = time.time()
+    fs_rmany(freshness_file(user))
+    freshness_record_sync(user, destination, '*', base)
+    freshness_record_change(user, ['*'], base + 10)
+    freshness_record_sync(user, destination, 'guid-1', base + 20)
+    assert not freshness_is_fresh(user, destination, base + 30)  # guid sync does not cover user change
+    freshness_record_sync(user, destination, '*', base + 20)
+    assert freshness_is_fresh(user, destination, base + 30)
+    assert freshness_load(user)['sync'][destination] == {'*': base + 20}  # pruned guid entry
+
+
+def test_freshness_max_age():
+    print()
+    os.environ['FRESHNESS_MAX_AGE'] = "100"
+    try:
+        user = 'fresh-age@domain'
+        destination = 'tcp:1.2.3.4:1234'
+        base = time.time()
+        fs_rmany(freshness_file(user))
+        freshness_record_sync(user, destination, '*', base)
+        assert freshness_is_fresh(user, destination, base + 100)
+        assert not freshness_is_fresh(user, destination, base + 101)
+    finally:
+        del os.environ['FRESHNESS_MAX_AGE']
+
+
+def test_freshness_node_lag():
+    print()
+    fs_rmany(freshness_dir())
+    time_now = time.time()
+    freshness_record_sync('user-1@domain', 'tcp:node-a:1234', '*', time_now - 50)
+    freshness_record_sync('user-1@domain', 'tcp:node-b:1234', '*', time_now - 10)
+    freshness_record_change('user-1@domain', ['guid-1'], time_now - 30)
+    freshness_record_sync('user-2@domain', 'tcp:node-a:1234', '*', time_now - 10)
+    assert freshness_user_iterate() == ['user-1@domain', 'user-2@domain']
+    node_map = freshness_node_lag(time_now)
+    assert node_map['tcp:node-a:1234']['user_count'] == 2
+    assert node_map['tcp:node-a:1234']['user_behind'] == 1
+    assert node_map['tcp:node-a:1234']['lag_max'] == 30
+    assert node_map['tcp:node-b:1234']['user_behind'] == 0
+    freshness_persist_report()
+    assert os.path.isfile(freshness_report_file())
+    assert freshness_user_iterate() == ['user-1@domain', 'user-2@domain']
+
+
+def test_freshness_echo_window(monkeypatch):
+    print()
+    from mail_serv import syncer, echo
+    from mail_serv.echo import echo_tracker
+    user = 'fresh-echo@domain'
+    destination = 'tcp:1.2.3.4:1234'
+    fs_rmany(freshness_file(user))
+    submit_list = list()
+    monkeypatch.setattr(echo, 'echo_summary', lambda user_name: dict())
+    monkeypatch.setattr(syncer, 'sieve_invoke_user', lambda user_name, mbox_name: None)
+    monkeypatch.setattr(syncer, 'activity_record', lambda count_map: None)
+    monkeypatch.setattr(syncer, 'metrics_persist', lambda session: None)
+    monkeypatch.setattr(syncer, 'dispatch_instance', lambda: type('Stub', (), dict(submit=lambda *args: submit_list.append(args)))())
+    event = f"chng_type=mail_save\tuser_name={user}\tmbox_name=INBOX\tmbox_guid=guid-1"
+    with echo_tracker().tracking(user):  # local dsync in flight
+        freshness_record_sync(user, destination, '*', time.time() - 1)  # sync start
+        syncer.syncer_process_events([event])  # delivery during sync, task collapsed into sync
+    assert submit_list == []
+    assert not freshness_is_fresh(user, destination)  # change is still recorded, keeper must not skip
+    freshness_record_sync(user, destination, '*', time.time())
+    assert freshness_is_fresh(user, destination)
@@ -0,0 +1,54 @@
+
+from mail_serv_test import *
+from mail_serv import keeper
+from mail_serv.keeper import *
+from mail_serv.support import fs_rmany
+
+os.environ['CHECKPOINT_DIR'] = f"{THIS_DIR}/tmp/keeper/checkpoint"
+os.environ['PRIORITY_STATE_DIR'] = f"{THIS_DIR}/tmp/keeper/priority"
+os.environ['ACTIVITY_LOG_DIR'] = f"{THIS_DIR}/tmp/keeper/activity"
+os.environ['FRESHNESS_DIR'] = f"{THIS_DIR}/tmp/keeper/freshness"
+os.environ['METRICS_REPORT_DIR'] = f"{THIS_DIR}/tmp/keeper/metrics"
+
+
+def test_keeper_resume_failed(monkeypatch):
+    print()
+    fs_rmany(f"{THIS_DIR}/tmp/keeper")
+    monkeypatch.setattr(keeper, 'user_list', lambda: ['fail@domain', 'good@domain', 'rest@domain'])
+    checkpoint = RunCheckpoint('keeper-service')  # interrupted run
+    checkpoint.persist_header()
+    checkpoint.record_user('fail@domain', dict(maintain='done', replicate='fail'))
+    checkpoint.record_user('good@domain', dict(maintain='done'))
+
+    user_done = list()
+    monkeypatch.setattr(keeper, 'keeper_process_user', lambda user_name: user_done.append(user_name) or dict(maintain='done'))
+    keeper_process_all()
+    assert sorted(user_done) == ['fail@domain', 'rest@domain']  # failed user is retried
+
+
+class NodeStub():
+
+    def __init__(self, name, addr):
+        self.name = name
+        self.addr = addr
+        self.port = '12345'
+
+
+def test_keeper_prefetch_diverge(monkeypatch):
+    print()
+    monkeypatch.setenv('DIVERGE_ENABLE', 'true')
+    monkeypatch.setenv('FRESHNESS_ENABLE', 'false')
+    peer_map = {
+        'user-1@domain': [NodeStub('serv_1', '10.0.0.1'), NodeStub('serv_2', '10.0.0.2')],
+        'user-2@domain': [NodeStub('serv_1', '10.0.0.1')],
+        'user-3@domain': [],
+    }
+    registry = type('RegistryStub', (), dict(user_snapshot=lambda self, user_name: peer_map[user_name]))()
+    monkeypatch.setattr(keeper, 'tinker_registry', lambda: registry)
+    prefetch_list = list()
+    monkeypatch.setattr(keeper, 'diverge_prefetch', lambda addr, user_list: prefetch_list.append((addr, user_list)))
+    keeper_prefetch_diverge(['user-1@domain', 'user-2@domain', 'user-3@domain'])
+    assert prefetch_list == [  # single request per peer for the whole batch
+        ('10.0.0.1', ['user-1@domain', 'user-2@domain']),
+        ('10.0.0.2', ['user-1@domain']),
+    ]
@@ -0,0 +1,207 @@
+
+import random
+import threading
+from mail_serv_test import *
+from mail_serv import maintain
+from mail_serv.maintain import *
+from mail_serv.support import fs_rmany, fs_mkdir
+
+os.environ['FRESHNESS_DIR'] = f"{THIS_DIR}/tmp/freshness"
+
+
+def test_maintain_parse():
+    print()
+    entry_list = [
+        'require "fileinto";',
+        '#expunge#mailbox Trash savedbefore 30d',
+        '#flags-add#\\Seen mailbox Spam',
+        '#unknown#value',
+    ]
+    assert maintain_parse(entry_list) == [
+        MaintainRule('expunge', 'mailbox Trash savedbefore 30d'),
+        MaintainRule('flags add', '\\Seen mailbox Spam'),
+    ]
+
+
+def test_maintain_cache(monkeypatch):
+    print()
+    sieve_root = f"{THIS_DIR}/tmp/maintain"
+    fs_rmany(sieve_root)
+    monkeypatch.setattr(maintain, 'config_sieve_path', lambda user_name: f"{sieve_root}/{user_name}")
+    monkeypatch.setattr(maintain, 'user_list', lambda: ['plain@domain', 'config@domain'])
+    command_list = list()
+    monkeypatch.setattr(maintain, 'doveadm', lambda *args: command_list.append(args))
+    conf_file = f"{sieve_root}/config@domain/A_R_K_O_N.maintain.sieve"
+    fs_mkdir(os.path.dirname(conf_file))
+    with open(conf_file, "w") as conf_text:
+        conf_text.write("#expunge#mailbox Trash savedbefore 30d\n")
+
+    assert maintain_user_list(['plain@domain', 'config@domain']) == ['config@domain']
+    maintain_all()
+    assert command_list == [('expunge', '-u', 'config@domain', 'mailbox', 'Trash', 'savedbefore', '30d')]
+
+    read_count = list()
+    parse_func = maintain.maintain_parse
+    monkeypatch.setattr(maintain, 'maintain_parse', lambda entry_list: read_count.append(1) or parse_func(entry_list))
+    maintain_user('config@domain')
+    maintain_user('plain@domain')
+    assert read_count == []  # unchanged file, cached rules
+
+    with open(conf_file, "a") as conf_text:
+        conf_text.write("#flags-add#\\\\Seen mailbox Spam\n")
+    maintain_user('config@domain')
+    assert read_count == [1]
+    assert command_list[-1] == ('flags', 'add', '-u', 'config@domain', '\\Seen', 'mailbox', 'Spam')
+
+    os.remove(conf_file)
+    command_list.clear()
+    maintain_user('config@domain')
+    assert command_list == []
+
+
+def test_maintain_plan():
+    print()
+    rule_list = maintain_parse([
+        '#expunge#mailbox Trash savedbefore 30d',
+        '#flags-add#\\\\Seen mailbox Spam',
+        '#expunge#mailbox Junk savedbefore 7d',
+        '#move#Archive mailbox inbox before 365d',
+        '#expunge#mailbox Trash deleted',
+        '#flags-add#\\\\Seen mailbox Spam keyword work',
+        '#expunge#mailbox Archive deleted',
+        '#deduplicate#mailbox INBOX',
+        '#expunge#seen',
+        '#expunge#mailbox Trash',
+    ])
+    stage_list = maintain_plan(rule_list)
+    summary = [[(step.action, step.search()) for step in stage] for stage in stage_list]
+    assert summary == [
+        [
+            ('expunge', "mailbox Trash OR '(' savedbefore 30d ')' '(' deleted ')'"),
+            ('flags add', "'\\Seen' mailbox Spam OR '(' ALL ')' '(' keyword work ')'"),
+            ('expunge', 'mailbox Junk savedbefore 7d'),
+            ('move', 'Archive mailbox inbox before 365d'),
+        ],
+        [
+            ('expunge', 'mailbox Archive deleted'),
+            ('deduplicate -m', 'mailbox INBOX'),
+        ],
+        [
+            ('expunge', 'seen'),  # unknown mailbox: no merge, no reorder
+        ],
+        [
+            ('expunge', 'mailbox Trash'),
+        ],
+    ]
+    assert maintain_step(MaintainRule('expunge', 'mailbox inbox seen')).commute(
+        maintain_step(MaintainRule('move', 'Archive mailbox Spam'))
+    )
+    assert not maintain_step(MaintainRule('expunge', 'mailbox inbox seen')).commute(
+        maintain_step(MaintainRule('move', 'INBOX mailbox Spam'))
+    )
+    assert maintain_query_mbox_set(['mailbox', 'A', 'seen']) == {'A'}
+    assert maintain_query_mbox_set(['mailbox', 'Lists/*']) is None
+    assert maintain_query_mbox_set(['OR', 'mailbox', 'A', 'seen']) is None
+    assert maintain_query_mbox_set(['seen']) is None
+
+
+class MailboxStub:
+    "messages: id -> [mailbox, flags], evaluate subset of doveadm search query"
+
+    def __init__(self, rnd):
+        self.message_map = dict()
+        for index in range(200):
+            flag_set = set([flag for flag in ('\\Seen', '\\Flagged', 'work') if rnd.random() < 0.3])
+            self.message_map[index] = [rnd.choice(['INBOX', 'Spam', 'Lists', 'Trash']), flag_set]
+        self.lock = threading.Lock()
+
+    def parse(self, term_list):
+        "produce predicate list from terms, consume until ')'"
+        predicate_list = list()
+        while term_list and term_list[0] != ')':
+            predicate_list.append(self.parse_key(term_list))
+        return predicate_list
+
+    def parse_key(self, term_list):
+        term = term_list.pop(0)
+        if term == 'OR':
+            left, right = self.parse_key(term_list), self.parse_key(term_list)
+            return lambda message: left(message) or right(message)
+        if term == '(':
+            group = self.parse(term_list)
+            assert term_list.pop(0) == ')'
+            return lambda message: all(key(message) for key in group)
+        if term == 'mailbox':
+            mbox = maintain_mbox_name(term_list.pop(0))
+            return lambda message: message[0] == mbox
+        if term == 'ALL':
+            return lambda message: True
+        if term == 'keyword':
+            flag = term_list.pop(0)
+            return lambda message: flag in message[1]
+        if term == 'seen':
+            return lambda message: '\\Seen' in message[1]
+        if term == 'unseen':
+            return lambda message: '\\Seen' not in message[1]
+        raise RuntimeError(f"unexpected: {term}")
+
+    def doveadm(self, *command):
+        command = list(command)
+        action = command[:command.index('-u')]
+        term_list = command[command.index('-u') + 2:]
+        target = term_list.pop(0) if action[0] in ('flags', 'move') else None
+        key_list = self.parse(term_list)
+        with self.lock:
+            match_list = [
+                index for index, message in self.message_map.items()
+                if all(key(message) for key in key_list)
+            ]
+            for index in match_list:
+                if action == ['expunge']:
+                    del self.message_map[index]
+                elif action == ['flags', 'add']:
+                    self.message_map[index][1].add(target)
+                elif action == ['flags', 'remove']:
+                    self.message_map[index][1].discard(target)
+                elif action == ['move']:
+                    self.message_map[index][0] = maintain_mbox_name(target)
+
+    def snapshot(self):
+        return dict([(index, (mbox, sorted(flag_set))) for index, (mbox, flag_set) in self.message_map.items()])
+
+
+def test_maintain_plan_equivalence(monkeypatch):
+    print()
+    rnd = random.Random(5)
+    mbox_list = ['INBOX', 'Spam', 'Lists', 'Trash']
+    flag_list = ['work', '\\\\Seen']  # shell escaped in configuration
+    merge_count = stage_count = 0
+    for _ in range(200):
+        entry_list = list()
+        focus_list = rnd.sample(mbox_list, 2) + ['inbox']  # few mailboxes per configuration, so entries can merge
+        for _ in range(rnd.randint(1, 8)):
+            query = rnd.choices([
+                f"mailbox {rnd.choice(focus_list)} {rnd.choice(['seen', 'unseen', 'keyword work', ''])}",
+                rnd.choice(['seen', 'unseen', 'keyword work', 'keyword \\\\Flagged']),
+                f"OR mailbox {rnd.choice(mbox_list)} keyword work",
+            ], weights=[2, 1, 1])[0].strip()
+            entry_list.append(rnd.choice([
+                f"#expunge#{query}",
+                f"#flags-add#{rnd.choice(flag_list)} {query}",
+                f"#flags-rem#{rnd.choice(flag_list)} {query}",
+                f"#move#{rnd.choice(mbox_list)} {query}",
+            ]))
+        rule_list = maintain_parse(entry_list)
+        seed = rnd.random()
+        serial = MailboxStub(random.Random(seed))
+        for rule in rule_list:
+            serial.doveadm(*maintain_command('user@domain', rule.action, rule.search))
+        planned = MailboxStub(random.Random(seed))
+        apply_func = lambda user_name, action, search: planned.doveadm(*maintain_command(user_name, action, search))
+        stage_list = maintain_plan(rule_list)
+        maintain_execute('user@domain', stage_list, apply_func)
+        assert planned.snapshot() == serial.snapshot(), entry_list
+        merge_count += len(rule_list) - sum([len(stage) for stage in stage_list])
+        stage_count += len([stage for stage in stage_list if len(stage) > 1])
+    print(f"merge_count={merge_count} stage_count={stage_count}")
+    assert merge_count > 5 and stage_count > 10
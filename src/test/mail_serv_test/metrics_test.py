@@ -0,0 +1,39 @@
+
+from mail_serv_test import *
+from mail_serv.metrics import *
+
+os.environ['METRICS_REPORT_DIR'] = f"{THIS_DIR}/tmp/metrics"
+
+
+def test_metrics_counter():
+    print()
+    counter = MetricCounter()
+    bucket = metrics_bucket()
+    window = metrics_window()
+    counter.add(1, 0)
+    counter.add(2, bucket)
+    assert counter.total == 3
+    assert counter.window_sum(bucket) == 3
+    assert counter.window_sum(window + bucket) == 2  # first bucket expired
+    assert counter.total == 3
+
+
+def test_metrics_registry():
+    print()
+    registry = MetricRegistry()
+    registry.count('sync_total', node='serv_2')
+    registry.count('sync_total', 2, node='serv_2')
+    registry.count('sync_total', node='serv_3')
+    assert registry.total('sync_total', node='serv_2') == 3
+    snapshot = registry.snapshot()
+    assert snapshot['sync_total{node="serv_3"}']['total'] == 1
+    text = registry.render_text()
+    print(text)
+    assert 'sync_total{node="serv_2"} 3' in text
+
+
+def test_metrics_persist():
+    print()
+    metrics_count('tester_total')
+    metrics_persist('tester')
+    assert os.path.isfile(metrics_report_file('tester'))
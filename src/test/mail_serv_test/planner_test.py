@@ -0,0 +1,35 @@
+
+from mail_serv_test import *
+from mail_serv.planner import *
+from mail_serv.metrics import metrics_instance
+
+
+def test_planner_batch():
+    print()
+    guid_limit = planner_guid_limit()
+    planner = ReplicatePlanner()
+    storm_set = set(f"guid-{index}" for index in range(guid_limit + 1))
+    task_list = planner.plan(dict([
+        ('calm@domain', set(['guid-a', 'guid-b'])),
+        ('storm@domain', storm_set),
+    ]), time_now=1000)
+    assert task_list == [
+        ('calm@domain', 'guid-a'),
+        ('calm@domain', 'guid-b'),
+        ('storm@domain', None),
+    ]
+    assert metrics_instance().total('planner_escalate') >= 1
+
+
+def test_planner_window():
+    print()
+    guid_limit = planner_guid_limit()
+    window = planner_window()
+    planner = ReplicatePlanner()
+    for index in range(guid_limit):
+        task_list = planner.plan(dict([('user@domain', set([f"guid-{index}"]))]), time_now=1000)
+        assert task_list == [('user@domain', f"guid-{index}")]
+    task_list = planner.plan(dict([('user@domain', set(["guid-last"]))]), time_now=1001)
+    assert task_list == [('user@domain', None)]
+    task_list = planner.plan(dict([('user@domain', set(["guid-next"]))]), time_now=1002 + window)
+    assert task_list == [('user@domain', "guid-next")]
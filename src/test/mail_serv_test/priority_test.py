@@ -0,0 +1,49 @@
+
+from mail_serv_test import *
+from mail_serv.priority import *
+
+os.environ['PRIORITY_STATE_DIR'] = f"{THIS_DIR}/tmp/priority"
+
+HOUR = 3600
+
+
+def test_priority_staleness():
+    print()
+    time_now = 100 * HOUR
+    priority_map = dict([
+        ('fresh@domain', UserPriority(time_kept=time_now - 1 * HOUR)),
+        ('stale@domain', UserPriority(time_kept=time_now - 12 * HOUR)),
+        ('never@domain', UserPriority()),
+    ])
+    user_list = ['fresh@domain', 'stale@domain', 'never@domain']
+    user_order = priority_user_order(user_list, priority_map, time_now)
+    assert user_order == ['never@domain', 'stale@domain', 'fresh@domain']
+
+
+def test_priority_activity_failure():
+    print()
+    time_now = 100 * HOUR
+    time_kept = time_now - 1 * HOUR
+    priority_map = dict([
+        ('quiet@domain', UserPriority(time_kept=time_kept)),
+        ('active@domain', UserPriority(time_kept=time_kept)),
+        ('failed@domain', UserPriority(time_kept=time_kept, fail_count=1)),
+        ('removed@domain', UserPriority()),
+    ])
+    activity_map = dict([
+        ('active@domain', [(time_now - 60, 20)]),
+    ])
+    priority_absorb_activity(priority_map, activity_map, time_now)
+    user_list = ['quiet@domain', 'active@domain', 'failed@domain']
+    user_order = priority_user_order(user_list, priority_map, time_now)
+    assert user_order == ['active@domain', 'failed@domain', 'quiet@domain']
+    assert 'removed@domain' not in priority_map
+
+
+def test_priority_persist():
+    print()
+    priority_map = dict([
+        ('user@domain', UserPriority(time_kept=123, fail_count=2)),
+    ])
+    priority_persist(priority_map)
+    assert priority_restore() == priority_map
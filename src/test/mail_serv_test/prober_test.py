@@ -0,0 +1,58 @@
+
+import socket
+from mail_serv_test import *
+from mail_serv.prober import *
+
+
+def test_prober_connect_all():
+    print()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    live_target = server.getsockname()
+    dead_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    dead_socket.bind(('127.0.0.1', 0))
+    dead_target = dead_socket.getsockname()  # bound but not listening
+    try:
+        result_map = prober_connect_all([live_target, dead_target], timeout=1.0)
+        print(result_map)
+        assert result_map[live_target] is not None
+        assert result_map[dead_target] is None
+    finally:
+        server.close()
+        dead_socket.close()
+
+
+def test_prober_circuit_breaker():
+    print()
+    health = NodeHealth('addr', 1234)
+    failure_limit = prober_failure_limit()
+    backoff_base = prober_backoff_base()
+    assert health.circuit_state(0) == 'closed'
+    assert health.needs_probe(100)
+    for index in range(failure_limit):
+        health.report_probe(None, 100)
+    assert health.circuit_state(100) == 'open'
+    assert not health.needs_probe(100)
+    assert not health.is_available(100)
+    assert health.circuit_state(100 + backoff_base) == 'half-open'
+    health.report_probe(None, 200)
+    assert health.time_retry == 200 + 2 * backoff_base  # exponential
+    health.report_probe(0.001, 300)
+    assert health.circuit_state(300) == 'closed'
+    assert health.is_available(300)
+    assert not health.needs_probe(300)  # cached
+
+
+def test_prober_live_list():
+    print()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    live_target = server.getsockname()
+    try:
+        prober = NodeProber()
+        assert prober.live_list([live_target]) == [live_target]
+        assert prober.health_map[live_target].rtt is not None
+    finally:
+        server.close()
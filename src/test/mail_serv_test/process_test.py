@@ -0,0 +1,26 @@
+import time
+from mail_serv_test import *
+from mail_serv.process import *
+
+
+def test_execute_process_line():
+    print()
+    line_list = list()
+    result = execute_process_line(['sh', '-c', 'echo out; echo err-1 >&2; echo err-2 >&2; exit 3'], line_list.append)
+    assert result.rc == 3
+    assert result.stdout == "out\n"
+    assert result.stderr is None
+    assert line_list == ["err-1\n", "err-2\n"]
+
+
+def test_process_deadline():
+    print()
+    time_start = time.monotonic()
+    with process_deadline(0.3):
+        result = execute_process_unit(['sleep', '5'])
+        assert process_expired()
+    assert result.rc != 0 and result.error is not None
+    assert time.monotonic() - time_start < 2
+    assert process_time_left() is None
+    with process_deadline(0):
+        assert execute_process_unit(['true']).rc == 0
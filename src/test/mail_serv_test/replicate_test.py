@@ -0,0 +1,97 @@
+
+from mail_serv_test import *
+from mail_serv import replicate
+from mail_serv.replicate import *
+from mail_serv.syncstate import syncstate_get, syncstate_drop
+from mail_serv.process import ExecuteResult
+
+os.environ['SYNCSTATE_DIR'] = f"{THIS_DIR}/tmp/syncstate"
+os.environ['FRESHNESS_DIR'] = f"{THIS_DIR}/tmp/freshness"
+os.environ['USERLOCK_DIR'] = f"{THIS_DIR}/tmp/userlock"
+
+
+def test_replicate_parse_state():
+    print()
+    assert replicate_parse_state("") == ""
+    assert replicate_parse_state("AQAAAJ1\n") == "AQAAAJ1"
+    assert replicate_parse_state("noise\nAQAAAJ2\n\n") == "AQAAAJ2"
+
+
+def test_replicate_stateful(monkeypatch):
+    print()
+    user = 'replicate-user@domain'
+    destination = replicate_destination('1.2.3.4', '1234')
+    syncstate_drop(user, destination)
+
+    command_list = list()
+    result_list = list()
+
+    def doveadm_line(react_stderr, *option_list):
+        command_list.append(option_list)
+        result = result_list.pop(0)
+        for line in (result.stderr or "").splitlines(keepends=True):
+            react_stderr(line)
+        return ExecuteResult(rc=result.rc, stdout=result.stdout)
+
+    monkeypatch.setattr(replicate, 'doveadm_line', doveadm_line)
+
+    # initial full sync
+    result_list.append(ExecuteResult(rc=0, stdout="state-1\n"))
+    replicate_with_guid(user, 'guid-1', '1.2.3.4', '1234')
+    assert command_list[-1][command_list[-1].index('-s') + 1] == ""
+    assert syncstate_get(user, destination, 'guid-1') == "state-1"
+
+    # incremental sync
+    result_list.append(ExecuteResult(rc=0, stdout="state-2\n"))
+    replicate_with_guid(user, 'guid-1', '1.2.3.4', '1234')
+    assert command_list[-1][command_list[-1].index('-s') + 1] == "state-1"
+    assert syncstate_get(user, destination, 'guid-1') == "state-2"
+
+    # rejected state falls back to full sync
+    result_list.append(ExecuteResult(rc=1, stderr="Error: Invalid sync state"))
+    result_list.append(ExecuteResult(rc=0, stdout="state-3\n"))
+    replicate_with_guid(user, 'guid-1', '1.2.3.4', '1234')
+    assert command_list[-1][command_list[-1].index('-s') + 1] == ""
+    assert syncstate_get(user, destination, 'guid-1') == "state-3"
+
+    # lock failure is temporary and keeps state
+    result_list.append(ExecuteResult(rc=75, stderr="Error: Couldn't lock"))
+    try:
+        replicate_with_guid(user, 'guid-1', '1.2.3.4', '1234')
+        assert False, "expect failure"
+    except ReplicateTempFail as error:
+        assert "lock" in str(error)
+    assert syncstate_get(user, destination, 'guid-1') == "state-3"
+
+    # temporary exit code without lock failure is ordinary failure
+    result_list.append(ExecuteResult(rc=75, stderr="Error: Remote disconnected"))
+    try:
+        replicate_with_guid(user, 'guid-1', '1.2.3.4', '1234')
+        assert False, "expect failure"
+    except ReplicateTempFail:
+        assert False, "expect ordinary failure"
+    except AssertionError as error:
+        assert "disconnected" in str(error)
+
+    # other failures keep state
+    result_list.append(ExecuteResult(rc=1, stderr="Error: Mailbox broken"))
+    try:
+        replicate_with_guid(user, 'guid-1', '1.2.3.4', '1234')
+        assert False, "expect failure"
+    except AssertionError as error:
+        assert "broken" in str(error)
+    assert syncstate_get(user, destination, 'guid-1') == "state-3"
+
+
+def test_replicate_retry(monkeypatch):
+    print()
+    monkeypatch.setenv('REPLICATE_TEMPFAIL_DELAY', '0.01')
+    attempt_list = list()
+
+    def replicate_func(user):
+        attempt_list.append(user)
+        if len(attempt_list) < 3:
+            raise ReplicateTempFail("user locked")
+
+    replicate_retry(replicate_func, 'retry-user@domain')
+    assert len(attempt_list) == 3
@@ -0,0 +1,53 @@
+
+from mail_serv_test import *
+from mail_serv import resident
+from mail_serv.resident import *
+
+os.environ['PRIORITY_STATE_DIR'] = f"{THIS_DIR}/tmp/priority"
+os.environ['ACTIVITY_LOG_DIR'] = f"{THIS_DIR}/tmp/activity"
+os.environ['TIMING_REPORT_DIR'] = f"{THIS_DIR}/tmp/timing"
+os.environ['CHECKPOINT_DIR'] = f"{THIS_DIR}/tmp/checkpoint"
+os.environ['FRESHNESS_DIR'] = f"{THIS_DIR}/tmp/freshness"
+os.environ['METRICS_REPORT_DIR'] = f"{THIS_DIR}/tmp/metrics"
+
+
+def test_resident_io_bytes():
+    print()
+    io_bytes = resident_io_bytes()
+    print(f"io_bytes={io_bytes:,}")
+    assert io_bytes >= 0
+
+
+def test_resident_io_limiter():
+    print()
+    limiter = IoRateLimiter(io_rate=0)
+    assert limiter.throttle() == 0
+    limiter = IoRateLimiter(io_rate=1e12)
+    assert limiter.throttle() == 0
+
+
+def test_resident_cycle(monkeypatch):
+    print()
+
+    user_done = list()
+
+    def keeper_process_entry(user_name, priority_map, checkpoint):
+        user_done.append(user_name)
+        priority_map.setdefault(user_name, UserPriority()).report_success(time.time())
+        checkpoint.record_user(user_name, dict(maintain='done'))
+        return user_name != 'fail@domain'
+
+    monkeypatch.setattr(resident, 'user_list', lambda: ['fail@domain', 'good@domain'])
+    monkeypatch.setattr(resident, 'keeper_process_entry', keeper_process_entry)
+
+    keeper = ResidentKeeper(cycle_time=0.2, worker_count=2, io_rate=0)
+    keeper.setup_workers()
+    keeper.process_cycle()
+
+    assert sorted(user_done) == ['fail@domain', 'good@domain']
+    assert keeper.progress.cycle_count == 1
+    assert keeper.progress.user_done == 2
+    assert keeper.progress.user_fail == 1
+    assert keeper.progress.user_active == []
+    assert os.path.isfile(resident_progress_file())
+    assert keeper.checkpoint.finished
@@ -0,0 +1,159 @@
+
+import re
+import sys
+import json
+import time
+import random
+import shutil
+from typing import List, Mapping
+from mail_serv_test import *
+from mail_serv import sieve, command
+from mail_serv.sieve import *
+from mail_serv.support import fs_rmany, fs_mkdir, fs_persist_json
+
+os.environ['USERLOCK_DIR'] = f"{THIS_DIR}/tmp/userlock"
+
+# routing rule counts, override with SIEVE_BENCH_SIZE=1000,10000
+bench_size_list = [int(size) for size in os.environ.get('SIEVE_BENCH_SIZE', '1000,10000,50000').split(',')]
+
+# json report, compare between versions
+bench_report_file = os.environ.get('SIEVE_BENCH_REPORT', f"{THIS_DIR}/tmp/sieve-bench/report.json")
+
+bench_vendor_list = ['Vendor', 'Client', 'Friend', 'Service', 'Archive']
+bench_keyword_list = ['invoice', 'urgent', 'report', 'order', 'ticket', 'alert', 'review']
+bench_first_list = ['Anna', 'Boris', 'Carla', 'David', 'Elena', 'Frank', 'Greta', 'Hugo', 'Ivan', 'Julia']
+bench_last_list = ['Smith', 'Novak', 'Ivanov', 'Garcia', 'Muller', 'Rossi', 'Tanaka', 'Kowalski', 'Silva']
+
+
+def bench_mbox_list(define_count:int, seed:int=1) -> List[str]:
+    "sorted mailbox list: 'Vendor/Company/First Last [keyword] addr@domain' plus folders"
+    rnd = random.Random(seed)
+    company_count = max(10, define_count // 25)
+    folder_set = set(['INBOX', 'Sent', 'Drafts', 'Trash', 'Junk'] + bench_vendor_list)
+    define_set = set()
+    while len(define_set) < define_count:
+        vendor = rnd.choice(bench_vendor_list)
+        company_index = rnd.randrange(company_count)
+        company = f"Company{company_index}"
+        domain = f"company{company_index}.{rnd.choice(['com', 'net', 'org'])}"
+        first = rnd.choice(bench_first_list)
+        last = rnd.choice(bench_last_list)
+        keyword = f" [{rnd.choice(bench_keyword_list)}]" if rnd.random() < 0.3 else ""
+        addr = rnd.choice([
+            f"{first.lower()}.{last.lower()}{rnd.randrange(100)}@{domain}",
+            f"{first.lower()}{rnd.randrange(1000)}@{domain}",
+            f"@{domain}",
+        ])
+        folder_set.add(f"{vendor}/{company}")
+        define_set.add(f"{vendor}/{company}/{first} {last}{keyword} {addr}")
+    return sorted(folder_set | define_set)
+
+
+class BenchStore:
+    "doveadm and sievec stand-ins, record compile cost"
+
+    sievec_token = re.compile(r'"[^"]*"|:\w+|[][(){},;]|[A-Za-z_-]+')
+
+    def __init__(self, mbox_list:List[str], sieve_dir:str):
+        self.mbox_list = mbox_list
+        self.sieve_dir = sieve_dir
+        self.script_set = set()
+        self.compile_time = 0.0
+        self.compile_count = 0
+        self.sievec_path = shutil.which('sievec')
+
+    def persist_mbox_list(self, user_name, mbox_list_file):
+        with open(mbox_list_file, "w") as mbox_text:
+            mbox_text.write("".join([f"{mbox}\n" for mbox in self.mbox_list]))
+
+    def persist_filter(self, user_name, filter_name, filter_file):
+        shutil.copyfile(filter_file, f"{self.sieve_dir}/{filter_name}.sieve")
+        self.script_set.add(filter_name)
+
+    def list_filter(self, user_name):
+        return sorted(self.script_set)
+
+    def remove_filter(self, user_name, filter_name):
+        self.script_set.discard(filter_name)
+
+    def sievec(self, *option_list):
+        "real sievec when installed, otherwise tokenize and check block balance"
+        script_file, binary_file = option_list[-2:]
+        time_start = time.perf_counter()
+        if self.sievec_path:
+            command.sievec(*option_list)
+        else:
+            with open(script_file, "r") as script:
+                token_list = self.sievec_token.findall(script.read())
+            assert token_list.count('{') == token_list.count('}'), script_file
+            with open(binary_file, "w") as binary:
+                binary.write(f"compiled {len(token_list)}\n")
+        self.compile_time += time.perf_counter() - time_start
+        self.compile_count += 1
+
+
+def bench_build(monkeypatch, mbox_list:List[str], optimize:bool) -> Mapping:
+    "time generation and full sieve_build_user, measure emitted scripts"
+    sieve_dir = f"{THIS_DIR}/tmp/sieve-bench/store"
+    build_dir = f"{sieve_dir}/sys"
+    fs_rmany(sieve_dir)
+    fs_mkdir(sieve_dir)
+    store = BenchStore(mbox_list, sieve_dir)
+    monkeypatch.setenv('SIEVE_OPTIMIZE', str(optimize).lower())
+    monkeypatch.setattr(sieve, 'config_sieve_path', lambda user_name: sieve_dir)
+    monkeypatch.setattr(sieve, 'sieve_persist_mbox_list', store.persist_mbox_list)
+    monkeypatch.setattr(sieve, 'sieve_persist_filter', store.persist_filter)
+    monkeypatch.setattr(sieve, 'sieve_list_filter', store.list_filter)
+    monkeypatch.setattr(sieve, 'sieve_remove_filter', store.remove_filter)
+    monkeypatch.setattr(sieve, 'sievec', store.sievec)
+
+    time_start = time.perf_counter()
+    script_list = sieve_render_model(sieve_build_model(mbox_list), build_dir)
+    time_generate = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    sieve_build_user('bench@domain')
+    time_build = time.perf_counter() - time_start
+
+    size_list = [len(script.text.encode('utf-8')) for script in script_list]
+    return dict(
+        entries=len(mbox_list),
+        rules=sum([len(rule_list) for rule_list in sieve_build_model(mbox_list).rule_map.values()]),
+        optimize=optimize,
+        script_count=len(script_list),
+        script_bytes=sum(size_list),
+        script_bytes_max=max(size_list),
+        generate_seconds=round(time_generate, 4),
+        build_seconds=round(time_build, 4),
+        compile_seconds=round(store.compile_time, 4),
+        compile_count=store.compile_count,
+        compiler='sievec' if store.sievec_path else 'stand-in',
+    )
+
+
+def test_bench_mbox_list():
+    print()
+    mbox_list = bench_mbox_list(1000)
+    assert mbox_list == sorted(mbox_list)
+    model = sieve_build_model(mbox_list)
+    assert sum([len(rule_list) for rule_list in model.rule_map.values()]) == 1000
+    assert set(model.base_list) >= set(bench_vendor_list)
+
+
+def test_sieve_bench(monkeypatch):
+    print()
+    result_list = list()
+    for size in bench_size_list:
+        mbox_list = bench_mbox_list(size)
+        for optimize in (False, True):
+            result = bench_build(monkeypatch, mbox_list, optimize)
+            print(result)
+            result_list.append(result)
+    report = dict(
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=sys.version.split()[0],
+        result_list=result_list,
+    )
+    fs_persist_json(bench_report_file, report)
+    with open(bench_report_file, "r") as report_text:
+        assert json.load(report_text)['result_list'] == result_list
@@ -1,5 +1,17 @@
 
+
+import re
+import time
+import random
+import threading
+from typing import List
+from mail_serv_test import *
+from mail_serv import sieve
 from mail_serv.sieve import *
+from mail_serv.support import fs_rmany, fs_mkdir, fs_strip_eol
+
+os.environ['SIEVE_STATE_DIR'] = f"{THIS_DIR}/tmp/sieve-state"
+os.environ['USERLOCK_DIR'] = f"{THIS_DIR}/tmp/userlock"
 
 
 def test_sieve_regex():
@@ -36,3 +48,490 @@ def test_sieve_regex_define_2():
     assert match_define.group(2) == "[keyword]"
     assert match_define.group(3) == "first.last@company.com"
 
+
+
+class SieveStoreStub():
+    "stand-in for dovecot sieve storage and mailbox list"
+
+    def __init__(self, mbox_list, sieve_dir):
+        self.mbox_list = mbox_list
+        self.sieve_dir = sieve_dir
+        self.script_map = dict()
+        self.upload_list = list()
+        self.remove_list = list()
+        self.compile_list = list()  # build time compile, error report
+        self.install_list = list()  # in place compile in user context
+
+    def persist_mbox_list(self, user_name, mbox_list_file):
+        with open(mbox_list_file, "w") as mbox_text:
+            for mbox in self.mbox_list:
+                mbox_text.write(f"{mbox}\n")
+
+    def persist_filter(self, user_name, filter_name, filter_file):
+        with open(filter_file, "r") as script:
+            self.script_map[filter_name] = script.read()
+        with open(f"{self.sieve_dir}/{filter_name}.sieve", "w") as stored:  # file storage
+            stored.write(self.script_map[filter_name])
+        self.upload_list.append(filter_name)
+
+    def list_filter(self, user_name):
+        return list(self.script_map.keys())
+
+    def remove_filter(self, user_name, filter_name):
+        del self.script_map[filter_name]
+        self.remove_list.append(filter_name)
+
+    def sievec(self, *option_list):
+        script_file, binary_file = option_list[-2:]
+        with open(script_file, "r") as script:
+            text = script.read()
+        if 'broken' in text:
+            raise RuntimeError(f"{script_file}: line 3: error: unexpected character")
+        with open(binary_file, "w") as binary:
+            binary.write(f"compiled\n{text}")
+        if option_list[:2] == ('-u', 'user@domain'):
+            assert os.path.dirname(binary_file) == self.sieve_dir  # next to stored filter
+            self.install_list.append(os.path.basename(script_file))
+        else:
+            self.compile_list.append(os.path.basename(script_file))
+
+
+def sieve_store_stub(monkeypatch, mbox_list) -> SieveStoreStub:
+    sieve_dir = f"{THIS_DIR}/tmp/sieve-build"
+    store = SieveStoreStub(mbox_list, sieve_dir)
+    monkeypatch.setattr(sieve, 'config_sieve_path', lambda user_name: sieve_dir)
+    monkeypatch.setattr(sieve, 'sieve_persist_mbox_list', store.persist_mbox_list)
+    monkeypatch.setattr(sieve, 'sieve_persist_filter', store.persist_filter)
+    monkeypatch.setattr(sieve, 'sieve_list_filter', store.list_filter)
+    monkeypatch.setattr(sieve, 'sieve_remove_filter', store.remove_filter)
+    monkeypatch.setattr(sieve, 'sievec', store.sievec)
+    fs_rmany(sieve_dir)
+    return store
+
+
+def test_sieve_build_compile(monkeypatch):
+    print()
+    mbox_list = ['Vendor', 'Friend', "Vendor/Company/Person person@company.com"]
+    store = sieve_store_stub(monkeypatch, mbox_list)
+    sieve_build_user('user@domain')
+    assert sorted(store.compile_list) == ['Friend.system.sieve', 'Vendor.system.sieve']
+    assert sorted(store.install_list) == ['A_R_K_O_N.system.sieve', 'Friend.system.sieve', 'Vendor.system.sieve']
+    sieve_dir = f"{THIS_DIR}/tmp/sieve-build"
+    build_dir = f"{sieve_dir}/sys"
+    assert os.path.isfile(f"{sieve_dir}/Vendor.system.svbin")
+    assert os.path.isfile(f"{sieve_dir}/A_R_K_O_N.system.svbin")
+    assert len(os.listdir(sieve_cache_dir(build_dir))) == 2
+
+    store.compile_list.clear()
+    store.install_list.clear()
+    sieve_build_user('user@domain')  # no change
+    assert store.compile_list == [] and store.install_list == []
+
+    store.mbox_list.append("Friend/Group/Buddy buddy@home.net")
+    sieve_build_user('user@domain')  # unchanged filter keeps compiled form
+    assert store.compile_list == ['Friend.system.sieve']
+    assert store.install_list == ['Friend.system.sieve', 'A_R_K_O_N.system.sieve']  # root embeds includes
+    assert len(os.listdir(sieve_cache_dir(build_dir))) == 2
+
+    store.upload_list.clear()
+    store.mbox_list.append("Friend/Group/Other broken@home.net")
+    try:
+        sieve_build_user('user@domain')
+        assert False, "expect failure"
+    except RuntimeError as error:
+        assert "Friend.system" in str(error)
+    assert store.upload_list == []  # nothing uploaded on compile error
+
+
+def test_sieve_build_incremental(monkeypatch):
+    print()
+    mbox_list = ['INBOX', 'Vendor', 'Friend'] + [
+        f"Vendor/Company/Person {index} person{index}@company.com" for index in range(40)
+    ] + [
+        "Friend/Group/Buddy buddy@home.net",
+    ]
+    store = sieve_store_stub(monkeypatch, mbox_list)
+
+    sieve_build_user('user@domain')
+    assert store.upload_list == ['INBOX.system', 'Vendor.system', 'Friend.system', 'A_R_K_O_N.system']
+
+    store.upload_list.clear()
+    sieve_build_user('user@domain')  # no change
+    assert store.upload_list == []
+
+    store.mbox_list[5] = "Vendor/Company/Renamed renamed@company.com"
+    sieve_build_user('user@domain')  # leaf rename
+    assert store.upload_list == ['Vendor.system']
+    assert 'renamed@company.com' in store.script_map['Vendor.system']
+
+    store.upload_list.clear()
+    store.mbox_list.remove('Friend')
+    store.mbox_list.remove("Friend/Group/Buddy buddy@home.net")
+    sieve_build_user('user@domain')  # base removal
+    assert store.upload_list == ['A_R_K_O_N.system']
+    assert store.remove_list == ['Friend.system']
+    assert set(store.script_map.keys()) == set(['INBOX.system', 'Vendor.system', 'A_R_K_O_N.system'])
+
+
+def legacy_build_dir(mbox_list_file:str, build_dir:str) -> None:
+    "former multi-pass file based generator, reference output"
+    arkon_name = sieve_system_name(sieve_arkon())
+    with open(sieve_system_file(build_dir, sieve_arkon()), "w") as arkon_text:
+        arkon_text.write(f'# {arkon_name}\n')
+        arkon_text.write(f'require "include";\n')
+        with open(mbox_list_file, "r") as entry_list:
+            for entry in entry_list:
+                mbox_path = fs_strip_eol(entry)
+                match_root = sieve_regex_base.match(mbox_path)
+                if match_root:
+                    base_mbox = match_root.group(1)
+                    base_name = sieve_system_name(base_mbox)
+                    arkon_text.write(f'include :personal "{base_name}";\n')
+                    with open(sieve_system_file(build_dir, base_mbox), "w") as script:
+                        script.write(f'# {base_name}\n')
+                        script.write(f'require "fileinto";\n')
+        with open(mbox_list_file, "r") as entry_list:
+            for entry in entry_list:
+                mbox_path = fs_strip_eol(entry)
+                match_define = sieve_regex_define.match(mbox_path)
+                if match_define:
+                    define_subj = match_define.group(2)
+                    if define_subj:
+                        define_subj = define_subj[1:-1]
+                    sieve_code = sieve_code_entry(define_subj, match_define.group(3), mbox_path)
+                    with open(sieve_system_file(build_dir, match_define.group(1)), "a") as script:
+                        script.write(f"{sieve_code}\n")
+
+
+def sieve_sample_mbox_list(define_count:int, base_count:int=40) -> List[str]:
+    "sorted mailbox list with base and define mailboxes"
+    mbox_list = ['INBOX', 'Sent', 'Trash']
+    for base_index in range(base_count):
+        mbox_list.append(f"Base{base_index}")
+        mbox_list.append(f"Base{base_index}/Company")
+    for index in range(define_count):
+        base_index = index % base_count
+        keyword = f" [key{index % 7}]" if index % 3 == 0 else ""
+        mbox_list.append(f"Base{base_index}/Company/Person {index}{keyword} person{index}@company{index % 50}.com")
+    return sorted(mbox_list)
+
+
+def test_sieve_build_equivalence(monkeypatch):
+    print()
+    monkeypatch.setenv('SIEVE_OPTIMIZE', 'false')
+    build_dir = f"{THIS_DIR}/tmp/sieve-equivalence"
+    fs_rmany(build_dir)
+    fs_mkdir(build_dir)
+    mbox_list = sieve_sample_mbox_list(500)
+    mbox_list_file = f"{build_dir}/a_mailbox_list.txt"
+    with open(mbox_list_file, "w") as mbox_text:
+        mbox_text.write("".join([f"{mbox}\n" for mbox in mbox_list]))
+    legacy_build_dir(mbox_list_file, build_dir)
+    script_list = sieve_render_model(sieve_build_model(sieve_read_mbox_list(mbox_list_file)), build_dir)
+    assert len(script_list) == 3 + 40 + 1
+    for script in script_list:
+        with open(script.file, "r") as legacy_text:
+            assert script.text == legacy_text.read(), script.name
+
+
+def test_sieve_build_bench(monkeypatch):
+    print()
+    monkeypatch.setenv('SIEVE_OPTIMIZE', 'false')
+    build_dir = f"{THIS_DIR}/tmp/sieve-bench"
+    fs_rmany(build_dir)
+    fs_mkdir(build_dir)
+    mbox_list_file = f"{build_dir}/a_mailbox_list.txt"
+    with open(mbox_list_file, "w") as mbox_text:
+        mbox_text.write("".join([f"{mbox}\n" for mbox in sieve_sample_mbox_list(10000)]))
+
+    time_start = time.perf_counter()
+    legacy_build_dir(mbox_list_file, build_dir)
+    time_legacy = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    script_list = sieve_render_model(sieve_build_model(sieve_read_mbox_list(mbox_list_file)), build_dir)
+    for script in script_list:
+        with open(script.file, "w") as script_text:
+            script_text.write(script.text)
+    time_model = time.perf_counter() - time_start
+
+    print(f"entries=10000 legacy={time_legacy:.3f}s model={time_model:.3f}s")
+
+
+class SieveEval():
+    """
+    minimal evaluator for generated filter subset:
+    if, allof, anyof, address [:domain] :contains, header :contains, fileinto, stop
+    """
+
+    token_regex = re.compile(r'"[^"]*"|:\w+|[][(){},;]|[A-Za-z_-]+')
+
+    def __init__(self, text:str):
+        line_list = [line for line in text.splitlines() if not line.startswith('#')]
+        self.token_list = self.token_regex.findall("\n".join(line_list))
+        self.index = 0
+        self.program = self.parse_block(top=True)
+
+    def next(self) -> str:
+        token = self.token_list[self.index]
+        self.index += 1
+        return token
+
+    def peek(self) -> str:
+        return self.token_list[self.index] if self.index < len(self.token_list) else None
+
+    def parse_block(self, top=False) -> list:
+        command_list = list()
+        while True:
+            token = self.peek()
+            if token is None or token == '}':
+                if not top:
+                    self.next()
+                return command_list
+            token = self.next()
+            if token == 'if':
+                test = self.parse_test()
+                assert self.next() == '{'
+                command_list.append(('if', test, self.parse_block()))
+            elif token in ('require', 'fileinto'):
+                command_list.append((token, self.next()[1:-1]))
+                assert self.next() == ';'
+            elif token == 'stop':
+                command_list.append(('stop',))
+                assert self.next() == ';'
+            else:
+                assert False, f"unexpected: {token}"
+
+    def parse_string_list(self) -> list:
+        token = self.next()
+        if token != '[':
+            return [token[1:-1]]
+        value_list = list()
+        while True:
+            token = self.next()
+            if token == ']':
+                return value_list
+            if token != ',':
+                value_list.append(token[1:-1])
+
+    def parse_test(self) -> tuple:
+        token = self.next()
+        if token in ('allof', 'anyof'):
+            assert self.next() == '('
+            test_list = [self.parse_test()]
+            while self.next() == ',':
+                test_list.append(self.parse_test())
+            return (token, test_list)
+        tag_list = list()
+        while self.peek().startswith(':'):
+            tag_list.append(self.next())
+        return (token, tag_list, self.parse_string_list(), self.parse_string_list())
+
+    def test(self, test:tuple, message:dict) -> bool:
+        kind = test[0]
+        if kind == 'allof':
+            return all(self.test(entry, message) for entry in test[1])
+        if kind == 'anyof':
+            return any(self.test(entry, message) for entry in test[1])
+        _, tag_list, header_list, key_list = test
+        value_list = list()
+        for header in header_list:
+            for value in message.get(header, []):
+                if kind == 'address' and ':domain' in tag_list:
+                    value = value.split('@')[-1]
+                value_list.append(value.lower())
+        return any(key.lower() in value for value in value_list for key in key_list)
+
+    def run(self, message:dict, command_list=None) -> tuple:
+        "return (target, stopped)"
+        for command in self.program if command_list is None else command_list:
+            if command[0] == 'if' and self.test(command[1], message):
+                target, stopped = self.run(message, command[2])
+                if stopped or target:
+                    return target, stopped
+            elif command[0] == 'fileinto':
+                target = command[1]
+            elif command[0] == 'stop':
+                return target, True
+        return None, False
+
+
+def test_sieve_optimize_equivalence():
+    print()
+    random.seed(44)
+    domain_list = [f"company{index}.com" for index in range(12)] + ["Mixed.Case.org"]
+    keyword_list = [None, None, "urgent", "report"]
+    rule_list = list()
+    for index in range(300):
+        domain = random.choice(domain_list)
+        person = random.choice([f"person{index}", f"team{index % 5}", ""])
+        keyword = random.choice(keyword_list)
+        mbox_path = f"Base/Company/Rule {index}"
+        if index % 17 == 0:
+            mbox_path = rule_list[-1].mbox_path if rule_list else mbox_path  # identical target
+        rule_list.append(SieveRule(keyword, f"{person}@{domain}", mbox_path))
+        if index % 3 == 0:  # consecutive same domain
+            rule_list.append(SieveRule(keyword, f"other{index}@{domain}", f"Base/Company/Other {index}"))
+    rule_list.append(SieveRule(None, "odd@@company1.com", "Base/Company/Odd"))
+
+    plain = SieveEval("\n".join([
+        sieve_code_entry(rule.define_subj, rule.define_addr, rule.mbox_path) for rule in rule_list
+    ]))
+    optimized_text = "\n".join(sieve_code_optimize(rule_list))
+    optimized = SieveEval(optimized_text)
+    assert optimized_text.count('address :domain') > 0
+
+    address_list = [rule.define_addr for rule in rule_list] + ["stranger@nowhere.net", "x@company3.com"]
+    match_count = 0
+    for _ in range(3000):
+        message = dict()
+        for header in ("To", "CC", "From", "Sender", "Reply-To"):
+            if random.random() < 0.4:
+                message[header] = [random.choice(address_list).upper() if random.random() < 0.1
+                    else random.choice(address_list) for _ in range(random.randint(1, 2))]
+        message["Subject"] = [random.choice(["hello", "urgent: fix", "monthly report", ""])]
+        outcome = plain.run(message)
+        assert outcome == optimized.run(message), message
+        match_count += outcome[0] is not None
+    assert match_count > 1000
+
+
+class MailStoreStub:
+    "mailboxes of single user: name -> uid -> (guid, subject), answer doveadm and sieve-filter"
+
+    def __init__(self):
+        self.uidvalidity = '1000'
+        self.mbox_map = dict(INBOX=dict())
+        self.uidnext_map = dict(INBOX=1)
+        self.filter_list = list()  # filtered guids per pass
+        self.change_list = list()  # mailbox changes, as reported to syncer
+        self.guid_count = 0
+
+    def deliver(self, mbox, subject) -> str:
+        self.guid_count += 1
+        guid = f"guid-{self.guid_count}"
+        self.append(mbox, guid, subject)
+        return guid
+
+    def append(self, mbox, guid, subject) -> None:
+        self.mbox_map.setdefault(mbox, dict())
+        uid = self.uidnext_map.setdefault(mbox, 1)
+        self.mbox_map[mbox][uid] = (guid, subject)
+        self.uidnext_map[mbox] = uid + 1
+        self.change_list.append(('append', mbox, guid))
+
+    def expunge(self, mbox, uid) -> tuple:
+        entry = self.mbox_map[mbox].pop(uid)
+        self.change_list.append(('expunge', mbox, entry[0]))
+        return entry
+
+    def doveadm(self, *option_list):
+        if option_list[:3] == ('-f', 'tab', 'mailbox'):
+            mbox = option_list[-1]
+            return f"uidvalidity\tuidnext\n{self.uidvalidity}\t{self.uidnext_map[mbox]}\n"
+        raise RuntimeError(f"unexpected: {option_list}")
+
+    def source_uid_list(self, source):
+        "resolve virtual mailbox definition into backend mailbox and uids"
+        if source != sieve_virtual_mbox():
+            return source, sorted(self.mbox_map[source].keys())
+        with open(sieve_virtual_file('user@domain'), "r") as define_text:
+            mbox, search = define_text.read().splitlines()
+        keyword, uid_range = search.split()
+        assert keyword == 'UID'
+        head, tail = [int(uid) for uid in uid_range.split(':')]
+        return mbox, [uid for uid in sorted(self.mbox_map[mbox].keys()) if head <= uid <= tail]
+
+    def sieve_filter(self, *option_list):
+        "file subject 'vendor' into Vendor, keep others in place"
+        mbox, uid_list = self.source_uid_list(option_list[-1])
+        self.filter_list.append([self.mbox_map[mbox][uid][0] for uid in uid_list])
+        for uid in uid_list:
+            guid, subject = self.mbox_map[mbox][uid]
+            if 'vendor' in subject:
+                self.append('Vendor', *self.expunge(mbox, uid))
+
+
+def sieve_invoke_setup(monkeypatch, store:MailStoreStub) -> None:
+    script = f"{THIS_DIR}/tmp/sieve-state/active.sieve"
+    fs_mkdir(os.path.dirname(script))
+    with open(script, "w") as script_text:
+        script_text.write("# active\n")
+    fs_rmany(sieve_state_file('user@domain'))
+    monkeypatch.setattr(sieve, 'config_sieve_active', lambda user: script)
+    monkeypatch.setattr(sieve, 'config_mail_home', lambda user: f"{THIS_DIR}/tmp/sieve-home")
+    monkeypatch.setattr(sieve, 'doveadm', store.doveadm)
+    monkeypatch.setattr(sieve, 'sieve_filter', store.sieve_filter)
+
+
+def test_sieve_invoke_default(monkeypatch):
+    print()
+    store = MailStoreStub()
+    sieve_invoke_setup(monkeypatch, store)
+    monkeypatch.delenv('SIEVE_INCREMENTAL', raising=False)
+    store.deliver('INBOX', 'hello')
+    sieve_invoke_user('user@domain')
+    sieve_invoke_user('user@domain')
+    assert store.filter_list == [['guid-1'], ['guid-1']]  # full pass every time
+    assert not os.path.exists(sieve_state_file('user@domain'))
+
+
+def test_sieve_invoke_incremental(monkeypatch):
+    print()
+    store = MailStoreStub()
+    sieve_invoke_setup(monkeypatch, store)
+    monkeypatch.setenv('SIEVE_INCREMENTAL', 'true')
+
+    store.deliver('INBOX', 'hello')
+    store.deliver('INBOX', 'vendor news')
+    sieve_invoke_user('user@domain')  # no record: full pass
+    assert store.filter_list == [['guid-1', 'guid-2']]
+    assert list(store.mbox_map['INBOX'].keys()) == [1]
+
+    store.filter_list.clear()
+    sieve_invoke_user('user@domain')  # nothing new
+    assert store.filter_list == []
+
+    store.deliver('INBOX', 'vendor offer')
+    store.deliver('INBOX', 'lunch')
+    store.change_list.clear()
+    sieve_invoke_user('user@domain')  # new range only
+    assert store.filter_list == [['guid-3', 'guid-4']]
+    assert store.mbox_map['INBOX'] == {1: ('guid-1', 'hello'), 4: ('guid-4', 'lunch')}
+
+    # syncer sees only the rule move: kept message is not touched, source uids stay
+    assert store.change_list == [('expunge', 'INBOX', 'guid-3'), ('append', 'Vendor', 'guid-3')]
+    assert store.uidnext_map['INBOX'] == 5
+
+    store.filter_list.clear()
+    sieve_invoke_user('user@domain')  # kept message is not filtered again
+    store.deliver('INBOX', 'vendor promo')
+    sieve_invoke_user('user@domain')
+    assert store.filter_list == [['guid-5']]
+
+    store.filter_list.clear()
+    store.uidvalidity = '2000'
+    sieve_invoke_user('user@domain')  # uidvalidity change: full pass
+    assert store.filter_list == [['guid-1', 'guid-4']]
+
+    assert sieve_build_model(['INBOX', sieve_virtual_mbox()]).base_list == ['INBOX']
+    assert sieve_uid_set([7, 1, 2, 3, 9, 10]) == "1:3,7,9:10"
+
+
+def test_sieve_user_lock(monkeypatch):
+    print()
+    from mail_serv.userlock import userlock_hold
+    monkeypatch.setenv('SIEVE_USER_TIMEOUT', '0')  # no limit, must not mean no wait
+    monkeypatch.setattr(sieve, 'config_sieve_active', lambda user: f"{THIS_DIR}/tmp/sieve-state/missing.sieve")
+    entered = threading.Event()
+
+    def holder():
+        with userlock_hold('lock@domain', kind='sieve'):  # concurrent build
+            entered.set()
+            time.sleep(0.3)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    entered.wait(5)
+    sieve_invoke_user('lock@domain')  # waits for build instead of failing
+    thread.join()
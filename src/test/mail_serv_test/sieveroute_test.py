@@ -0,0 +1,104 @@
+
+import random
+from email.parser import HeaderParser
+from mail_serv_test import *
+from mail_serv import sieveroute
+from mail_serv.sieve import sieve_build_model
+from mail_serv.sieveroute import *
+from mail_serv.support import fs_rmany, fs_mkdir
+
+
+def test_pattern_automaton():
+    print()
+    pattern_list = ["he", "she", "his", "hers", "@company.com", "a@b", "b"]
+    automaton = PatternAutomaton(pattern_list)
+    for text in ["ushers", "joe@company.com", "xa@bc", "", "nothing"]:
+        expected = set([index for index, pattern in enumerate(pattern_list) if pattern in text])
+        assert automaton.search(text) == expected, text
+
+
+def sample_header(text:str):
+    return HeaderParser().parsestr(text)
+
+
+def test_sieve_router():
+    print()
+    model = sieve_build_model([
+        'Friend',
+        'Vendor',
+        'Friend/Group/Buddy buddy@home.net',
+        'Vendor/Company/Sales [offer] @company.com',
+        'Vendor/Company/Person person@company.com',
+        'Vendor/Company/Any @company.com',
+    ])
+    router = SieveRouter(model)
+    assert router.route(sample_header("From: Buddy <BUDDY@home.net>\nSubject: hi\n\n")) == 'Friend/Group/Buddy buddy@home.net'
+    assert router.route(sample_header("To: x@company.com\nSubject: Special OFFER\n\n")) == 'Vendor/Company/Sales [offer] @company.com'
+    assert router.route(sample_header("Cc: a@b.net, person@company.com\nSubject: hello\n\n")) == 'Vendor/Company/Person person@company.com'
+    assert router.route(sample_header("Reply-To: y@company.com\n\n")) == 'Vendor/Company/Any @company.com'
+    assert router.route(sample_header("From: =?utf-8?q?Offer?= <z@company.com>\n\n")) == 'Vendor/Company/Sales [offer] @company.com'
+    assert router.route(sample_header("From: stranger@nowhere.net\nSubject: offer\n\n")) is None
+
+
+def test_sieve_router_random():
+    print()
+    random.seed(3)
+    mbox_list = ['Base'] + [
+        f"Base/Company/Rule {index} {random.choice(['[urgent] ', '[report] ', ''])}"
+        f"{random.choice([f'person{index}', ''])}@company{index % 40}.com"
+        for index in range(2000)
+    ]
+    router = SieveRouter(sieve_build_model(mbox_list))
+    address_list = [rule.define_addr for rule in router.rule_list] + ["stranger@nowhere.net"]
+
+    def naive_route(addr_list, subj_list):
+        for rule in router.rule_list:
+            if not any(rule.define_addr.lower() in addr.lower() for addr in addr_list):
+                continue
+            if rule.define_subj and not any(rule.define_subj.lower() in subj.lower() for subj in subj_list):
+                continue
+            return rule.mbox_path
+        return None
+
+    for _ in range(500):
+        addr_to = random.choice(address_list).replace('@', 'x@', random.random() < 0.2)
+        addr_from = random.choice(address_list)
+        subject = random.choice(["Urgent: fix", "monthly REPORT", "hello"])
+        header = sample_header(f"To: {addr_to}\nFrom: {addr_from}\nSubject: {subject}\n\n")
+        assert router.route(header) == naive_route([addr_to, addr_from], [addr_from, subject])
+
+
+def test_sieve_route_user(monkeypatch):
+    print()
+    sieve_dir = f"{THIS_DIR}/tmp/sieve-route"
+    build_dir = f"{sieve_dir}/sys"
+    fs_rmany(sieve_dir)
+    fs_mkdir(build_dir)
+    with open(f"{build_dir}/a_mailbox_list.txt", "w") as mbox_text:
+        mbox_text.write("INBOX\nVendor\nVendor/Company/Person person@company.com\nVendor/Other/Any @other.com\n")
+    monkeypatch.setattr(sieveroute, 'config_sieve_path', lambda user: sieve_dir)
+    message_map = {
+        1: "From: person@company.com\n",
+        2: "From: stranger@nowhere.net\n",
+        3: "To: a@other.com\n",
+        4: "Cc: person@company.com\n",
+        5: "Sender: b@other.com\n",
+    }
+    command_list = list()
+
+    def doveadm(*option_list):
+        command_list.append(option_list)
+        if option_list[:3] == ('-f', 'tab', 'fetch'):
+            return "uid\n" + "".join([f"{uid}\n" for uid in message_map])
+        if option_list[0] == 'fetch':
+            return "".join([f"uid: {uid}\nhdr:\n{text}\n\f\n" for uid, text in message_map.items()])
+        return ""
+
+    monkeypatch.setattr(sieveroute, 'doveadm', doveadm)
+    report = sieveroute_refilter_user('user@domain')
+    assert report == {'Vendor/Company/Person person@company.com': 2, 'Vendor/Other/Any @other.com': 2}
+    move_list = [command for command in command_list if command[0] == 'move']
+    assert move_list == [
+        ('move', '-u', 'user@domain', 'Vendor/Company/Person person@company.com', 'mailbox', 'INBOX', 'uid', '1,4'),
+        ('move', '-u', 'user@domain', 'Vendor/Other/Any @other.com', 'mailbox', 'INBOX', 'uid', '3,5'),
+    ]
@@ -68,3 +68,56 @@ def test_syncer_regex_replicate():
     assert regex.match('Vendor/Company/Name @company.com')
     assert regex.match('Vendor/Company/First Last first.last@company.com')
     assert regex.match('Vendor/Company/First Last [keyword] first.last@company.com')
+
+
+class SyncerRecorder:
+    "capture syncer side effects"
+
+    def __init__(self, monkeypatch):
+        import mail_serv.syncer as syncer
+        self.invoke_list = list()
+        self.change_list = list()
+        self.submit_list = list()
+        monkeypatch.setattr(syncer, 'sieve_build_user', lambda user_name: None)
+        monkeypatch.setattr(syncer, 'sieve_invoke_user', lambda user_name, mbox_name: self.invoke_list.append((user_name, mbox_name)))
+        monkeypatch.setattr(syncer, 'freshness_record_change', lambda user_name, guid_list: self.change_list.append((user_name, guid_list)))
+        monkeypatch.setattr(syncer, 'activity_record', lambda count_map: None)
+        monkeypatch.setattr(syncer, 'metrics_persist', lambda session: None)
+        monkeypatch.setattr(syncer, 'dispatch_instance', lambda: self)
+
+    def submit(self, user_name, mbox_guid=None):
+        self.submit_list.append((user_name, mbox_guid))
+
+
+def test_syncer_echo_window(monkeypatch):
+    print()
+    from mail_serv import echo
+    recorder = SyncerRecorder(monkeypatch)
+    summary = dict([('guid-echo', ('7', '10', '9'))])
+    monkeypatch.setattr(echo, 'echo_summary', lambda user: dict(summary))
+    tracker = echo_tracker()
+    tracker.listen(recorder.submit)
+    event = "chng_type=mail_save\tuser_name=echo@domain\tmbox_name=INBOX\tmbox_guid=guid-echo"
+
+    with tracker.tracking('echo@domain', 'guid-echo'):  # local dsync in flight
+        syncer_process_events([event])
+        assert recorder.submit_list == []  # deferred behind running sync
+    assert recorder.invoke_list == [('echo@domain', 'INBOX')]
+    assert recorder.change_list == [('echo@domain', ['guid-echo'])]
+    assert recorder.submit_list == []  # covered by successful sync
+
+    syncer_process_events([event])  # late echo, mailbox unchanged since sync
+    assert recorder.submit_list == []
+    assert len(recorder.invoke_list) == 2 and len(recorder.change_list) == 2
+
+    summary['guid-echo'] = ('8', '11', '10')
+    syncer_process_events([event])  # newer change after sync
+    assert recorder.submit_list == [('echo@domain', 'guid-echo')]
+
+    try:
+        with tracker.tracking('echo@domain'):
+            syncer_process_events([event])
+            raise RuntimeError("dsync failure")
+    except RuntimeError:
+        pass
+    assert recorder.submit_list == [('echo@domain', 'guid-echo')] * 2  # released on failure
@@ -0,0 +1,20 @@
+
+from mail_serv_test import *
+from mail_serv.syncstate import *
+
+os.environ['SYNCSTATE_DIR'] = f"{THIS_DIR}/tmp/syncstate"
+
+
+def test_syncstate_store():
+    print()
+    user = 'state-user@domain'
+    destination = 'tcp:1.2.3.4:1234'
+    syncstate_drop(user, destination)
+    assert syncstate_get(user, destination, '*') == ""
+    syncstate_put(user, destination, '*', 'state-1')
+    syncstate_put(user, destination, 'guid-1', 'state-2')
+    assert syncstate_get(user, destination, '*') == 'state-1'
+    assert syncstate_get(user, destination, 'guid-1') == 'state-2'
+    syncstate_drop(user, destination, 'guid-1')
+    assert syncstate_get(user, destination, 'guid-1') == ""
+    assert os.path.isfile(f"{syncstate_dir()}/domain/state-user.json")
@@ -0,0 +1,44 @@
+
+import json
+from mail_serv_test import *
+from mail_serv.timing import *
+from mail_serv.support import fs_rmany
+
+os.environ['TIMING_REPORT_DIR'] = f"{THIS_DIR}/tmp/timing"
+
+
+def test_timing_percentile():
+    print()
+    value_list = [float(index) for index in range(1, 101)]
+    assert timing_percentile(value_list, 50) == 50
+    assert timing_percentile(value_list, 95) == 95
+    assert timing_percentile(value_list, 100) == 100
+    assert timing_percentile([7.0], 95) == 7
+    assert timing_percentile([], 50) == 0
+
+
+def test_timing_session():
+    print()
+    session = 'tester-timing'
+    report_file = timing_report_file(session)
+    fs_rmany(report_file)
+
+    with timing_measure('none@domain', 'ignored'):
+        pass  # outside of session
+
+    with timing_session(session) as collector:
+        for user_name in ['fast@domain', 'slow@domain']:
+            with timing_measure(user_name, 'total'):
+                with timing_measure(user_name, 'maintain'):
+                    time.sleep(0.02 if user_name == 'slow@domain' else 0.001)
+
+    with open(report_file, "r") as report_text:
+        report_list = [json.loads(line) for line in report_text]
+    assert len(report_list) == 1
+    report = report_list[0]
+    print(report)
+    assert report['run_id'] == collector.run_id
+    assert report['user_count'] == 2
+    assert report['step']['maintain']['count'] == 2
+    assert report['step']['maintain']['max'] >= 0.02
+    assert report['slowest_user'][0]['user'] == 'slow@domain'
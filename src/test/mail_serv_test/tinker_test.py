@@ -1,6 +1,9 @@
 
+import time
 from mail_serv_test import *
+from mail_serv import tinker
 from mail_serv.tinker import *
+from mail_serv.support import fs_copy, fs_rmany
 
 
 def test_tinker_default():
@@ -35,3 +38,82 @@ def test_tinker_script_addr():
 def test_tinker_skip_list():
     print()
     assert tinker_skip_list() == ['readme.md', 'readme.txt', 'readme.rst']
+
+
+def test_tinker_registry(monkeypatch):
+    print()
+    etc_dir = f"{THIS_DIR}/tmp/tinker-registry"
+    fs_rmany(etc_dir)
+    fs_copy(f"{THIS_DIR}/etc/tinc", etc_dir)
+    monkeypatch.setenv('TINKER_ETC_DIR', etc_dir)
+    monkeypatch.setattr(tinker, 'config_doveadm_port', lambda: '1234')
+    node_dir = tinker_node_dir()
+
+    registry = NodeRegistry()
+    snapshot = registry.snapshot()
+    print(snapshot)
+    assert [entry.name for entry in snapshot] == ['serv_2', 'serv_3']
+    assert snapshot[0] == NodeEntry('serv_2', '2.3.4.5', '1234', '2019-09-01T16:05:25Z')
+    assert registry.snapshot() is snapshot  # no change, no rebuild
+    assert registry.host_name == 'serv_1'
+    assert registry.user_snapshot('user@domain') == snapshot  # mesh topology
+
+    with open(f"{node_dir}/serv_4", "w") as node_conf:
+        node_conf.write("node_addr=10.1.1.4\n")
+    assert [entry.name for entry in registry.snapshot()] == ['serv_2', 'serv_3', 'serv_4']
+
+
+def test_tinker_registry_watch(monkeypatch):
+    print()
+    etc_dir = f"{THIS_DIR}/tmp/tinker-watch"
+    fs_rmany(etc_dir)
+    fs_copy(f"{THIS_DIR}/etc/tinc", etc_dir)
+    monkeypatch.setenv('TINKER_ETC_DIR', etc_dir)
+    monkeypatch.setattr(tinker, 'config_doveadm_port', lambda: '1234')
+    node_dir = tinker_node_dir()
+
+    registry = NodeRegistry()
+    registry.watch_start()
+    time.sleep(0.5)
+    assert [entry.name for entry in registry.snapshot()] == ['serv_2', 'serv_3']
+
+    os.remove(f"{node_dir}/serv_3")
+    time.sleep(0.5)
+    assert [entry.name for entry in registry.snapshot()] == ['serv_2']
+
+
+def test_tinker_ring_stable():
+    print()
+    name_list = [f"serv_{index}" for index in range(1, 9)]
+    user_list = [f"user-{index}@domain" for index in range(1000)]
+    ring_full = HashRing(tuple(name_list), 64)
+    ring_less = HashRing(tuple(name_list[:-1]), 64)  # serv_8 subnet down
+    for user in user_list:
+        replica_list = ring_full.replica_list(user, 2)
+        assert len(set(replica_list)) == 2
+        assert ring_full.replica_list(user, 2) == replica_list
+        if 'serv_8' not in replica_list:
+            assert ring_less.replica_list(user, 2) == replica_list  # minimal reassignment
+    owner_count = dict()
+    for user in user_list:
+        for name in ring_full.replica_list(user, 2):
+            owner_count[name] = owner_count.get(name, 0) + 1
+    assert min(owner_count.values()) > 1000 * 2 / 8 / 2  # reasonable spread
+    assert HashRing(('serv_1',), 8).replica_list('user@domain', 3) == ['serv_1']
+
+
+def test_tinker_user_peer_list(monkeypatch):
+    print()
+    node_name_list = ['serv_2', 'serv_3', 'serv_4', 'serv_5']
+    assert tinker_user_peer_list('user@domain', 'serv_1', node_name_list) == node_name_list
+    monkeypatch.setenv('TINKER_TOPOLOGY', 'ring')
+    monkeypatch.setenv('TINKER_RING_REPLICA', '2')
+    name_tuple = ('serv_1', 'serv_2', 'serv_3', 'serv_4', 'serv_5')
+    for index in range(100):
+        user = f"user-{index}@domain"
+        home_list = HashRing(name_tuple, tinker_ring_vnode()).replica_list(user, 2)
+        peer_list = tinker_user_peer_list(user, 'serv_1', node_name_list)
+        if 'serv_1' in home_list:
+            assert len(peer_list) == 1  # rest of home set
+        else:
+            assert peer_list == sorted(home_list)  # whole home set
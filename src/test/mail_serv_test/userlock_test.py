@@ -0,0 +1,66 @@
+
+import threading
+from mail_serv_test import *
+from mail_serv.userlock import *
+from mail_serv.metrics import metrics_instance
+
+os.environ['USERLOCK_DIR'] = f"{THIS_DIR}/tmp/userlock"
+
+
+def test_userlock_process():
+    print()
+    user = 'lock-user@domain'
+    entered = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with userlock_hold(user):
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    entered.wait(5)
+    busy_count = metrics_instance().total('userlock_busy', scope='process')
+    try:
+        with userlock_hold(user, wait=0.1):
+            assert False, "expect busy"
+    except UserLockBusy:
+        pass
+    assert metrics_instance().total('userlock_busy', scope='process') == busy_count + 1
+    release.set()
+    thread.join()
+    with userlock_hold(user, wait=0.1):
+        pass
+    assert user not in userlock_table.lock_map
+
+
+def test_userlock_host():
+    print()
+    user = 'host-user@domain'
+    path = userlock_file(user)
+    fs_mkdir(os.path.dirname(path))
+    with open(path, "a") as lock_file:  # stand-in for other process
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with userlock_hold(user, wait=0.1):
+                assert False, "expect busy"
+        except UserLockBusy:
+            pass
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    with userlock_hold(user, wait=0.1):
+        pass
+
+
+def test_userlock_kind():
+    print()
+    user = 'kind-user@domain'
+    assert userlock_file(user) != userlock_file(user, 'sieve')
+    with userlock_hold(user, wait=0.1, kind='sieve'):
+        with userlock_hold(user, wait=0.1):  # independent of replication
+            pass
+        try:
+            with userlock_hold(user, wait=0.1, kind='sieve'):
+                assert False, "expect busy"
+        except UserLockBusy:
+            pass